@@ -1,3 +1,11 @@
+import sys
+import json
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+
+
 class Loader(object):
 
     def __init__(self):
@@ -15,3 +23,106 @@ class Loader(object):
     @classmethod
     def get_loader(cls, nothing):
         return cls()
+
+
+def _n_bytes(value):
+    """Approximate memory footprint of loaded data or labels."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif sp.issparse(value):
+        value = value.tocsr()
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    else:
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+
+
+def _n_samples(value):
+    return value.shape[0] if hasattr(value, 'shape') else len(value)
+
+
+class LoaderCache(object):
+    """Cache for data and labels returned by loaders.
+
+    Entries are keyed by the dataset name and serialized configuration of
+    the loader, so that distinct loader instances with the same
+    configuration share them. Loaders that are not serializable (without
+    dataset_name attribute) are not cached.
+
+    Cached dense arrays are shared between callers and made read-only.
+    Sparse matrices cannot be made read-only, so a copy is returned to each
+    caller (copying is still much cheaper than loading); label lists are
+    copied. On cache hits, the number of samples is checked by the loader
+    as if the value had been loaded.
+
+    Parameters
+    ----------
+    max_bytes: int or None
+        Approximate maximum size of cached values; least recently used
+        entries are evicted first. None means no limit.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()  # key -> (value, n_bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, loader, what):
+        try:
+            name = loader.dataset_name
+        except AttributeError:
+            return None
+        return (name, json.dumps(loader.serialize(), sort_keys=True), what)
+
+    def get(self, loader, what):
+        """Returns loader.get_<what>(), from cache if possible."""
+        key = self.key(loader, what)
+        if key is None:
+            return getattr(loader, 'get_' + what)()
+        if key in self._entries:
+            entry = self._entries.pop(key)
+            self._entries[key] = entry  # Move to most recently used
+            value = entry[0]
+            if hasattr(loader, 'check_n_samples'):
+                loader.check_n_samples(_n_samples(value))
+        else:
+            value = getattr(loader, 'get_' + what)()
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            self._store(key, value)
+        if sp.issparse(value):
+            value = value.copy()
+        return value
+
+    def get_data(self, loader):
+        return self.get(loader, 'data')
+
+    def get_labels(self, loader):
+        return list(self.get(loader, 'labels'))
+
+    def _store(self, key, value):
+        n_bytes = _n_bytes(value)
+        if self.max_bytes is not None and n_bytes > self.max_bytes:
+            return
+        self._entries[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.max_bytes is not None and self.n_bytes > self.max_bytes:
+            _, (_, n_bytes) = self._entries.popitem(last=False)
+            self.n_bytes -= n_bytes
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self.n_bytes = 0
+
+
+# Process-wide cache, used by experiments
+loader_cache = LoaderCache()
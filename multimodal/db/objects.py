@@ -90,7 +90,7 @@ class ObjectsLoader(Loader):
 
     def serialize(self):
         return {'features': self.feature_list,
-                'labels': list(self.labels_to_keep)}
+                'labels': sorted(self.labels_to_keep)}
 
     @classmethod
     def get_loader(cls, cfg):
@@ -1,21 +1,46 @@
 """Helpers to evaluate learning results."""
 
 
+import warnings
+
 import scipy.sparse as sp
 import numpy as np
+from scipy.cluster.vq import kmeans2
+
+from .lib.array_utils import row_sums, dense_dot_T
+from .lib.metrics import (EPSILON, kl_div, rev_kl_div, sym_kl_div, frobenius,
+                          cosine_diff, KLTerms, pairwise_kl, pairwise_rev_kl,
+                          pairwise_sym_kl)
+
+
+# Default memory budget (in bytes) for temporaries of pairwise distances
+MAX_MEMORY = 2 ** 27
 
 
 def compare_labels_given_nb(reco_label_vect, true_label_vect):
+    """For each example, compares the true labels with the labels of highest
+    activations in reco_label_vect, taking as many labels as there are
+    true labels.
+    """
     if len(reco_label_vect.shape) == 1:
         reco_label_vect = reco_label_vect[np.newaxis, :]
         true_label_vect = true_label_vect[np.newaxis, :]
-    nb_ex = true_label_vect.shape[0]
-    nb_true = true_label_vect.sum(axis=-1)
-    # Sort -vect to get idx in decreasing order
-    idx = np.argsort(-reco_label_vect, axis=-1)
-    e = np.eye(true_label_vect.shape[-1])
-    reco_given_nb = np.vstack([e[idx[i, :nb_true[i]], :].sum(axis=0)
-                               for i in range(nb_ex)])
+    reco_label_vect = np.asarray(reco_label_vect)
+    true_label_vect = np.asarray(true_label_vect)
+    nb_ex, nb_labels = true_label_vect.shape
+    nb_true = true_label_vect.sum(axis=-1).astype(int)
+    reco_given_nb = np.zeros((nb_ex, nb_labels), dtype=bool)
+    k = min(nb_true.max(), nb_labels) if nb_ex > 0 else 0
+    if k > 0:
+        # Indices of the k highest activations, in decreasing order
+        top = np.argpartition(-reco_label_vect, k - 1, axis=-1)[:, :k]
+        order = np.argsort(-np.take_along_axis(reco_label_vect, top, -1),
+                           axis=-1)
+        top = np.take_along_axis(top, order, -1)
+        # Only keep the nb_true first ones
+        keep = np.arange(k)[np.newaxis, :] < nb_true[:, np.newaxis]
+        rows = np.repeat(np.arange(nb_ex)[:, np.newaxis], k, axis=1)
+        reco_given_nb[rows[keep], top[keep]] = True
     return (reco_given_nb == true_label_vect).all(axis=-1)
 
 
@@ -24,6 +49,37 @@ def score_labels_given_nb(reco_label_vect, true_label_vect):
             compare_labels_given_nb(reco_label_vect, true_label_vect))
 
 
+class GivenNbScoreAccumulator(object):
+    """Computes score_labels_given_nb over chunks of examples.
+
+    Accumulators from different processes can be merged.
+    """
+
+    def __init__(self):
+        self.n_correct = 0
+        self.n_samples = 0
+
+    def add(self, reco_label_vect, true_label_vect):
+        """Scores a chunk of examples and returns results for each example
+        (see compare_labels_given_nb).
+        """
+        ok = compare_labels_given_nb(reco_label_vect, true_label_vect)
+        self.n_correct += int(ok.sum())
+        self.n_samples += ok.shape[0]
+        return ok
+
+    def merge(self, other):
+        self.n_correct += other.n_correct
+        self.n_samples += other.n_samples
+        return self
+
+    @property
+    def score(self):
+        if self.n_samples == 0:
+            return np.nan
+        return self.n_correct / float(self.n_samples)
+
+
 def compare_labels_threshold(reco_label_vect, true_label_vect, threshold):
     return ((reco_label_vect >= threshold) == true_label_vect).all(axis=-1)
 
@@ -79,18 +135,79 @@ def dists_to_found_labels(dists, ex_labels):
 
 
 def found_labels_to_score(true, found):
-    ok = [f == l for f, l in zip(found, true)]
-    result = np.average(ok)
-    return result
+    try:
+        true_array, found_array = np.asarray(true), np.asarray(found)
+    except ValueError:  # Labels of various lengths
+        true_array = found_array = None
+    if (true_array is not None and true_array.ndim == 1
+            and true_array.shape == found_array.shape):
+        return np.average(true_array == found_array)
+    else:  # Labels are not scalars
+        ok = [f == l for f, l in zip(found, true)]
+        return np.average(ok)
 
 
 def found_labels_to_confusion(true, found, n_labels):
     """n_labels x n_labels matrix
     conf[i, j] is number of time label i has been classified as j.
     """
-    conf = np.zeros((n_labels, n_labels))
-    conf[true, found] += 1
-    return conf
+    acc = ConfusionAccumulator(n_labels)
+    acc.add(true, found)
+    return acc.confusion.astype(np.float64)
+
+
+class ConfusionAccumulator(object):
+    """Accumulates a confusion matrix from chunks of labels (integers in
+    range(n_labels)).
+
+    confusion[i, j] is the number of time label i has been classified as j.
+    Accumulators from different processes can be merged.
+    """
+
+    def __init__(self, n_labels):
+        self.n_labels = n_labels
+        self.confusion = np.zeros((n_labels, n_labels), dtype=np.int64)
+
+    def add(self, true, found):
+        true = np.asarray(true, dtype=np.int64).ravel()
+        found = np.asarray(found, dtype=np.int64).ravel()
+        if true.shape != found.shape:
+            raise ValueError('Got %d true labels and %d found labels.'
+                             % (true.shape[0], found.shape[0]))
+        for labels in (true, found):
+            if len(labels) > 0 and (labels.min() < 0
+                                    or labels.max() >= self.n_labels):
+                raise ValueError('Labels should be in range(%d).'
+                                 % self.n_labels)
+        n = self.n_labels
+        self.confusion += np.bincount(true * n + found,
+                                      minlength=n * n).reshape((n, n))
+
+    def merge(self, other):
+        if other.n_labels != self.n_labels:
+            raise ValueError('Can not merge accumulators with different '
+                             'numbers of labels.')
+        self.confusion += other.confusion
+        return self
+
+    @property
+    def n_samples(self):
+        return int(self.confusion.sum())
+
+    @property
+    def accuracy(self):
+        if self.n_samples == 0:
+            return np.nan
+        return np.trace(self.confusion) / float(self.n_samples)
+
+    @property
+    def recall(self):
+        """Ratio of well classified examples for each true label (nan for
+        labels without examples).
+        """
+        n_true = self.confusion.sum(axis=1).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.diagonal(self.confusion) / n_true
 
 
 def todense(X):
@@ -100,10 +217,131 @@ def todense(X):
         return X
 
 
-def all_distances(reco_data, ex_data, measure):
-    reco_data = todense(reco_data)[:, np.newaxis, :]
-    ex_data = todense(ex_data)[np.newaxis, :, :]
-    return measure(reco_data, ex_data, axis=-1)
+def _dense(X):
+    return np.asarray(X.todense()) if sp.issparse(X) else np.asarray(X)
+
+
+def _square_norms(X):
+    if sp.issparse(X):
+        return row_sums(X.multiply(X))
+    else:
+        return np.einsum('ij,ij->i', X, X)
+
+
+def _frobenius_from_products(a_norms, b_norms, ab):
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b
+    sq = a_norms[:, np.newaxis] + b_norms[np.newaxis, :] - 2 * ab
+    return np.sqrt(np.maximum(sq, 0))
+
+
+def _cosine_diff_from_products(a_norms, b_norms, ab):
+    return -ab / (np.sqrt(a_norms[:, np.newaxis] * b_norms[np.newaxis, :])
+                  + (ab == 0))  # 0 when a == 0 or b == 0
+
+
+# Measures computed from KL terms (see KLTerms)
+_KL_MEASURES = {
+    kl_div: pairwise_kl,
+    rev_kl_div: pairwise_rev_kl,
+    sym_kl_div: pairwise_sym_kl,
+    }
+# Measures computed from square norms and dot products
+_PRODUCT_MEASURES = {
+    frobenius: _frobenius_from_products,
+    cosine_diff: _cosine_diff_from_products,
+    }
+
+
+class _ExampleTerms(object):
+    """Terms depending only on examples, shared by all measures and chunks.
+    """
+
+    def __init__(self, ex_data, measures):
+        self.X = ex_data
+        if any(m in _KL_MEASURES for m in measures):
+            self.kl = KLTerms(ex_data)
+        if any(m in _PRODUCT_MEASURES for m in measures):
+            self.norms = _square_norms(ex_data)
+        if any(m not in _KL_MEASURES and m not in _PRODUCT_MEASURES
+               for m in measures):
+            self.dense = _dense(ex_data)[np.newaxis, :, :]
+
+
+def _chunk_distances(A, ex, measures):
+    """Distances between rows of A and examples for each measure; terms
+    depending on A (logs, norms, dot products) are computed once.
+    """
+    kl = norms = products = dense = None
+    dists = []
+    for measure in measures:
+        if measure in _KL_MEASURES:
+            if kl is None:
+                kl = KLTerms(A)
+            dists.append(_KL_MEASURES[measure](kl, ex.kl))
+        elif measure in _PRODUCT_MEASURES:
+            if products is None:
+                norms = _square_norms(A)
+                products = dense_dot_T(A, ex.X)
+            dists.append(_PRODUCT_MEASURES[measure](norms, ex.norms,
+                                                    products))
+        else:
+            if dense is None:
+                dense = _dense(A)[:, np.newaxis, :]
+            dists.append(measure(dense, ex.dense, axis=-1))
+    return dists
+
+
+def _as_rows(X):
+    """Dense arrays or CSR matrices (efficient row slicing)."""
+    return X.tocsr() if sp.issparse(X) else np.asarray(X)
+
+
+def _chunk_rows(n_rows, bytes_per_row, max_memory):
+    step = max(1, int(max_memory // max(1, bytes_per_row)))
+    for start in range(0, n_rows, step):
+        yield slice(start, min(start + step, n_rows))
+
+
+def all_distances_multi(reco_data, ex_data, measures, max_memory=MAX_MEMORY):
+    """Returns the list of matrices of distances between each row of
+    reco_data and each row of ex_data, for each measure.
+
+    For kl_div, rev_kl_div, sym_kl_div, frobenius and cosine_diff,
+    distances are computed from matrix products (sparse inputs are not
+    densified) and terms shared by several measures are only computed
+    once. Other measures are applied by broadcasting, which requires dense
+    temporaries of size n_reco x n_ex x n_features. In both cases rows of
+    reco_data are processed by chunks so that temporaries use about
+    max_memory bytes.
+    """
+    reco_data = _as_rows(reco_data)
+    ex_data = _as_rows(ex_data)
+    n_ex, n_features = ex_data.shape
+    dists = [np.zeros((reco_data.shape[0], n_ex)) for _ in measures]
+    # Estimate memory used by temporaries for each sample
+    per_row = 2 * n_features + len(measures) * n_ex
+    if any(m in _KL_MEASURES for m in measures):
+        per_row += 4 * n_ex
+    if any(m in _PRODUCT_MEASURES for m in measures):
+        per_row += 3 * n_ex
+    if any(m not in _KL_MEASURES and m not in _PRODUCT_MEASURES
+           for m in measures):
+        per_row += 2 * n_ex * n_features
+    per_row *= np.dtype(np.float64).itemsize
+    ex = _ExampleTerms(ex_data, measures)
+    for rows in _chunk_rows(reco_data.shape[0], per_row, max_memory):
+        for d, chunk in zip(dists, _chunk_distances(reco_data[rows], ex,
+                                                    measures)):
+            d[rows, :] = chunk
+    return dists
+
+
+def all_distances(reco_data, ex_data, measure, max_memory=MAX_MEMORY):
+    """Matrix of distances between each row of reco_data and each row of
+    ex_data (see all_distances_multi).
+    """
+    return all_distances_multi(reco_data, ex_data, [measure],
+                               max_memory=max_memory)[0]
 
 
 def classify_NN(reco_data, ex_data, ex_labels, measure):
@@ -116,6 +354,14 @@ def classify_NN(reco_data, ex_data, ex_labels, measure):
     return dists_to_found_labels(dists, ex_labels)
 
 
+def classify_NN_multi(reco_data, ex_data, ex_labels, measures):
+    """Same as classify_NN for several measures at once (shared terms are
+    only computed once). Returns the list of found labels for each measure.
+    """
+    return [dists_to_found_labels(dists, ex_labels)
+            for dists in all_distances_multi(reco_data, ex_data, measures)]
+
+
 def evaluate_NN_label(reco_data, test_data, true_labels, test_labels, measure):
     """For each sample in reco_data, compares it with all examples of
     test_data. The test is considered successful when the label corresponding
@@ -124,7 +370,202 @@ def evaluate_NN_label(reco_data, test_data, true_labels, test_labels, measure):
 
     test_data should not contain examples that appear in reco_data
     """
-    reco_data = todense(reco_data)[:, np.newaxis, :]
-    test_data = todense(test_data)[np.newaxis, :, :]
-    dists = measure(reco_data, test_data, axis=-1)
+    dists = all_distances(reco_data, test_data, measure)
     return scores_from_dists(dists, true_labels, test_labels)
+
+
+def _top_k(dists, k):
+    """Indices and values of the k smallest distances on each row, sorted;
+    missing neighbors have index -1 and infinite distance.
+    """
+    n, m = dists.shape
+    idx = -np.ones((n, k), dtype=int)
+    values = np.inf * np.ones((n, k))
+    kk = min(k, m)
+    if kk > 0:
+        best = np.argpartition(dists, kk - 1, axis=1)[:, :kk]
+        best_dists = np.take_along_axis(dists, best, axis=1)
+        order = np.argsort(best_dists, axis=1)
+        idx[:, :kk] = np.take_along_axis(best, order, axis=1)
+        values[:, :kk] = np.take_along_axis(best_dists, order, axis=1)
+    return values, idx
+
+
+class NeighborIndex(object):
+    """Bank of labeled examples for nearest neighbor queries.
+
+    Examples can be added at any time (add); query returns the k nearest
+    examples of each sample. Subclasses implement the search (_search) and
+    may maintain additional structures when examples are added (_added).
+
+    Parameters
+    ----------
+    measure: function
+        Distance, with the same signature as measures from
+        multimodal.lib.metrics (e.g. frobenius or cosine_diff).
+    """
+
+    def __init__(self, measure=cosine_diff):
+        self.measure = measure
+        self.labels = []
+        self._data = None
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def data(self):
+        return self._data[:self._n, :]
+
+    def add(self, X, labels=None):
+        """Adds examples (rows of X) with given labels."""
+        X = np.atleast_2d(_dense(X)).astype(np.float64)
+        if labels is None:
+            labels = [None] * X.shape[0]
+        elif len(labels) != X.shape[0]:
+            raise ValueError('Got %d labels for %d examples.'
+                             % (len(labels), X.shape[0]))
+        if self._data is None:
+            self._data = np.zeros((max(1, X.shape[0]), X.shape[1]))
+        elif X.shape[1] != self._data.shape[1]:
+            raise ValueError('Wrong number of features: %d (expected %d).'
+                             % (X.shape[1], self._data.shape[1]))
+        start, stop = self._n, self._n + X.shape[0]
+        if stop > self._data.shape[0]:  # Grow storage geometrically
+            new = np.zeros((max(stop, 2 * self._data.shape[0]),
+                            X.shape[1]))
+            new[:start, :] = self.data
+            self._data = new
+        self._data[start:stop, :] = X
+        self.labels.extend(labels)
+        self._n = stop
+        self._added(start, stop)
+
+    def _added(self, start, stop):
+        pass
+
+    def query(self, X, k=1):
+        """Returns distances and indices (arrays of shape (n_samples, k)) of
+        the k nearest examples of each sample, closest first. Missing
+        neighbors have index -1 and infinite distance.
+        """
+        X = np.atleast_2d(_dense(X))
+        if self._n == 0:
+            return _top_k(np.zeros((X.shape[0], 0)), k)
+        return self._search(X, k)
+
+    def _search(self, X, k):
+        raise NotImplementedError
+
+    def found_labels(self, X):
+        """Labels of the nearest example of each sample (None if the index
+        is empty).
+        """
+        _, idx = self.query(X, k=1)
+        return [self.labels[i] if i >= 0 else None for i in idx[:, 0]]
+
+
+class ExactNeighborIndex(NeighborIndex):
+    """Compares samples with all examples (supports any measure)."""
+
+    def _search(self, X, k):
+        return _top_k(all_distances(X, self.data, self.measure), k)
+
+
+class IVFNeighborIndex(NeighborIndex):
+    """Approximate index based on a coarse quantizer.
+
+    Examples are clustered (k-means) into n_lists inverted lists; samples
+    are only compared with examples from the n_probe lists with closest
+    centroids. For cosine_diff, clustering is done on normalized vectors.
+    Empty lists are skipped and more lists are probed when the probed ones
+    hold less than k examples, so that k neighbors are found whenever the
+    index holds at least k examples.
+
+    The quantizer is trained once train_ratio * n_lists examples have been
+    added, and trained again each time the number of examples doubles;
+    before that, search is exact.
+
+    random_state: seed (int) or random number generator used by k-means,
+    default to numpy's global random state.
+    """
+
+    def __init__(self, measure=cosine_diff, n_lists=16, n_probe=2,
+                 train_ratio=8, random_state=None):
+        if measure not in (cosine_diff, frobenius):
+            raise ValueError('IVFNeighborIndex only supports cosine_diff '
+                             'and frobenius measures.')
+        super(IVFNeighborIndex, self).__init__(measure=measure)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_ratio = train_ratio
+        self.random_state = random_state
+        self.centroids = None
+        self._lists = None
+        self._n_trained = 0
+
+    def _quantizer_space(self, X):
+        if self.measure is cosine_diff:
+            norms = np.sqrt(np.square(X).sum(axis=1))
+            return X / (norms[:, np.newaxis] + EPSILON)
+        else:
+            return X
+
+    def _assign(self, X):
+        return np.argmin(all_distances(self._quantizer_space(X),
+                                       self.centroids, frobenius), axis=1)
+
+    def _fill_lists(self, start, stop):
+        assigned = self._assign(self._data[start:stop, :])
+        for c in np.unique(assigned):
+            self._lists[c].extend(start + np.flatnonzero(assigned == c))
+
+    def train(self):
+        """Clusters current examples and rebuilds inverted lists."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # Empty clusters
+            self.centroids, _ = kmeans2(self._quantizer_space(self.data),
+                                        min(self.n_lists, self._n),
+                                        minit='++', seed=self.random_state)
+        self._lists = [[] for _ in range(self.centroids.shape[0])]
+        self._fill_lists(0, self._n)
+        self._n_trained = self._n
+
+    def _added(self, start, stop):
+        if (self._n >= self.train_ratio * self.n_lists
+                and self._n >= 2 * self._n_trained):
+            self.train()
+        elif self.centroids is not None:
+            self._fill_lists(start, stop)
+
+    def _search(self, X, k):
+        if self.centroids is None:
+            return _top_k(all_distances(X, self.data, self.measure), k)
+        dists = np.inf * np.ones((X.shape[0], k))
+        idx = -np.ones((X.shape[0], k), dtype=int)
+        to_centroids = all_distances(self._quantizer_space(X),
+                                     self.centroids, frobenius)
+        # Lists by increasing distance to their centroid; the n_probe
+        # closest non empty lists are probed, then following ones until they
+        # hold enough candidates
+        order = np.argsort(to_centroids, axis=1)
+        sizes = np.array([len(l) for l in self._lists])[order]
+        non_empty = sizes > 0
+        n_before = np.cumsum(non_empty, axis=1) - non_empty
+        size_before = np.cumsum(sizes, axis=1) - sizes
+        probed = non_empty & ((n_before < self.n_probe)
+                              | (size_before < min(k, self._n)))
+        # Samples probing the same lists are processed together
+        groups = {}
+        for i in range(X.shape[0]):
+            p = tuple(np.sort(order[i, probed[i]]))
+            groups.setdefault(p, []).append(i)
+        for probe, rows in groups.items():
+            candidates = np.hstack([np.asarray(self._lists[c], dtype=int)
+                                    for c in probe])
+            d, j = _top_k(all_distances(X[rows, :], self._data[candidates],
+                                        self.measure), k)
+            dists[rows, :] = d
+            idx[rows, :] = np.where(j >= 0, candidates[j], -1)
+        return dists, idx
@@ -2,19 +2,25 @@
 
 
 import os
+import copy
 import json
+import hashlib
 from datetime import datetime
 from itertools import product
 from collections import OrderedDict
+from multiprocessing import Pool
 
 import numpy as np
 
 from .lib.logger import Logger
 from .lib.metrics import kl_div, rev_kl_div, cosine_diff, frobenius
-from .lib.utils import random_split, leave_one_out
+from .lib.utils import random_split, leave_one_out, effective_n_jobs
+from .lib.shared_arrays import SharedMatrix
+from .db.models.loader import loader_cache
 from .pairing import associate_samples
 from .learner import MultimodalLearner
-from .evaluation import classify_NN, found_labels_to_score, chose_examples
+from .evaluation import (classify_NN_multi, found_labels_to_score,
+                         chose_examples)
 
 
 DEFAULT_PARAMS = {
@@ -29,6 +35,46 @@ EX = 1
 
 INTERNAL = -1
 
+# Measures used for evaluation and corresponding suffixes of result keys
+METRICS = [kl_div, rev_kl_div, frobenius, cosine_diff]
+METRIC_SUFFIXES = ['', '_bis', '_frob', '_cosine']
+
+# Number of chunks of runs sent to each process in parallel experiments
+CHUNKS_PER_JOB = 4
+
+
+def _encode_random_state(state):
+    """Converts numpy random state to a list that can be stored as json."""
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return [name, [int(k) for k in keys], int(pos), int(has_gauss),
+            float(cached_gaussian)]
+
+
+def _decode_random_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return (name, np.array(keys, dtype=np.uint32), pos, has_gauss,
+            cached_gaussian)
+
+
+def _run_splits_worker(args):
+    """Performs runs on the given splits in a worker process and returns a
+    logger holding them.
+    """
+    experiment, shared_data, shared_ex, seeded_splits, previous_dico = args
+    experiment.data = [s.get() for s in shared_data]
+    experiment.data_ex = [s.get() for s in shared_ex]
+    experiment.logger = Logger()
+    experiment._previous_dico = previous_dico
+    try:
+        for seed, (train, test) in seeded_splits:
+            np.random.seed(seed)
+            experiment._run_split(train, test)
+    finally:
+        experiment.data = experiment.data_ex = None
+        for s in shared_data + shared_ex:
+            s.close()
+    return experiment.logger
+
 
 class Experiment(object):
 
@@ -42,7 +88,8 @@ class Experiment(object):
 class MultimodalExperiment(Experiment):
 
     def __init__(self, loaders, k, iter_train, iter_test, coefs=None,
-                 shuffle_labels=False, run_mode=.1, debug=False):
+                 shuffle_labels=False, run_mode=.1, debug=False,
+                 warm_start=False, iter_warm=None):
         super(MultimodalExperiment, self).__init__()
         self.modalities = list(loaders.keys())
         self.loaders = [loaders[m] for m in self.modalities]
@@ -53,6 +100,12 @@ class MultimodalExperiment(Experiment):
         self.shuffle_labels = shuffle_labels
         self.run_mode = run_mode  # (ratio (float)|leave-one-out|single-run)
         self.debug = debug
+        # Start training from the dictionary of previous run (mostly
+        # relevant for leave-one-out) with iter_warm iterations
+        self.warm_start = warm_start
+        self.iter_warm = (max(1, iter_train // 5) if iter_warm is None
+                          else iter_warm)
+        self._previous_dico = None
 
     @property
     def n_modalities(self):
@@ -65,7 +118,7 @@ class MultimodalExperiment(Experiment):
         return d
 
     def _get_raw_labels(self):
-        return [loader.get_labels() for loader in self.loaders]
+        return [loader_cache.get_labels(loader) for loader in self.loaders]
 
     def _set_coefs(self, raw_data):
         if self.coefs is None:
@@ -76,8 +129,8 @@ class MultimodalExperiment(Experiment):
         self.labels_all = labels
         self.logger.store_global('label_pairing', self.label_association)
         self.logger.store_global('sample_pairing', assoc_idx)
-        # Load data
-        raw_data = [loader.get_data() for loader in self.loaders]
+        # Load data (shared with other experiments using the same loaders)
+        raw_data = [loader_cache.get_data(loader) for loader in self.loaders]
         # Eventually compute weighting coefficients for modalities
         self._set_coefs(raw_data)
         # Order data
@@ -101,19 +154,40 @@ class MultimodalExperiment(Experiment):
         self.labels_ex = [self.labels_all[i] for i in self.examples]
         self.labels = [self.labels_all[i] for i in self.others]
 
-    def prepare(self):
+    def prepare(self, restore=None):
+        """Pairs samples, splits examples from other data and prepares the
+        generator of runs.
+
+        restore: global logs from a previous execution (optional), from
+            which the pairing and the random state used to generate runs are
+            restored.
+        """
         # Log parameters
         params = self._parameters_to_dict()
         for key in params:
             self.logger.store_global(key, params[key])
         # Generate pairing and order data
         raw_labels = self._get_raw_labels()
-        (label_assoc, labels, assoc_idx) = associate_samples(
-            raw_labels, shuffle=self.shuffle_labels)
+        if restore is None:
+            (label_assoc, labels, assoc_idx) = associate_samples(
+                raw_labels, shuffle=self.shuffle_labels)
+        else:
+            label_assoc = restore['label_pairing']
+            assoc_idx = restore['sample_pairing']
+            labels = [label_assoc[0].index(raw_labels[0][idx[0]])
+                      for idx in assoc_idx]
         self._set_labels_and_prepare_data(label_assoc, labels, assoc_idx)
         # Chose examples for evaluation and split labels and data
         self._set_data_and_labels_for_examples(
                 chose_examples([l for l in self.labels_all]))
+        self._previous_dico = None
+        if restore is None:
+            self.logger.store_global(
+                'random_state', _encode_random_state(np.random.get_state()))
+        else:
+            self.logger.store_global('random_state', restore['random_state'])
+            np.random.set_state(_decode_random_state(
+                restore['random_state']))
         self.run_generator = self.get_generator()
         # Safety...
         assert(set(self.labels_ex) == set(self.labels_all))
@@ -137,26 +211,155 @@ class MultimodalExperiment(Experiment):
     def n_samples(self):
         return len(self.labels)
 
-    def run(self):
-        self.prepare()
-        self.logger.store_global('start_time', str(datetime.now()))
-        try:
-            while True:
-                self._perform_one_run()
-        except StopIteration:
-            pass
+    @property
+    def n_runs(self):
+        """Number of runs (splits) generated by get_generator."""
+        if self.run_mode == 'leave-one-out':
+            return self.n_samples
+        elif self.run_mode == 'single':
+            return 1
+        else:
+            nb_test = int(self.run_mode * self.n_samples)
+            return len(range(0, nb_test * int(1. / self.run_mode), nb_test))
+
+    def run(self, n_jobs=1, checkpoint=False, resume=False):
+        """Performs all runs and saves the logs.
+
+        n_jobs: number of processes performing runs (negative values count
+            from the number of processors). With several processes, data is
+            shared between them and each run is seeded with a value drawn
+            beforehand (in split order), so that results do not depend on
+            the number of processes; they differ from the ones of serial
+            execution, in which runs share the global random state. Logs of
+            runs are stored in split order.
+
+        checkpoint: if True, global logs and then each finished run are
+            written to a checkpoint file next to the logs (see Logger),
+            which is removed once logs are saved.
+
+        resume: if True, the execution continues from the checkpoint file,
+            if any: pairing and random state are restored from it and
+            finished runs are skipped, so that results are the same as
+            without interruption (provided runs are performed with the same
+            choice of serial or parallel execution). Implies checkpoint.
+            A ValueError is raised if the checkpoint was written by an
+            experiment with a different configuration (see
+            configuration_hash).
+
+        Without destination for the logs (logger.filename), checkpoint and
+        resume are ignored.
+        """
+        checkpoint = checkpoint or resume
+        if checkpoint and self.logger.filename is None:
+            self.logger.log('WARNING: No destination for logs, runs are not '
+                            'checkpointed.')
+            checkpoint = resume = False
+        states = []
+        if resume and os.path.exists(self.logger.checkpoint_filename):
+            self.logger, states = Logger.load_checkpoint(self.logger.filename)
+            stored_hash = self.logger.glob.get('configuration_hash')
+            self.prepare(restore=self.logger.glob)
+            if stored_hash != self.configuration_hash():
+                raise ValueError(
+                    'Checkpoint %s was written with a different '
+                    'configuration, remove it to start a new execution.'
+                    % self.logger.checkpoint_filename)
+        else:
+            self.prepare()
+            self.logger.store_global('start_time', str(datetime.now()))
+            self.logger.store_global('configuration_hash',
+                                     self.configuration_hash())
+            if checkpoint:
+                self.logger.start_checkpoint()
+        n_done = len(self.logger.exps)
+        if self.warm_start and n_done > 0:
+            self._previous_dico = self.logger.exps[-1]['dictionary']
+        n_jobs = effective_n_jobs(n_jobs)
+        if n_jobs == 1:
+            for _ in range(n_done):
+                next(self.run_generator)
+            if n_done > 0 and states[-1] is not None:
+                np.random.set_state(_decode_random_state(states[-1]))
+            try:
+                while True:
+                    self._perform_one_run()
+                    if checkpoint:
+                        self.logger.checkpoint_run(state=_encode_random_state(
+                            np.random.get_state()))
+            except StopIteration:
+                pass
+        else:
+            self._run_parallel(n_jobs, skip=n_done, checkpoint=checkpoint)
         self.logger.store_global('end_time', str(datetime.now()))
         try:
             self.logger.save()
         except self.logger.NoFileError:
             print('Not saving logs: no destination was provided.')
+        else:
+            if checkpoint:
+                self.logger.remove_checkpoint()
 
     def _get_new_learner(self):
         return MultimodalLearner(self.modalities, self.n_features,
                                  self.coefs, self.k)
 
+    def _seeded_split_chunks(self, chunk_size, skip=0):
+        """Generates chunks of chunk_size consecutive splits with seeds,
+        skipping the first ones (chunks do not depend on skip, the first
+        one may then be incomplete).
+        """
+        chunk = []
+        for i, split in enumerate(self.run_generator):
+            seed = np.random.randint(np.iinfo(np.int32).max)
+            if i >= skip:
+                chunk.append((seed, split))
+            if (i + 1) % chunk_size == 0 and len(chunk) > 0:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def _run_parallel(self, n_jobs, skip=0, checkpoint=False):
+        """Performs runs with n_jobs processes, by chunks of consecutive
+        splits, skipping the first ones.
+
+        With warm start, the first run of each chunk starts from scratch
+        (or from the previous run, when resuming in the middle of a chunk).
+        """
+        chunk_size = max(1, int(np.ceil(self.n_runs /
+                                        float(n_jobs * CHUNKS_PER_JOB))))
+        # Copy of the experiment sent to processes, without data
+        skeleton = copy.copy(self)
+        skeleton.data = skeleton.data_ex = None
+        skeleton.logger = skeleton.run_generator = skeleton.loaders = None
+        skeleton._previous_dico = None
+        if skip % chunk_size == 0:
+            self._previous_dico = None  # Resuming at the start of a chunk
+        shared_data = [SharedMatrix(x) for x in self.data]
+        shared_ex = [SharedMatrix(x) for x in self.data_ex]
+        try:
+            pool = Pool(n_jobs)
+            try:
+                tasks = ((skeleton, shared_data, shared_ex, c,
+                          self._previous_dico if i == 0 else None)
+                         for i, c in enumerate(self._seeded_split_chunks(
+                             chunk_size, skip=skip)))
+                for logger in pool.imap(_run_splits_worker, tasks):
+                    self.logger.append_runs_from_other(logger)
+                    if checkpoint:
+                        for i in range(-len(logger.exps), 0):
+                            self.logger.checkpoint_run(index=i)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            for s in shared_data + shared_ex:
+                s.close()
+
     def _perform_one_run(self):
-        train, test = next(self.run_generator)
+        self._run_split(*next(self.run_generator))
+
+    def _run_split(self, train, test):
         self.logger.new_run()
         self.logger.store('train', train)
         self.logger.store('test', test)
@@ -166,7 +369,12 @@ class MultimodalExperiment(Experiment):
         # Init Learner
         learner = self._get_new_learner()
         # Train
-        learner.train(data_train, self.iter_train)
+        if self.warm_start and self._previous_dico is not None:
+            learner.train(data_train, self.iter_warm,
+                          init_dictionary=self._previous_dico)
+        else:
+            learner.train(data_train, self.iter_train)
+        self._previous_dico = learner.get_dico()
         self.logger.store('dictionary', learner.get_dico())
         # Test
         self._evaluate(learner, data_test, test_labels)
@@ -185,6 +393,21 @@ class MultimodalExperiment(Experiment):
                              for l in self.loaders]
         return params
 
+    def configuration_hash(self):
+        """Returns a hash of the parameters, loaders and data dimensions of
+        the experiment (after prepare), used to check that a checkpoint
+        comes from the same experiment.
+        """
+        config = self._parameters_to_dict()
+        config['loaders'] = [
+            (getattr(l, 'dataset_name', type(l).__name__),
+             l.serialize() if hasattr(l, 'serialize') else None)
+            for l in self.loaders]
+        config['n_features'] = self.n_features
+        config['n_samples'] = self.n_samples + len(self.examples)
+        dumped = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
     def save_serialized_parameters(self, destination):
         params = self.serialize_parameters()
         with open(destination, 'w+') as f:
@@ -193,7 +416,8 @@ class MultimodalExperiment(Experiment):
     @classmethod
     def params_to_store(cls):
         return ['modalities', 'k', 'coefs', 'iter_train', 'iter_test',
-                'shuffle_labels', 'run_mode', 'debug']
+                'shuffle_labels', 'run_mode', 'debug', 'warm_start',
+                'iter_warm']
 
     @classmethod
     def get_loader(cls, dataset, conf):
@@ -219,7 +443,9 @@ class MultimodalExperiment(Experiment):
         return cls(loaders, serialized['k'], serialized['iter_train'],
                    serialized['iter_test'], coefs=serialized['coefs'],
                    shuffle_labels=serialized['shuffle_labels'],
-                   run_mode=serialized['run_mode'], debug=serialized['debug'])
+                   run_mode=serialized['run_mode'], debug=serialized['debug'],
+                   warm_start=serialized.get('warm_start', False),
+                   iter_warm=serialized.get('iter_warm'))
 
     @classmethod
     def load_from_serialized(cls, path_to_serialized):
@@ -241,13 +467,11 @@ class TwoModalitiesExperiment(MultimodalExperiment):
                           list(range(self.n_modalities)),
                           [-1] + list(range(self.n_modalities)))
         for (mod1, mod2, mod_cmp) in to_test:
-            for metric, suffix in zip(
-                    [kl_div, rev_kl_div, frobenius, cosine_diff],
-                    ['', '_bis', '_frob', '_cosine']):
-                # Perform recognition
-                found = classify_NN(transformed_data_test[mod1][mod_cmp],
-                                    transformed_data_ex[mod2][mod_cmp],
-                                    self.labels_ex, metric)
+            # Perform recognition (for all metrics at once)
+            all_found = classify_NN_multi(transformed_data_test[mod1][mod_cmp],
+                                          transformed_data_ex[mod2][mod_cmp],
+                                          self.labels_ex, METRICS)
+            for found, suffix in zip(all_found, METRIC_SUFFIXES):
                 # Store found labels
                 self.logger.store_result(
                     self._get_found_key(mod1, mod2, mod_cmp, suffix), found)
@@ -335,13 +559,11 @@ class ThreeModalitiesExperiment(MultimodalExperiment):
         transformed_data_ex = self._get_all_internals(learner, self.data_ex)
         # For each combination of modalities:
         for (mods1, mods2) in self._tested_combinations():
-            for metric, suffix in zip(
-                    [kl_div, rev_kl_div, frobenius, cosine_diff],
-                    ['', '_bis', '_frob', '_cosine']):
-                # Perform recognition
-                found = classify_NN(transformed_data_test[mods1],
-                                    transformed_data_ex[mods2],
-                                    self.labels_ex, metric)
+            # Perform recognition (for all metrics at once)
+            all_found = classify_NN_multi(transformed_data_test[mods1],
+                                          transformed_data_ex[mods2],
+                                          self.labels_ex, METRICS)
+            for found, suffix in zip(all_found, METRIC_SUFFIXES):
                 # Conpute score
                 self.logger.store_result(
                     self._get_score_key(mods1, mods2, suffix),
@@ -359,14 +581,15 @@ class ThreeModalitiesExperiment(MultimodalExperiment):
         return [(tuple(x), tuple(y)) for (x, y) in combinations]
 
     def _get_all_internals(self, learner, data_set):
-        internals = {}
+        tested = []
         for mods, rest in self._tested_combinations():
-            if mods not in internals:
-                internals[mods] = learner.reconstruct_internal_multi(
-                    [self.modalities[m] for m in mods],
-                    [data_set[m] for m in mods],
-                    self.iter_test)
-        return internals
+            if mods not in tested:
+                tested.append(mods)
+        internals = learner.reconstruct_internal_batch(
+            [[self.modalities[m] for m in mods] for mods in tested],
+            dict(zip(self.modalities, data_set)),
+            self.iter_test)
+        return dict(zip(tested, internals))
 
     def _get_score_key(self, mods1, mods2, metric):
         return "score_{}2{}{}".format(
@@ -4,66 +4,350 @@
 """Class to abstract learning from multiple modalities."""
 
 
-from .lib.nmf import KLdivNMF as NMF
-from .lib.array_utils import safe_hstack
+import os
+import json
 
+import numpy as np
+import scipy.sparse as sp
 
-def fit_coefficients(data_obs, dictionary, iter_nmf=100, verbose=False):
-    nmf_obs = NMF(n_components=dictionary.shape[0], max_iter=iter_nmf, tol=0)
+from .lib.nmf import KLdivNMF as NMF, check_non_negative
+from .lib.array_utils import safe_hstack, gen_batches
+from .lib.sklearn_utils import atleast2d_or_csr
+
+
+# Version of the format used by MultimodalLearner.save
+MODEL_FORMAT_VERSION = 1
+MODEL_PARAMS_FILE = 'learner.json'
+MODEL_DICTIONARY_FILE = 'dictionary.npy'
+
+
+def fit_coefficients(data_obs, dictionary, iter_nmf=100, verbose=False,
+                     n_threads=1, dtype=np.float64, weights=1.):
+    nmf_obs = NMF(n_components=dictionary.shape[0], max_iter=iter_nmf, tol=0,
+                  n_threads=n_threads, dtype=dtype)
     nmf_obs.components_ = dictionary
-    coefficients = nmf_obs.transform(data_obs, scale_W=True)
+    coefficients = nmf_obs.transform(data_obs, scale_W=True, weights=weights)
     return coefficients
 
 
+class CoefficientsTransformer(object):
+    """Computes internal coefficients of data from a fixed set of modalities.
+
+    The stacked dictionary, the sums of its rows and the coefficients used
+    to compensate between modalities are computed once, so that the
+    transformer can be reused on several data sets. Each sample stops being
+    updated as soon as the relative change of its coefficients falls under
+    tol. Coefficients may be initialized from previous values (warm start),
+    for example from the result on a similar sample.
+
+    If weights (on features) are given, data is not scaled by the
+    coefficients and the weights are used on the cost instead.
+
+    The sums of the rows of the dictionary normalize the updates of the
+    coefficients, since the dictionary of a subset of the modalities does
+    not have normalized rows. They may be given if already known (e.g.
+    cached by the learner), else they are computed from the dictionary.
+    """
+
+    def __init__(self, dictionary, coefficients, iterations, tol=1.e-4,
+                 n_threads=1, dtype=np.float64, weights=None, row_sums=None):
+        self.coefs = coefficients
+        self.weights = weights
+        self.nmf = NMF(n_components=dictionary.shape[0], max_iter=iterations,
+                       tol=tol, n_threads=n_threads, dtype=dtype)
+        self.nmf.components_ = np.ascontiguousarray(dictionary, dtype=dtype)
+        if row_sums is None:
+            row_sums = np.sum(self.dictionary, axis=1, dtype=np.float64)
+        self.row_sums = row_sums
+
+    @property
+    def dictionary(self):
+        return self.nmf.components_
+
+    def transform(self, data_matrices, init=None):
+        """Returns the coefficients for data (one matrix for each modality).
+
+        init: array, [n_samples, k] (optional)
+            Initial coefficients, default to data.dictionary^T.
+        """
+        if self.weights is None:
+            X = safe_hstack([c * m for m, c in zip(data_matrices, self.coefs)])
+            weights = 1.
+        else:
+            X, weights = safe_hstack(data_matrices), self.weights
+        X = atleast2d_or_csr(X, dtype=self.nmf.dtype)
+        check_non_negative(X, "CoefficientsTransformer.transform")
+        if init is None:
+            init = X.dot(self.dictionary.T)
+        return self.nmf._transform_rows(X, init, weights=weights,
+                                        H_sums=self.row_sums)
+
+
+def _row_sliceable(X):
+    return X.tocsr() if sp.issparse(X) else X
+
+
 class MultimodalLearner(object):
+    """Learns a dictionary from stacked data of several modalities.
+
+    Coefficients compensate between modalities: by default the data of each
+    modality is scaled by its coefficient before being stacked. If weighted
+    is True, data is stacked as is and the coefficients are used as weights
+    on the features in the cost instead, which avoids building scaled copies
+    of the data (the dictionary is then learnt in the scale of the data).
+
+    init is the initialization of the factorization used by train (see
+    KLdivNMF), e.g. 'nndsvd' which usually needs fewer iterations than the
+    default random initialization.
+
+    Sub-dictionaries for sets of modalities are cached as read-only arrays,
+    until the dictionary is replaced (modifying it in place is not
+    detected). Modalities that are adjacent in the dictionary, in particular
+    a single modality, give a view of the dictionary, so that the pages of
+    a memory-mapped dictionary (see load) are shared; other sets of
+    modalities are stacked in a contiguous copy.
+    """
 
     def __init__(self, modalities, dimensions, coefficients, k,
-                 sparseness=None, sp_coef=.1):
+                 sparseness=None, sp_coef=.1, n_threads=1,
+                 dtype=np.float64, weighted=False, init='random'):
         self.mod = modalities  # Names of the modalities
         self.dim = dimensions  # Dimensions of modalities
         self.coef = coefficients  # Coefficients used to compensate
                                   # between modalities
+        self.weighted = weighted  # Use coefficients as weights on the cost
         self.k = k
         self.sparseness = sparseness  # data, components, None
         self.sp_coef = sp_coef
+        self.n_threads = n_threads  # Used for NMF on sparse data
+        self.dtype = dtype  # Floating point type used in NMF computations
+        self.init = init  # Initialization of NMF for training
         self.dico = None  # None means not trained yet
 
-    def train(self, data_matrices, iterations):
+    def train(self, data_matrices, iterations, batch_size=None, n_restarts=1,
+              n_jobs=1, init_dictionary=None, init=None):
+        """Learns the dictionary from data matrices (one for each modality).
+
+        init overrides the initialization method of the learner for this
+        training. If init_dictionary is given, the factorization starts from it
+        (e.g. from a dictionary learnt on similar data) instead of being
+        initialized from the data.
+
+        If batch_size is given, the dictionary is learnt in mini-batch mode
+        and modalities are only stacked for one block of samples at a time,
+        iterations being then the number of passes over the data.
+
+        Otherwise, n_restarts factorizations are computed (by n_jobs
+        processes) and the one with lowest error is kept.
+        """
         n_samples = data_matrices[0].shape[0]
         for m, d in zip(data_matrices, self.dim):
             assert(m.shape == (n_samples, d))
-        Vtrain = self.stack_data(self.mod, data_matrices)
         # Perform the experiment
         if self.sparseness is not None:
             raise NotImplemented
-        self.nmf_train = NMF(n_components=self.k, max_iter=iterations, tol=0)
-        self.nmf_train.fit(Vtrain, scale_W=True)
+        if batch_size is not None and n_restarts > 1:
+            raise ValueError("Restarts are not available in mini-batch mode.")
+        self.nmf_train = NMF(n_components=self.k, max_iter=iterations, tol=0,
+                             init=self.init if init is None else init,
+                             n_threads=self.n_threads, n_restarts=n_restarts,
+                             n_jobs=n_jobs, dtype=self.dtype)
+        self.nmf_train._init_dictionary = init_dictionary
+        if batch_size is None:
+            Vtrain = self.prepare_data(self.mod, data_matrices)
+            self.nmf_train.fit(Vtrain, scale_W=True,
+                               weights=self.get_data_weights(self.mod))
+        else:
+            self._partial_fit(data_matrices, iterations, batch_size)
         self.dico = self.nmf_train.components_
 
+    def _partial_fit(self, data_matrices, passes, batch_size=None,
+                     forget_factor=1.):
+        n_samples = data_matrices[0].shape[0]
+        if batch_size is None:
+            batch_size = n_samples
+        weights = self.get_data_weights(self.mod)
+        data_matrices = [_row_sliceable(m) for m in data_matrices]
+        for _ in range(passes):
+            for batch in gen_batches(n_samples, batch_size):
+                self.nmf_train.partial_fit(
+                    self.prepare_data(self.mod,
+                                      [m[batch] for m in data_matrices]),
+                    scale_W=True, weights=weights,
+                    forget_factor=forget_factor)
+
+    def update(self, data_matrices, iterations, forget_factor=1.,
+               batch_size=None):
+        """Updates the dictionary from new data matrices (one for each
+        modality), starting from the current dictionary.
+
+        Updates are performed in mini-batch mode (see train): iterations
+        passes are made over the new data, by blocks of batch_size samples
+        (default to all samples). Statistics from previous updates, or from
+        training in mini-batch mode, are kept so that the dictionary
+        accounts for all data seen so far; they are multiplied by
+        forget_factor for each block, which gives more importance to recent
+        samples. If there are no such statistics (e.g. the learner was
+        trained in batch mode or loaded), they are computed from the new
+        data only.
+        """
+        if self.dico is None:
+            raise ValueError("Learner has not been trained.")
+        n_samples = data_matrices[0].shape[0]
+        for m, d in zip(data_matrices, self.dim):
+            assert(m.shape == (n_samples, d))
+        nmf = getattr(self, 'nmf_train', None)
+        if (nmf is None or nmf._H_stats is None
+                or nmf.components_ is not self.dico):
+            self.nmf_train = NMF(n_components=self.k, max_iter=iterations,
+                                 tol=0, n_threads=self.n_threads,
+                                 dtype=self.dtype)
+            self.nmf_train._init_dictionary = self.dico
+        self._partial_fit(data_matrices, iterations, batch_size=batch_size,
+                          forget_factor=forget_factor)
+        self.dico = self.nmf_train.components_
+
+    @property
+    def dico(self):
+        return self._dico
+
+    @dico.setter
+    def dico(self, dico):
+        self._dico = dico
+        # Cached (stacked dictionary, sums of its rows) for modalities
+        self._dico_views = {}
+
+    def _get_dico_view(self, modalities):
+        key = tuple(modalities)
+        if key not in self._dico_views:
+            ranges = [self.get_axis_range(m) for m in modalities]
+            if all(r[0] == prev[1] for prev, r in zip(ranges, ranges[1:])):
+                # Single range of columns: no copy
+                stacked = self.dico[:, ranges[0][0]:ranges[-1][1]]
+            else:
+                stacked = np.ascontiguousarray(safe_hstack(
+                    [self.dico[:, slice(*r)] for r in ranges]))
+            stacked.flags.writeable = False
+            self._dico_views[key] = (stacked, stacked.sum(axis=1))
+        return self._dico_views[key]
+
+    def save(self, path):
+        """Stores the trained learner in the directory at path.
+
+        Parameters are stored as json and the dictionary as an uncompressed
+        .npy file, so that it may be memory-mapped by load.
+        """
+        if self.dico is None:
+            raise ValueError("Learner has not been trained.")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, MODEL_DICTIONARY_FILE),
+                np.asarray(self.dico))
+        params = {'version': MODEL_FORMAT_VERSION,
+                  'modalities': list(self.mod),
+                  'dimensions': [int(d) for d in self.dim],
+                  'coefficients': [float(c) for c in self.coef],
+                  'k': int(self.k),
+                  'sparseness': self.sparseness,
+                  'sp_coef': self.sp_coef,
+                  'dtype': np.dtype(self.dtype).name,
+                  'weighted': self.weighted,
+                  'init': self.init,
+                  }
+        with open(os.path.join(path, MODEL_PARAMS_FILE), 'w') as f:
+            json.dump(params, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', n_threads=1):
+        """Loads a learner stored by save.
+
+        By default the dictionary is memory-mapped read-only, so that
+        processes loading the same learner share it (use mmap_mode=None to
+        load it in memory).
+        """
+        with open(os.path.join(path, MODEL_PARAMS_FILE), 'r') as f:
+            params = json.load(f)
+        if params.get('version') != MODEL_FORMAT_VERSION:
+            raise ValueError("Unsupported learner format version: %s."
+                             % params.get('version'))
+        learner = cls(params['modalities'], params['dimensions'],
+                      params['coefficients'], params['k'],
+                      sparseness=params['sparseness'],
+                      sp_coef=params['sp_coef'], n_threads=n_threads,
+                      dtype=np.dtype(params['dtype']).type,
+                      weighted=params['weighted'],
+                      init=params.get('init', 'random'))
+        learner.dico = np.load(os.path.join(path, MODEL_DICTIONARY_FILE),
+                               mmap_mode=mmap_mode)
+        return learner
+
     def get_dico(self, modality=None):
         if modality is None:
             return self.dico
         else:
-            start, stop = self.get_axis_range(modality)
-            return self.dico[:, start:stop]
+            return self._get_dico_view([modality])[0]
 
     def get_stacked_dicos(self, modalities):
-        return safe_hstack([self.get_dico(modality=m) for m in modalities])
+        return self._get_dico_view(modalities)[0]
+
+    def get_dico_row_sums(self, modalities):
+        """Returns the sums of the rows of the dictionary restricted to
+        modalities, shape = [k].
+        """
+        return self._get_dico_view(modalities)[1]
 
     def stack_data(self, modalities, data_matrices):
         coefs = [self.coef[self.get_index(mod)] for mod in modalities]
         return safe_hstack([c * m
                             for m, c in zip(data_matrices, coefs)])
 
+    def get_weights(self, modalities):
+        """Returns the coefficients of modalities as weights on the features
+        of stacked data, shape = [1, n_features].
+        """
+        return np.hstack([self.coef[self.get_index(mod)]
+                          * np.ones((1, self.dim[self.get_index(mod)]))
+                          for mod in modalities])
+
+    def prepare_data(self, modalities, data_matrices):
+        """Stacks data, scaled by coefficients unless the learner is weighted.
+        """
+        if self.weighted:
+            return safe_hstack(data_matrices)
+        else:
+            return self.stack_data(modalities, data_matrices)
+
+    def get_data_weights(self, modalities):
+        """Weights on the cost for data from prepare_data."""
+        return self.get_weights(modalities) if self.weighted else 1.
+
+    def _get_offsets(self):
+        dims = tuple(self.dim)
+        if getattr(self, '_offsets_dims', None) != dims:
+            self._offsets = [0]
+            for d in dims:
+                self._offsets.append(self._offsets[-1] + d)
+            self._offsets_dims = dims
+        return self._offsets
+
     def get_axis_range(self, modality):
         idx = self.get_index(modality)
-        start = sum(self.dim[:idx])
-        stop = start + self.dim[idx]
-        return (start, stop)
+        offsets = self._get_offsets()
+        return (offsets[idx], offsets[idx + 1])
 
     def get_index(self, modality):
         return self.mod.index(modality)
 
+    def get_transformer(self, modalities, iterations, tol=1.e-4):
+        """Returns a CoefficientsTransformer for data from given modalities.
+        """
+        return CoefficientsTransformer(
+            self.get_stacked_dicos(modalities),
+            [self.coef[self.get_index(mod)] for mod in modalities],
+            iterations, tol=tol, n_threads=self.n_threads, dtype=self.dtype,
+            weights=self.get_weights(modalities) if self.weighted else None,
+            row_sums=self.get_dico_row_sums(modalities))
+
     def reconstruct_internal(self, orig_mod, test_data, iterations):
         return self.reconstruct_internal_multi([orig_mod], [test_data],
                                                iterations)
@@ -72,11 +356,45 @@ class MultimodalLearner(object):
         for mod, data in zip(orig_mods, test_data):
             assert(data.shape[1] == self.dim[self.get_index(mod)])
         stacked_dico = self.get_stacked_dicos(orig_mods)
-        stacked_data = self.stack_data(orig_mods, test_data)
+        stacked_data = self.prepare_data(orig_mods, test_data)
         internal = fit_coefficients(stacked_data, stacked_dico,
-                                    iter_nmf=iterations)
+                                    iter_nmf=iterations,
+                                    n_threads=self.n_threads,
+                                    dtype=self.dtype,
+                                    weights=self.get_data_weights(orig_mods))
         return internal
 
+    def reconstruct_internal_batch(self, orig_mods_list, test_data,
+                                   iterations):
+        """Computes internal coefficients of test data for several sets of
+        input modalities.
+
+        Data of each modality is prepared once and shared between the sets;
+        coefficients for each set are computed on the features of its own
+        modalities only (padding all sets to the features of all modalities
+        makes the products on unused features dominate the cost). Results
+        are the same as from reconstruct_internal_multi for each set.
+
+        orig_mods_list: list of lists of modalities
+        test_data: dict {modality: data matrix}, with the same samples for
+            all modalities
+        Returns the list of internal coefficients for each set.
+        """
+        used = [m for m in self.mod
+                if any(m in mods for mods in orig_mods_list)]
+        n_samples = test_data[used[0]].shape[0]
+        for mod in used:
+            assert(test_data[mod].shape ==
+                   (n_samples, self.dim[self.get_index(mod)]))
+        prepared = {mod: self.prepare_data([mod], [test_data[mod]])
+                    for mod in used}
+        return [fit_coefficients(safe_hstack([prepared[m] for m in mods]),
+                                 self.get_stacked_dicos(mods),
+                                 iter_nmf=iterations,
+                                 n_threads=self.n_threads, dtype=self.dtype,
+                                 weights=self.get_data_weights(mods))
+                for mods in orig_mods_list]
+
     def reconstruct_modality(self, dest_mod, internal):
         return internal.dot(self.get_dico(dest_mod))
 
@@ -92,3 +410,25 @@ class MultimodalLearner(object):
         internal = self.reconstruct_internal_multi(orig_mods, test_data,
                                                    iterations)
         return self.reconstruct_modalities(dest_mods, internal)
+
+    def modalities_to_modalities_batch(self, combinations, test_data,
+                                       iterations):
+        """Reconstructs data for several combinations of input and output
+        modalities.
+
+        Internal coefficients are computed once for each set of input
+        modalities (see reconstruct_internal_batch).
+
+        combinations: list of pairs (input modalities, output modalities)
+        test_data: dict {modality: data matrix}
+        Returns the list of reconstructions for each combination.
+        """
+        orig_mods_list = []
+        for orig_mods, _ in combinations:
+            if list(orig_mods) not in orig_mods_list:
+                orig_mods_list.append(list(orig_mods))
+        internals = self.reconstruct_internal_batch(orig_mods_list,
+                                                    test_data, iterations)
+        return [self.reconstruct_modalities(
+                    dest_mods, internals[orig_mods_list.index(list(orig))])
+                for orig, dest_mods in combinations]
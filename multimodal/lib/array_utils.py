@@ -16,6 +16,34 @@ def safe_vstack(Xs):
         return np.vstack(Xs)
 
 
+def row_sums(X):
+    """Sums of rows of dense or sparse X, as 1D array."""
+    return np.asarray(X.sum(axis=1)).ravel()
+
+
+def dense_dot_T(A, B):
+    """A.B^T as dense array, for dense or sparse A and B."""
+    if sp.issparse(A):
+        P = A.dot(B.T)
+    elif sp.issparse(B):
+        P = B.dot(A.T).T
+    else:
+        return A.dot(B.T)
+    return P.toarray() if sp.issparse(P) else np.asarray(P)
+
+
+def gen_batches(n, batch_size):
+    """Generates slices of at most batch_size elements covering range(n).
+    """
+    start = 0
+    for _ in range(int(n // batch_size)):
+        end = start + batch_size
+        yield slice(start, end)
+        start = end
+    if start < n:
+        yield slice(start, n)
+
+
 def normalize_sum(a, axis=0, eps=1.e-16):
     if axis >= len(a.shape):
         raise ValueError
@@ -5,7 +5,10 @@
 """
 
 
+import os
 import json
+import pickle
+
 import numpy as np
 
 
@@ -104,6 +107,79 @@ class Logger(object):
         assert(self.exp_keys == other.exp_keys)
         self.exps.extend(other.exps)
 
+    def append_runs_from_other(self, other):
+        """Appends experiments from other logger, whose keys may differ.
+        """
+        self.exps.extend(other.exps)
+        self.exp_keys.update(other.exp_keys)
+        self.result_keys.update(other.result_keys)
+
+    # Checkpoints: global logs and experiments appended one at a time
+
+    @property
+    def checkpoint_filename(self):
+        if self.filename is None:
+            raise self.NoFileError('No file set for this logger.')
+        return self.filename + '.checkpoint'
+
+    def start_checkpoint(self):
+        """Writes a new checkpoint file (replacing any previous one) holding
+        global logs.
+        """
+        tmp = self.checkpoint_filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'glob': self.glob}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.checkpoint_filename)
+
+    def checkpoint_run(self, index=-1, state=None):
+        """Appends an experiment (the last one by default) to the checkpoint
+        file, together with an optional state.
+
+        The record is written at once and flushed to disk, so that an
+        interruption at most leaves an incomplete last record, which is
+        ignored by load_checkpoint.
+        """
+        exp = self.exps[index]
+        record = pickle.dumps(
+            {'exp': exp,
+             'result_keys': [k for k in exp if k in self.result_keys],
+             'state': state},
+            pickle.HIGHEST_PROTOCOL)
+        with open(self.checkpoint_filename, 'ab') as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove_checkpoint(self):
+        os.remove(self.checkpoint_filename)
+
+    @classmethod
+    def load_checkpoint(cls, filename):
+        """Returns the logger stored in the checkpoint file for filename and
+        the list of states stored with its experiments.
+
+        An incomplete last record (from an interrupted write) is removed
+        from the file.
+        """
+        logger = Logger(filename)
+        states = []
+        with open(logger.checkpoint_filename, 'rb+') as f:
+            logger.glob = pickle.load(f)['glob']
+            end = f.tell()
+            while True:
+                try:
+                    record = pickle.load(f)
+                except (EOFError, ValueError, pickle.UnpicklingError):
+                    break
+                end = f.tell()
+                logger.new_run()
+                logger.exps[-1] = record['exp']
+                logger.exp_keys.update(record['exp'])
+                logger.result_keys.update(record['result_keys'])
+                states.append(record['state'])
+            f.truncate(end)
+        return logger, states
+
     @classmethod
     def merge_experiments(cls, loggers):
         if len(loggers) == 0:
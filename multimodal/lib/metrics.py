@@ -11,6 +11,8 @@ __date__ = '01/2013'
 import numpy as np
 import scipy.sparse as sp
 
+from .array_utils import row_sums, dense_dot_T
+
 
 EPSILON = 1.e-8
 
@@ -70,6 +72,68 @@ def sym_kl_div(*args, **kwargs):
     return .5 * (kl_div(*args, **kwargs) + rev_kl_div(*args, **kwargs))
 
 
+class KLTerms(object):
+    """Terms of the generalized KL divergence that only depend on one set of
+    vectors (rows of X), to be reused across calls to pairwise_kl and
+    related functions.
+
+    For sparse X, log(X + eps) is stored as log(eps) + L where L is sparse.
+    """
+
+    def __init__(self, X, eps=EPSILON):
+        self.X = X.tocsr() if sp.issparse(X) else np.asarray(X)
+        self.eps = eps
+        self.sums = row_sums(self.X)
+        if sp.issparse(self.X):
+            x_log_x = self.X.copy()
+            x_log_x.data = x_log_x.data * np.log(x_log_x.data + eps)
+            self.x_log_x = row_sums(x_log_x)
+        else:
+            self.x_log_x = (self.X * np.log(self.X + eps)).sum(axis=1)
+        self._log = None
+
+    @property
+    def log(self):
+        """(offset, L) such that log(X + eps) = offset + L."""
+        if self._log is None:
+            if sp.issparse(self.X):
+                L = self.X.copy()
+                L.data = np.log(L.data + self.eps) - np.log(self.eps)
+                self._log = (np.log(self.eps), L)
+            else:
+                self._log = (0., np.log(self.X + self.eps))
+        return self._log
+
+
+def _kl_terms(X, eps):
+    return X if isinstance(X, KLTerms) else KLTerms(X, eps=eps)
+
+
+def pairwise_kl(A, B, eps=EPSILON):
+    """Matrix of generalized KL divergences between rows of A and rows of B:
+    result[i, j] = generalized_KL(A[i, :], B[j, :]).
+
+    It is computed as sum(a log a) - a.log(b)^T - sum(a) + sum(b), which
+    only involves a matrix product with log(B + eps). A and B may be
+    sparse, or KLTerms instances holding precomputed terms.
+    """
+    a, b = _kl_terms(A, eps), _kl_terms(B, eps)
+    log_offset, log_b = b.log
+    a_log_b = dense_dot_T(a.X, log_b) + log_offset * a.sums[:, np.newaxis]
+    return (a.x_log_x[:, np.newaxis] - a_log_b
+            - a.sums[:, np.newaxis] + b.sums[np.newaxis, :])
+
+
+def pairwise_rev_kl(A, B, eps=EPSILON):
+    """result[i, j] = generalized_KL(B[j, :], A[i, :])"""
+    return pairwise_kl(B, A, eps=eps).T
+
+
+def pairwise_sym_kl(A, B, eps=EPSILON):
+    a, b = _kl_terms(A, eps), _kl_terms(B, eps)
+    return .5 * (pairwise_kl(a, b) + pairwise_rev_kl(a, b))
+
+
 def frobenius(a, b, axis=-1):
     return np.sqrt(np.square(a - b).sum(axis=axis))
 
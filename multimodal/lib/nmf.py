@@ -11,13 +11,24 @@
 
 
 import sys
+import copy
+import functools
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import scipy.sparse as sp
 
-from .metrics import generalized_KL
-from .array_utils import normalize_sum
-from .sklearn_utils import atleast2d_or_csr, safe_sparse_dot
+from .array_utils import normalize_sum, gen_batches
+from .shared_arrays import SharedMatrix
+from .out_of_core import is_out_of_core, default_block_rows
+from .utils import effective_n_jobs
+from .sklearn_utils import (atleast2d_or_csr, safe_sparse_dot,
+                            check_random_state, randomized_svd, norm)
+
+
+# Number of elements of temporary arrays in chunked sparse computations
+SPARSE_CHUNK_SIZE = 2 ** 20
 
 
 def check_non_negative(X, whom):
@@ -26,6 +37,39 @@ def check_non_negative(X, whom):
         raise ValueError("Negative values in data passed to %s" % whom)
 
 
+def _max_value(X):
+    data = X.data if sp.issparse(X) else X
+    return float(np.max(data)) if data.size > 0 else 0.
+
+
+def _row_max_values(X):
+    """Returns the largest value of each row of X, shape = [n_samples, 1].
+    """
+    if X.shape[1] == 0:
+        return np.zeros((X.shape[0], 1))
+    if sp.issparse(X):
+        return np.asarray(X.max(axis=1).todense(), dtype=np.float64)
+    return np.asarray(X.max(axis=1), dtype=np.float64).reshape((-1, 1))
+
+
+def _safe_eps(eps, dtype, scale=0.):
+    """Returns eps as a scalar of the given floating point type, raised to the
+    smallest normal number of that type if it would underflow, and to the
+    resolution of the type for values of magnitude scale (typically the
+    largest value of the data) so that adding it to such values has an
+    effect. In double precision, the latter only matters for data with
+    large values; in single precision, it matters for values over 0.1.
+
+    If scale is an array (e.g. the largest value of each row of the data,
+    see _row_max_values), an array of the same shape is returned.
+    """
+    info = np.finfo(np.dtype(dtype))
+    if np.ndim(scale) > 0:
+        return np.maximum(max(eps, info.tiny),
+                          info.eps * np.asarray(scale)).astype(dtype)
+    return np.dtype(dtype).type(max(eps, info.tiny, info.eps * scale))
+
+
 def _scale(matrix, factors, axis=0):
     """Scales line or columns of a matrix.
 
@@ -49,12 +93,76 @@ def _scale(matrix, factors, axis=0):
     return np.multiply(matrix, factors)
 
 
-def _special_sparse_dot(a, b, refmat):
+def _csr_row_block(X, start, stop):
+    """Returns rows start to stop of csr matrix X as a csr matrix sharing
+    data and indices with X.
+    """
+    p_start, p_stop = X.indptr[start], X.indptr[stop]
+    return sp.csr_matrix((X.data[p_start:p_stop], X.indices[p_start:p_stop],
+                          X.indptr[start:(stop + 1)] - p_start),
+                         shape=(stop - start, X.shape[1]))
+
+
+def _row_chunks(X, chunk_nnz):
+    """Splits rows of csr matrix X in contiguous ranges (start, stop) of
+    about chunk_nnz non-zero elements each (rows are never split).
+    """
+    bounds = np.searchsorted(X.indptr,
+                             np.arange(chunk_nnz, X.indptr[-1], chunk_nnz))
+    bounds = np.unique(np.hstack([[0], bounds, [X.shape[0]]]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _map_threads(f, chunks, n_threads=1, pool=None):
+    """Applies f to chunks, using a pool of n_threads threads if n_threads is
+    more than one. Numpy and scipy.sparse kernels release the GIL so chunks
+    are effectively processed in parallel.
+
+    The given pool (of n_threads threads) is used if any, otherwise a
+    temporary pool is created.
+    """
+    if n_threads == 1 or len(chunks) < 2:
+        return [f(c) for c in chunks]
+    if pool is not None:
+        return pool.map(f, chunks)
+    pool = ThreadPool(min(n_threads, len(chunks)))
+    try:
+        return pool.map(f, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _balanced_chunks(X, n_threads):
+    """Splits rows of csr matrix X in n_threads ranges with about the same
+    number of non-zero elements.
+    """
+    return _row_chunks(X, max(1, int(np.ceil(X.indptr[-1] /
+                                             float(n_threads)))))
+
+
+def _without_explicit_zeros(X):
+    """Returns sparse X without explicit zeros, copied only if it holds
+    some, so that X (that may be shared with other processes) is never
+    modified. Other inputs are returned as is.
+    """
+    if sp.issparse(X) and not np.all(X.data):
+        X = X.copy()
+        X.eliminate_zeros()
+    return X
+
+
+def _special_sparse_dot(a, b, refmat, n_threads=1,
+                        chunk_size=SPARSE_CHUNK_SIZE, pool=None):
     """Computes dot product of a and b on indices where refmat is nonnzero
     and returns sparse csr matrix with same structure than refmat.
 
-    First calls to eliminate_zeros on refmat which might modify the structure
-    of refmat.
+    refmat must not hold explicit zeros (see _without_explicit_zeros); it
+    is not modified.
+
+    The computation is performed by chunks of rows of refmat so that
+    temporary arrays have at most about chunk_size elements. Chunks are
+    processed by n_threads threads (from pool if given).
 
     Params
     ------
@@ -63,11 +171,308 @@ def _special_sparse_dot(a, b, refmat):
 
     Dot product of a and b must have refmat's shape.
     """
-    refmat.eliminate_zeros()
-    ii, jj = refmat.nonzero()
-    dot_vals = np.multiply(a[ii, :], b.T[jj, :]).sum(axis=1)
-    c = sp.coo_matrix((dot_vals, (ii, jj)), shape=refmat.shape)
-    return c.tocsr()
+    if not sp.isspmatrix_csr(refmat):
+        refmat = refmat.tocsr()
+    bT = np.ascontiguousarray(b.T)
+    dot_vals = np.empty(refmat.indices.shape, dtype=np.result_type(a, b))
+    indptr, indices = refmat.indptr, refmat.indices
+
+    def dot_chunk(rows):
+        start, stop = rows
+        p_start, p_stop = indptr[start], indptr[stop]
+        ii = np.repeat(np.arange(start, stop),
+                       np.diff(indptr[start:(stop + 1)]))
+        dot_vals[p_start:p_stop] = np.einsum(
+            'ij,ij->i', np.take(a, ii, axis=0),
+            np.take(bT, indices[p_start:p_stop], axis=0))
+
+    _map_threads(dot_chunk,
+                 _row_chunks(refmat, max(1, chunk_size // max(1, a.shape[1]))),
+                 n_threads=n_threads, pool=pool)
+    return sp.csr_matrix((dot_vals, indices.copy(), indptr.copy()),
+                         shape=refmat.shape)
+
+
+def _threaded_dot(Q, M, n_threads=1, pool=None):
+    """Computes Q.M, where Q may be a sparse matrix, in which case its rows
+    are split between n_threads threads.
+    """
+    if not sp.issparse(Q) or n_threads == 1:
+        return safe_sparse_dot(Q, M)
+    Q = Q.tocsr()
+    out = np.empty((Q.shape[0], M.shape[1]), dtype=np.result_type(Q, M))
+
+    def dot_chunk(rows):
+        start, stop = rows
+        out[start:stop, :] = _csr_row_block(Q, start, stop) * M
+
+    _map_threads(dot_chunk, _balanced_chunks(Q, n_threads),
+                 n_threads=n_threads, pool=pool)
+    return out
+
+
+def _threaded_tdot(M, Q, n_threads=1, pool=None):
+    """Computes M^T.Q, where Q may be a sparse matrix, in which case its rows
+    (and the ones of M) are split between n_threads threads.
+    """
+    if not sp.issparse(Q) or n_threads == 1:
+        return safe_sparse_dot(M.T, Q)
+    Q = Q.tocsr()
+    chunks = _balanced_chunks(Q, n_threads)
+    if len(chunks) < 2:
+        return safe_sparse_dot(M.T, Q)
+
+    def tdot_chunk(rows):
+        start, stop = rows
+        return _csr_row_block(Q, start, stop).T * M[start:stop, :]
+
+    partial_dots = _map_threads(tdot_chunk, chunks, n_threads=n_threads,
+                                pool=pool)
+    out = partial_dots[0]
+    for d in partial_dots[1:]:
+        out += d
+    return out.T
+
+
+class _Weights(object):
+    """Non-uniform weights on the cost, prepared for the data matrix X.
+
+    matrix: weights used for sums over all elements, either as a dense
+        array that broadcasts to the shape of X or, for sparse weights, as a
+        csr matrix with the structure of X (sparse weights are only
+        considered on non-zero elements of X).
+
+    pattern: if X is sparse, csr matrix with the structure of X holding the
+        weights of its non-zero elements (else None).
+
+    Sparse X must be a csr matrix without explicit zeros (see
+    _without_explicit_zeros).
+    """
+
+    def __init__(self, weights, X):
+        if sp.issparse(X):
+            rows, cols = X.nonzero()
+            if sp.issparse(weights):
+                values = np.asarray(weights.tocsr()[rows, cols]).ravel()
+            else:
+                weights = np.atleast_2d(np.asarray(weights, dtype=X.dtype))
+                values = np.broadcast_to(weights, X.shape)[rows, cols]
+            self.pattern = sp.csr_matrix(
+                (values.astype(X.dtype), X.indices, X.indptr), shape=X.shape)
+            self.matrix = self.pattern if sp.issparse(weights) else weights
+        else:
+            if sp.issparse(weights):
+                weights = weights.toarray()
+            self.pattern = None
+            self.matrix = np.atleast_2d(np.asarray(weights, dtype=X.dtype))
+
+    def rows(self, rows):
+        """Weights for X[rows, :]."""
+        w = copy.copy(self)
+        if self.pattern is not None:
+            w.pattern = self.pattern[rows, :]
+        if sp.issparse(self.matrix):
+            w.matrix = w.pattern
+        elif self.matrix.shape[0] > 1:
+            w.matrix = self.matrix[rows, :]
+        return w
+
+    def multiply(self, Q):
+        """Element-wise product of the weights with Q (see _Q)."""
+        if sp.issparse(Q):
+            wQ = Q.copy()
+            wQ.data = np.multiply(Q.data, self.pattern.data)
+            return wQ
+        else:
+            return np.multiply(Q, self.matrix)
+
+    def dot_HT(self, H, n_threads=1, pool=None):
+        """Computes weights.H^T (the shape of the result broadcasts to the
+        one of W).
+        """
+        if sp.issparse(self.matrix):
+            return _threaded_dot(self.matrix, H.T, n_threads=n_threads,
+                                 pool=pool)
+        elif self.matrix.shape[1] == 1:
+            return np.multiply(self.matrix, np.sum(H, axis=1)[np.newaxis, :])
+        else:
+            return np.dot(self.matrix, H.T)
+
+    def tdot(self, W, n_threads=1, pool=None):
+        """Computes W^T.weights (the shape of the result broadcasts to the
+        one of H).
+        """
+        if sp.issparse(self.matrix):
+            return _threaded_tdot(W, self.matrix, n_threads=n_threads,
+                                  pool=pool)
+        elif self.matrix.shape[0] == 1:
+            return np.multiply(np.sum(W, axis=0)[:, np.newaxis], self.matrix)
+        else:
+            return np.dot(W.T, self.matrix)
+
+
+def _is_uniform(weights):
+    return not sp.issparse(weights) and np.ndim(weights) == 0
+
+
+def _check_weights(weights, X):
+    """Returns weights prepared for X (see _Weights) or None for uniform
+    weights (scalars).
+    """
+    if weights is None or isinstance(weights, _Weights):
+        return weights
+    if _is_uniform(weights):
+        return None
+    check_non_negative(weights, "NMF (weights)")
+    return _Weights(weights, X)
+
+
+def _initialize_nmf(X, n_components, init=None, eps=1e-6,
+                    random_state=None):
+    """Computes initial factors (W, H) for the decomposition of X.
+
+    Parameters
+    ----------
+
+    X: {array-like, sparse matrix}, shape = [n_samples, n_features]
+        Data matrix to be decomposed
+
+    init: None | 'nndsvd' |  'nndsvda' | 'nndsvdar' | 'random'
+        See KLdivNMF. Default (None) is 'nndsvdar' if
+        n_components < n_features and n_components <= n_samples,
+        otherwise 'random'.
+
+    eps: float
+        Truncate all values less then this in output to zero.
+
+    random_state: int or RandomState
+        Random number generator seed control, used for the randomized SVD
+        in NNDSVD and for random values.
+
+    Returns
+    -------
+    W: array, [n_samples, n_components]
+
+    H: array, [n_components, n_features]
+        Rows of H sum to one.
+
+    Notes
+    -----
+    NNDSVD is computed from a randomized truncated SVD that also accepts
+    sparse input, see
+
+    C. Boutsidis, E. Gallopoulos: SVD based initialization: A head start for
+    nonnegative matrix factorization - Pattern Recognition, 2008
+    """
+    n_samples, n_features = X.shape
+    random_state = check_random_state(random_state)
+    if init is None:
+        if n_components < n_features and n_components <= n_samples:
+            init = 'nndsvdar'
+        else:
+            init = 'random'
+
+    if init == 'random':
+        H = normalize_sum(np.abs(random_state.random_sample(
+            (n_components, n_features))) + .01, axis=1)
+        return X.dot(H.T), H
+    elif init not in ('nndsvd', 'nndsvda', 'nndsvdar'):
+        raise ValueError('Invalid init parameter: got %r instead of one of %r'
+                         % (init, (None, 'random', 'nndsvd', 'nndsvda',
+                                   'nndsvdar')))
+    if n_components > min(n_samples, n_features):
+        raise ValueError("NNDSVD requires n_components <= %d, got %d."
+                         % (min(n_samples, n_features), n_components))
+
+    U, S, V = randomized_svd(X, n_components, random_state=random_state)
+    W, H = np.zeros(U.shape), np.zeros(V.shape)
+
+    # The leading singular triplet is non-negative
+    # so it can be used as is for initialization.
+    W[:, 0] = np.sqrt(S[0]) * np.abs(U[:, 0])
+    H[0, :] = np.sqrt(S[0]) * np.abs(V[0, :])
+
+    for j in range(1, n_components):
+        x, y = U[:, j], V[j, :]
+
+        # extract positive and negative parts of column vectors
+        x_p, y_p = np.maximum(x, 0), np.maximum(y, 0)
+        x_n, y_n = np.abs(np.minimum(x, 0)), np.abs(np.minimum(y, 0))
+
+        # and their norms
+        x_p_nrm, y_p_nrm = norm(x_p), norm(y_p)
+        x_n_nrm, y_n_nrm = norm(x_n), norm(y_n)
+
+        m_p, m_n = x_p_nrm * y_p_nrm, x_n_nrm * y_n_nrm
+
+        # choose update
+        if m_p > m_n:
+            u = x_p / x_p_nrm
+            v = y_p / y_p_nrm
+            sigma = m_p
+        else:
+            u = x_n / x_n_nrm
+            v = y_n / y_n_nrm
+            sigma = m_n
+
+        lbd = np.sqrt(S[j] * sigma)
+        W[:, j] = lbd * u
+        H[j, :] = lbd * v
+
+    W[W < eps] = 0
+    H[H < eps] = 0
+
+    if init == 'nndsvda':
+        avg = X.mean()
+        W[W == 0] = avg
+        H[H == 0] = avg
+    elif init == 'nndsvdar':
+        avg = X.mean()
+        W[W == 0] = abs(avg * random_state.randn(len(W[W == 0])) / 100)
+        H[H == 0] = abs(avg * random_state.randn(len(H[H == 0])) / 100)
+
+    # Components are normalized, W is scaled accordingly
+    sums = H.sum(axis=1)
+    return _scale(W, sums, axis=0), normalize_sum(H, axis=1)
+
+
+def _using_thread_pool(method):
+    """Decorates a method of KLdivNMF so that a pool of n_threads threads is
+    created once for all the updates it performs (as self._pool); nested
+    calls reuse the pool of the outer call.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.n_threads == 1 or self._pool is not None:
+            return method(self, *args, **kwargs)
+        self._pool = ThreadPool(self.n_threads)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+    return wrapper
+
+
+def _fit_one_restart(model, X, seed, params):
+    model = copy.copy(model)
+    model.n_restarts = 1
+    model.random_state = seed
+    W = model.fit_transform(X, **params)
+    if params.get('return_errors', False):
+        W, errors = W
+    else:
+        errors = None
+    # Restarts are compared on the (weighted) cost that is minimized
+    error = model.error(X, W, weights=params.get('weights', 1.),
+                        eps=model.eps)
+    return W, model.components_, error, errors
+
+
+def _restart_worker(args):
+    model, shared_X, seed, params = args
+    return _fit_one_restart(model, shared_X.get(), seed, params)
 
 
 class KLdivNMF(object):
@@ -79,9 +484,12 @@ class KLdivNMF(object):
         Number of components, if n_components is not set all components
         are kept
 
-    init:  'nndsvd' |  'nndsvda' | 'nndsvdar' | 'random'
+    init:  'random' | 'nndsvd' |  'nndsvda' | 'nndsvdar' | None
         Method used to initialize the procedure.
-        Default: 'nndsvdar' if n_components < n_features, otherwise random.
+        Default: 'random', as in previous versions (NNDSVD variants must be
+        requested explicitly). None selects 'nndsvdar' if n_components <
+        n_features (and n_components does not exceed n_samples), otherwise
+        'random'. Ignored when an initial dictionary is set.
         Valid options::
 
             'nndsvd': Nonnegative Double Singular Value Decomposition (NNDSVD)
@@ -99,9 +507,34 @@ class KLdivNMF(object):
     max_iter: int, default: 200
         Number of iterations to compute.
 
+    check_every: int, default: 1
+        Number of iterations between two evaluations of the stopping
+        condition. The reconstruction error is computed from the quotient
+        used in the updates so checks do not require an additional
+        reconstruction of the data.
+
     subit: int, default: 10
         Number of sub-iterations to perform on W (resp. H) before switching
-        to H (resp. W) update.
+        to H (resp. W) update. In mini-batch mode (see partial_fit), number
+        of updates of the coefficients of each batch before updating the
+        components.
+
+    n_threads: int, default: 1
+        Number of threads used for updates on sparse data.
+
+    n_restarts: int, default: 1
+        Number of factorizations computed from different initializations
+        when fitting the model. The one with lowest error is kept.
+
+    n_jobs: int, default: 1
+        Number of processes used to compute restarts in parallel (-1 means
+        all available processors). Data is shared between processes through
+        shared memory.
+
+    dtype: numpy floating point type, default: np.float64
+        Type used for data, coefficients and components during computations.
+        Using np.float32 halves memory usage. Errors are always accumulated
+        in double precision.
 
     Attributes
     ----------
@@ -119,8 +552,9 @@ class KLdivNMF(object):
     >>> from multimodal.lib.nmf import KLdivNMF
     >>> model = KLdivNMF(n_components=2, init='random', random_state=0)
     >>> model.fit(X) #doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
-    KLdivNMF(eps=1e-08, init='random', max_iter=200, n_components=2,
-            random_state=0, subit=10, tol=1e-06)
+    KLdivNMF(check_every=1, dtype=<type 'numpy.float64'>, eps=1e-08,
+            init='random', max_iter=200, n_components=2, n_jobs=1,
+            n_restarts=1, n_threads=1, random_state=0, subit=10, tol=1e-06)
     >>> model.components_
     array([[ 0.50303234,  0.49696766],
            [ 0.93326505,  0.06673495]])
@@ -133,31 +567,48 @@ class KLdivNMF(object):
       matrix factorization. Nature, 1999
     """
 
-    def __init__(self, n_components=None, tol=1e-6, max_iter=200, eps=1.e-8,
-                 subit=10, random_state=None):
+    def __init__(self, n_components=None, init='random', tol=1e-6,
+                 max_iter=200, eps=1.e-8, subit=10, random_state=None,
+                 check_every=1, n_threads=1, n_restarts=1, n_jobs=1,
+                 dtype=np.float64):
         self.n_components = n_components
+        self.init = init
         self._init_dictionary = None
         self.random_state = random_state
         self.tol = tol
         self.max_iter = max_iter
+        self.check_every = check_every
         self.eps = eps
         # Only for gradient updates
         self.subit = subit
+        self.n_threads = n_threads
+        self.n_restarts = n_restarts
+        self.n_jobs = n_jobs
+        self.dtype = dtype
+        # Sufficient statistics for mini-batch updates of components
+        self._H_stats = None
+        # Threads used for updates on sparse data (see _using_thread_pool)
+        self._pool = None
 
     def _init(self, X):
         n_samples, n_features = X.shape
         if self._init_dictionary is None:
-            H_init = normalize_sum(np.abs(np.random.random(
-                (self.n_components, n_features))) + .01, axis=1)
+            W_init, H_init = _initialize_nmf(
+                X, self.n_components, init=self.init,
+                random_state=self.random_state)
+            return (W_init.astype(self.dtype, copy=False),
+                    H_init.astype(self.dtype, copy=False))
         else:
             assert(self._init_dictionary.shape ==
                    (self.n_components, n_features))
             H_init = self._init_dictionary
+        H_init = np.asarray(H_init).astype(self.dtype, copy=False)
         W_init = X.dot(H_init.T)
         return W_init, H_init
 
+    @_using_thread_pool
     def fit_transform(self, X, y=None, weights=1., _fit=True,
-                      return_errors=False, scale_W=False):
+                      return_errors=False, scale_W=False, block_size=None):
         """Learn a NMF model for the data X and returns the transformed data.
 
         This is more efficient than calling fit followed by transform.
@@ -171,7 +622,9 @@ class KLdivNMF(object):
         weights: {array-like, sparse matrix}, shape = [n_samples, n_features]
             Weights on the cost function used as coefficients on each
             element of the data. If smaller dimension is provided, standard
-            numpy broadcasting is used.
+            numpy broadcasting is used. Sparse weights are only considered
+            on non-zero elements of X, the other ones having null weights.
+            Uniform (scalar) weights do not change the updates.
 
         return_errors: boolean
             if True, the list of reconstruction errors along iterations is
@@ -181,6 +634,18 @@ class KLdivNMF(object):
             Whether to force scaling of W during updates. This is only relevant
             if components are normalized.
 
+        block_size: int or None (default)
+            If set, or if X is out of core (memory-mapped array or
+            DiskCSRMatrix), updates are computed on blocks of block_size
+            rows (default is to use blocks of about
+            out_of_core.BLOCK_SIZE elements) so that only one block of X is
+            in memory at a time. Components are initialized from the
+            first block, so that results are the same as for in-memory
+            updates only if they do not depend on the data (init='random',
+            initial dictionary or transform). Weights are not supported on
+            blocks, nor are scale_W and restarts (n_restarts > 1) when
+            fitting.
+
         _fit: if True (default), update the model, else only compute transform
 
         Returns
@@ -190,9 +655,31 @@ class KLdivNMF(object):
 
         or (data, errors) if return_errors
         """
-        X = atleast2d_or_csr(X)
+        if block_size is not None or is_out_of_core(X):
+            if not _is_uniform(weights):
+                raise ValueError("Weights are not supported on blocks.")
+            if not _fit:
+                return self._transform_blocks(X, block_size=block_size,
+                                              return_errors=return_errors)
+            if scale_W:
+                raise ValueError("scale_W is not supported when fitting "
+                                 "on blocks.")
+            if self.n_restarts > 1:
+                raise ValueError("Restarts are not supported when fitting "
+                                 "on blocks.")
+            return self._fit_transform_blocks(X, block_size=block_size,
+                                              return_errors=return_errors)
+
+        X = _without_explicit_zeros(atleast2d_or_csr(X, dtype=self.dtype))
         check_non_negative(X, "NMF.fit")
 
+        if _fit and self.n_restarts > 1:
+            return self._fit_transform_restarts(
+                X, weights=weights, return_errors=return_errors,
+                scale_W=scale_W)
+        eps = _safe_eps(self.eps, self.dtype, scale=_max_value(X))
+        weights = _check_weights(weights, X)
+
         n_samples, n_features = X.shape
 
         if not self.n_components:
@@ -202,6 +689,15 @@ class KLdivNMF(object):
 
         if _fit:
             self.components_ = H
+            self._H_stats = None
+        else:
+            self.components_ = self.components_.astype(self.dtype, copy=False)
+            out = self._transform_rows(X, W, return_errors=return_errors,
+                                       weights=weights, criterion='error')
+            if self.n_iter_ == self.max_iter and self.tol > 0:
+                sys.stderr.write(
+                    "Warning: Iteration limit reached during transform\n")
+            return out
 
         prev_error = np.Inf
         tol = self.tol * n_samples * n_features
@@ -210,26 +706,163 @@ class KLdivNMF(object):
             errors = []
 
         for n_iter in range(1, self.max_iter + 1):
+            Q = self._Q(X, W, self.components_, eps=eps,
+                        n_threads=self.n_threads, pool=self._pool)
             # Stopping condition
-            error = self.error(X, W, self.components_, weights=weights)
-            if prev_error - error < tol:
-                break
-            prev_error = error
+            if (n_iter - 1) % self.check_every == 0:
+                error = self._error_from_Q(X, W, self.components_, Q,
+                                           weights=weights)
+                if prev_error - error < tol:
+                    break
+                prev_error = error
 
-            if return_errors:
-                errors.append(error)
+                if return_errors:
+                    errors.append(error)
+
+            W = self._update(X, W, _fit=_fit, eps=eps, Q=Q, weights=weights)
+
+        if n_iter == self.max_iter and tol > 0:
+            sys.stderr.write("Warning: Iteration limit reached during fit\n")
+
+        if return_errors:
+            return W, errors
+        else:
+            return W
 
-            W = self._update(X, W, _fit=_fit)
+    def _get_block(self, X, rows):
+        X_block = _without_explicit_zeros(
+            atleast2d_or_csr(X[rows], dtype=self.dtype))
+        check_non_negative(X_block, "NMF.fit")
+        return X_block
+
+    @_using_thread_pool
+    def _fit_transform_blocks(self, X, block_size=None, return_errors=False):
+        """Fits the model by reading blocks of rows of X for each update.
+
+        Components are initialized from the first block.
+        """
+        if sp.issparse(X):
+            X = X.tocsr()  # Row slicing
+        n_samples, n_features = X.shape
+        if not self.n_components:
+            self.n_components = n_features
+        if block_size is None:
+            block_size = default_block_rows(X)
+        blocks = list(gen_batches(n_samples, block_size))
+
+        _, H = self._init(self._get_block(X, blocks[0]))
+        W = np.empty((n_samples, self.n_components), dtype=self.dtype)
+        max_value = 0.
+        for rows in blocks:
+            X_block = self._get_block(X, rows)
+            W[rows, :] = X_block.dot(H.T)
+            max_value = max(max_value, _max_value(X_block))
+        eps = _safe_eps(self.eps, self.dtype, scale=max_value)
+
+        prev_error = np.inf
+        tol = self.tol * n_samples * n_features
+        errors = []
+        n_iter = 0
+        for n_iter in range(1, self.max_iter + 1):
+            check = (n_iter - 1) % self.check_every == 0
+            error = 0.
+            numerator = np.zeros_like(H)
+            for rows in blocks:
+                X_block = self._get_block(X, rows)
+                Q = self._Q(X_block, W[rows, :], H, eps=eps,
+                            n_threads=self.n_threads, pool=self._pool)
+                if check:
+                    error += self._error_from_Q(X_block, W[rows, :], H, Q)
+                W[rows, :] = self._updated_W(X_block, W[rows, :], H, Q=Q,
+                                             n_threads=self.n_threads,
+                                             pool=self._pool)
+                numerator += _threaded_tdot(W[rows, :], Q, self.n_threads,
+                                            pool=self._pool)
+            # Same as _updated_H, accumulated over blocks
+            H = normalize_sum(np.multiply(H, numerator), axis=1)
+            if check:
+                if prev_error - error < tol:
+                    break
+                prev_error = error
+                errors.append(error)
 
         if n_iter == self.max_iter and tol > 0:
             sys.stderr.write("Warning: Iteration limit reached during fit\n")
 
+        self.components_ = H
+        self._H_stats = None
         if return_errors:
             return W, errors
         else:
             return W
 
-    def _update(self, X, W, _fit=True, scale_W=False, eps=1.e-8):
+    def _transform_blocks(self, X, block_size=None, return_errors=False):
+        """Transforms X by reading blocks of rows, each of which is
+        transformed independently (see _transform_rows).
+        """
+        if sp.issparse(X):
+            X = X.tocsr()  # Row slicing
+        if block_size is None:
+            block_size = default_block_rows(X)
+        self.components_ = self.components_.astype(self.dtype, copy=False)
+        H = self.components_
+        W = np.empty((X.shape[0], self.n_components), dtype=self.dtype)
+        block_errors = []
+        n_iter = 0
+        for rows in gen_batches(X.shape[0], block_size):
+            X_block = self._get_block(X, rows)
+            out = self._transform_rows(X_block, X_block.dot(H.T),
+                                       return_errors=return_errors,
+                                       criterion='error')
+            n_iter = max(n_iter, self.n_iter_)
+            if return_errors:
+                W[rows, :], errors = out
+                block_errors.append(errors)
+            else:
+                W[rows, :] = out
+        self.n_iter_ = n_iter
+        if self.n_iter_ == self.max_iter and self.tol > 0:
+            sys.stderr.write(
+                "Warning: Iteration limit reached during transform\n")
+        if return_errors:
+            # Converged blocks keep their last error
+            n_checks = max([len(e) for e in block_errors] or [0])
+            errors = [sum(e[min(i, len(e) - 1)] for e in block_errors if e)
+                      for i in range(n_checks)]
+            return W, errors
+        else:
+            return W
+
+    def _fit_transform_restarts(self, X, **params):
+        """Fits the model n_restarts times, with different random states, and
+        keeps the factorization with lowest error.
+        """
+        seeds = check_random_state(self.random_state).randint(
+            np.iinfo(np.int32).max, size=self.n_restarts)
+        n_jobs = effective_n_jobs(self.n_jobs)
+        if n_jobs == 1:
+            results = [_fit_one_restart(self, X, s, params) for s in seeds]
+        else:
+            model = copy.copy(self)
+            model._pool = None  # Threads can not be sent to processes
+            with SharedMatrix(X) as shared_X:
+                pool = Pool(min(n_jobs, self.n_restarts))
+                try:
+                    results = pool.map(_restart_worker,
+                                       [(model, shared_X, s, params)
+                                        for s in seeds])
+                finally:
+                    pool.close()
+                    pool.join()
+        W, self.components_, _, errors = min(results, key=lambda r: r[2])
+        self._H_stats = None
+        if params.get('return_errors', False):
+            return W, errors
+        else:
+            return W
+
+    def _update(self, X, W, _fit=True, scale_W=False, eps=1.e-8, Q=None,
+                weights=None):
         """Perform one update iteration.
 
         Updates components if _fit and returns updated coefficients.
@@ -242,21 +875,34 @@ class KLdivNMF(object):
             scale_W: boolean (default: False)
                 Whether to force scaling of W. This is only relevant if
                 components are normalized.
+
+            Q: array or sparse matrix (default: None)
+                Precomputed value of X / WH (see _Q), ignored if scale_W.
+
+            weights: None (default, uniform weights) or weights prepared for
+                X (see _Weights)
         """
         if scale_W:
             # This is only relevant if components are normalized.
             # Not always usefull but might improve convergence speed:
             # Scale W lines to have same sum than X lines
             W = _scale(normalize_sum(W, axis=1), X.sum(axis=1), axis=1)
-        Q = self._Q(X, W, self.components_, eps=eps)
+            Q = None
+        if Q is None:
+            Q = self._Q(X, W, self.components_, eps=eps,
+                        n_threads=self.n_threads, pool=self._pool)
         # update W
-        W = self._updated_W(X, W, self.components_, Q=Q)
+        W = self._updated_W(X, W, self.components_, weights=weights, Q=Q,
+                            eps=eps, n_threads=self.n_threads, pool=self._pool)
         if _fit:
             # update H
-            self.components_ = self._updated_H(X, W, self.components_, Q=Q)
+            self.components_ = self._updated_H(
+                X, W, self.components_, weights=weights, Q=Q, eps=eps,
+                n_threads=self.n_threads, pool=self._pool)
         return W
 
-    def fit(self, X, y=None, **params):
+    @_using_thread_pool
+    def fit(self, X, y=None, batch_size=None, **params):
         """Learn a NMF model for the data X.
 
         Parameters
@@ -265,11 +911,111 @@ class KLdivNMF(object):
         X: {array-like, sparse matrix}, shape = [n_samples, n_features]
             Data matrix to be decomposed
 
+        batch_size: int or None (default)
+            If set, the model is learnt in mini-batch mode: max_iter passes
+            are performed over consecutive blocks of batch_size rows of X,
+            each of them being used in a call to partial_fit (weights
+            given for each sample are sliced accordingly). Only the
+            parameters of partial_fit (weights, forget_factor, scale_W) are
+            then accepted.
+
+        Other parameters are passed to fit_transform (or partial_fit).
+
         Returns
         -------
         self
         """
-        self.fit_transform(X, **params)
+        if batch_size is None:
+            self.fit_transform(X, **params)
+        else:
+            unsupported = set(params) - set(['weights', 'forget_factor',
+                                             'scale_W'])
+            if unsupported:
+                raise ValueError("Parameters not supported in mini-batch "
+                                 "mode: %s." % ', '.join(sorted(unsupported)))
+            if sp.issparse(X):
+                X = X.tocsr()  # Row slicing
+            weights = params.pop('weights', 1.)
+            if sp.issparse(weights):
+                weights = weights.tocsr()
+            per_sample = np.ndim(weights) == 2 and weights.shape[0] > 1
+            self._H_stats = None
+            for _ in range(self.max_iter):
+                for batch in gen_batches(X.shape[0], batch_size):
+                    self.partial_fit(
+                        X[batch],
+                        weights=weights[batch] if per_sample else weights,
+                        **params)
+        return self
+
+    @_using_thread_pool
+    def partial_fit(self, X, y=None, weights=1., forget_factor=1.,
+                    scale_W=False):
+        """Update the model from a block of samples (mini-batch mode).
+
+        The coefficients of the block are first updated subit times with
+        fixed components. Components are then updated from sufficient
+        statistics accumulated over all blocks seen since last
+        initialization, so that memory only depends on the size of the block.
+
+        On first call the components are initialized from the block (or from
+        the initial dictionary if one has been set).
+
+        Parameters
+        ----------
+
+        X: {array-like, sparse matrix}, shape = [n_samples, n_features]
+            Block of data
+
+        weights: {array-like, sparse matrix}, shape = [n_samples, n_features]
+            Weights on the cost for the block (see fit_transform).
+
+        forget_factor: float (default: 1.)
+            Factor applied to statistics from previous blocks before adding
+            the ones from current block. Values smaller than 1 give more
+            importance to recent samples.
+
+        Returns
+        -------
+        self
+        """
+        X = _without_explicit_zeros(atleast2d_or_csr(X, dtype=self.dtype))
+        check_non_negative(X, "NMF.partial_fit")
+        eps = _safe_eps(self.eps, self.dtype, scale=_max_value(X))
+        weights = _check_weights(weights, X)
+
+        if not self.n_components:
+            self.n_components = X.shape[1]
+
+        if self._H_stats is None:
+            W, self.components_ = self._init(X)
+            # Numerator and denominator of multiplicative updates
+            self._H_stats = (np.zeros_like(self.components_),
+                             np.zeros((self.n_components, 1),
+                                      dtype=self.dtype))
+        else:
+            W = X.dot(self.components_.T)
+
+        for _ in range(self.subit):
+            W = self._update(X, W, _fit=False, scale_W=scale_W, eps=eps,
+                             weights=weights)
+        Q = self._Q(X, W, self.components_, eps=eps, n_threads=self.n_threads,
+                    pool=self._pool)
+        if weights is None:
+            numerator = _threaded_tdot(W, Q, self.n_threads, pool=self._pool)
+            denominator = np.sum(W, axis=0)[:, np.newaxis]
+        else:
+            numerator = _threaded_tdot(W, weights.multiply(Q), self.n_threads,
+                                       pool=self._pool)
+            denominator = weights.tdot(W, n_threads=self.n_threads,
+                                       pool=self._pool)
+        numerator_stats, denominator_stats = self._H_stats
+        self._H_stats = (
+            forget_factor * numerator_stats
+            + np.multiply(self.components_, numerator),
+            forget_factor * denominator_stats + denominator)
+        self.components_ = normalize_sum(
+            np.divide(self._H_stats[0], self._H_stats[1] + eps), axis=1)
         return self
 
     def transform(self, X, **params):
@@ -290,24 +1036,185 @@ class KLdivNMF(object):
         params['_fit'] = False
         return self.fit_transform(X, **params)
 
+    @_using_thread_pool
+    def _transform_rows(self, X, W, tol=None, return_errors=False,
+                        weights=1., H_sums=None,
+                        criterion='coefficients'):
+        """Updates coefficients W of the data X for fixed components.
+
+        At most max_iter updates are performed. Convergence is tracked for
+        each row, so that later iterations only process active rows:
+
+        - 'coefficients' criterion: a row stops being updated as soon as
+          the relative (l1) change of its coefficients falls under tol,
+        - 'error' criterion: a row stops being updated as soon as the
+          decrease of its reconstruction error falls under tol * n_features
+          (the row-wise split of the criterion of fit_transform).
+
+        tol defaults to self.tol. X must be a dense array or csr matrix of
+        type dtype. Weights on the cost may be given as for fit_transform.
+
+        H_sums: array, shape = [n_components] (optional)
+            Sums of the rows of the components, used for uniform weights as
+            the denominator of the updates and in the errors. If not given,
+            components are assumed to be normalized (as after fit) and the
+            denominator is omitted. Callers transforming data with a part
+            of the components (e.g. some modalities) must give them; they
+            are then computed once for all data sets.
+
+        Returns
+        -------
+        W or (W, errors) if return_errors, where errors are the total
+        reconstruction errors at each check of the stopping condition.
+        """
+        if criterion not in ('coefficients', 'error'):
+            raise ValueError("Invalid criterion: %s" % criterion)
+        on_error = criterion == 'error'
+        if tol is None:
+            tol = self.tol
+        X = _without_explicit_zeros(X)
+        # Rows are transformed independently: eps is scaled to each row so
+        # that the result for a sample does not depend on the others
+        eps = _safe_eps(self.eps, self.dtype, scale=_row_max_values(X))
+        H = self.components_.astype(self.dtype, copy=False)
+        W = np.array(W, dtype=self.dtype)
+        n_samples, n_features = X.shape
+        denominator = H_sums
+        if H_sums is None:
+            H_sums = np.sum(H, axis=1, dtype=np.float64)
+        row_tol = tol * n_features
+        weights = _check_weights(weights, X)
+        row_errors = np.inf * np.ones((n_samples,))
+        errors = []
+        active = np.arange(n_samples)
+        X_active = X
+        eps_active = eps
+        weights_active = weights
+        self.n_iter_ = 0
+        for n_iter in range(1, self.max_iter + 1):
+            W_active = W[active, :]
+            Q = self._Q(X_active, W_active, H, eps=eps_active,
+                        n_threads=self.n_threads, pool=self._pool)
+            keep = None
+            if ((on_error or return_errors)
+                    and (n_iter - 1) % self.check_every == 0):
+                current = self._row_errors_from_Q(X_active, W_active, H, Q,
+                                                  weights=weights_active,
+                                                  H_sums=H_sums)
+                if on_error:
+                    # Row-wise stopping condition
+                    keep = np.nonzero(row_errors[active] - current
+                                      >= row_tol)[0]
+                row_errors[active] = current
+                if return_errors:
+                    errors.append(row_errors.sum())
+            if keep is not None and keep.shape[0] < active.shape[0]:
+                # Remove converged rows from working set
+                active = active[keep]
+                if active.shape[0] == 0:
+                    break
+                X_active = X[active, :]
+                eps_active = eps[active, :]
+                if weights is not None:
+                    weights_active = weights.rows(active)
+                W_active = W_active[keep, :]
+                Q = Q[keep, :]
+            new_W = self._updated_W(
+                X_active, W_active, H, weights=weights_active, Q=Q,
+                eps=eps_active, n_threads=self.n_threads, pool=self._pool,
+                H_sums=denominator)
+            W[active, :] = new_W
+            self.n_iter_ = n_iter
+            if not on_error:
+                change = np.abs(new_W - W_active).sum(axis=1)
+                keep = np.nonzero(change > tol * new_W.sum(axis=1))[0]
+                if keep.shape[0] == 0:
+                    break
+                elif keep.shape[0] < active.shape[0]:
+                    active = active[keep]
+                    X_active = X[active, :]
+                    eps_active = eps[active, :]
+                    if weights is not None:
+                        weights_active = weights.rows(active)
+        if return_errors:
+            return W, errors
+        else:
+            return W
+
     # Helpers for beta divergence and related updates
 
     # Errors and performance estimations
 
+    @_using_thread_pool
     def error(self, X, W, H=None, weights=1., eps=1.e-8):
-        X = atleast2d_or_csr(X)
+        X = _without_explicit_zeros(atleast2d_or_csr(X))
         if H is None:
             H = self.components_
+        eps = _safe_eps(eps, W.dtype, scale=_max_value(X))
+        Q = self._Q(X, W, H, eps=eps, n_threads=self.n_threads,
+                    pool=self._pool)
+        prepared = _check_weights(weights, X)
+        if prepared is None:
+            return weights * self._error_from_Q(X, W, H, Q)
+        else:
+            return self._error_from_Q(X, W, H, Q, weights=prepared)
+
+    @classmethod
+    def _elementwise_errors(cls, X, Q, weights=None):
+        """Returns (weighted) X log(Q) - X, as an array or as a csr matrix
+        with the structure of X.
+        """
         if sp.issparse(X):
-            WH = _special_sparse_dot(W, H, X)
+            E = Q.copy()
+            E.data = np.multiply(X.data, np.log(Q.data)) - X.data
+            if weights is not None:
+                E.data = np.multiply(E.data, weights.pattern.data)
+        else:
+            E = np.multiply(X, np.log(Q)) - X
+            if weights is not None:
+                E = np.multiply(E, weights.matrix)
+        return E
+
+    @classmethod
+    def _error_from_Q(cls, X, W, H, Q, weights=None):
+        """Computes the error from the quotient Q = X / WH (see _Q) so that
+        WH does not need to be computed again.
+
+        Sums are accumulated in double precision.
+
+        weights: None (uniform weights) or prepared weights (see _Weights)
+        """
+        if weights is None:
             # Avoid computing all values of WH to get their sum
-            WH_sum = np.sum(np.multiply(np.sum(W, axis=0), np.sum(H, axis=1)))
-            return (np.multiply(
-                X.data,
-                np.log(np.divide(X.data + eps, WH.data + eps))
-                )).sum() - X.data.sum() + WH_sum
+            WH_sum = np.sum(np.multiply(np.sum(W, axis=0, dtype=np.float64),
+                                        np.sum(H, axis=1, dtype=np.float64)))
+            if sp.issparse(X):
+                X, Q = X.data, Q.data
+            return (np.multiply(X, np.log(Q)).sum(dtype=np.float64)
+                    - X.sum(dtype=np.float64) + WH_sum)
+        E = cls._elementwise_errors(X, Q, weights=weights)
+        if sp.issparse(E):
+            E = E.data
+        return (E.sum(dtype=np.float64)
+                + np.multiply(W, weights.dot_HT(H)).sum(dtype=np.float64))
+
+    @classmethod
+    def _row_errors_from_Q(cls, X, W, H, Q, weights=None, H_sums=None):
+        """Computes the error on each row of X from the quotient
+        Q = X / WH (see _Q).
+
+        H_sums: sums of the rows of H, computed if not given (only used for
+            uniform weights)
+        """
+        if weights is None:
+            if H_sums is None:
+                H_sums = np.sum(H, axis=1, dtype=np.float64)
+            WH_sums = np.dot(W, H_sums)
         else:
-            return generalized_KL(X, np.dot(W, H))
+            WH_sums = np.multiply(W, weights.dot_HT(H)).sum(axis=1,
+                                                            dtype=np.float64)
+        E = cls._elementwise_errors(X, Q, weights=weights)
+        return np.asarray(E.sum(axis=1, dtype=np.float64)).ravel() + WH_sums
 
     # Projections
 
@@ -323,29 +1230,57 @@ class KLdivNMF(object):
     # Update rules
 
     @classmethod
-    def _Q(cls, X, W, H, eps=1.e-8):
+    def _Q(cls, X, W, H, eps=1.e-8, n_threads=1, pool=None):
         """Computes X / (WH)
            where '/' is element-wise and WH is a matrix product.
         """
         # X should be at least 2D or csr
+        # eps is either a scalar or has shape [n_samples, 1]
         if sp.issparse(X):
-            WH = _special_sparse_dot(W, H, X)
+            WH = _special_sparse_dot(W, H, X, n_threads=n_threads, pool=pool)
+            if np.ndim(eps) > 0:
+                eps = np.repeat(eps.ravel(), np.diff(WH.indptr))
             WH.data = (X.data + eps) / (WH.data + eps)
             return WH
         else:
             return np.divide(X + eps, np.dot(W, H) + eps)
 
     @classmethod
-    def _updated_W(cls, X, W, H, weights=1., Q=None, eps=1.e-8):
+    def _updated_W(cls, X, W, H, weights=1., Q=None, eps=1.e-8, n_threads=1,
+                   pool=None, H_sums=None):
+        """H_sums: sums of the rows of H, denominator of the update for
+        uniform weights (omitted if None, for normalized rows of H).
+        """
         if Q is None:
-            Q = cls._Q(X, W, H, eps=eps)
-        W = np.multiply(W, safe_sparse_dot(Q, H.T))
-        return W
+            Q = cls._Q(X, W, H, eps=eps, n_threads=n_threads, pool=pool)
+        weights = _check_weights(weights, X)
+        if weights is None:
+            numerator = _threaded_dot(Q, H.T, n_threads=n_threads, pool=pool)
+            if H_sums is None:
+                # Denominator is the sum of rows of H, that are normalized
+                return np.multiply(W, numerator)
+            return np.multiply(W, np.divide(
+                numerator, np.asarray(H_sums, dtype=W.dtype) + eps))
+        numerator = _threaded_dot(weights.multiply(Q), H.T,
+                                  n_threads=n_threads, pool=pool)
+        return np.multiply(W, np.divide(
+            numerator,
+            weights.dot_HT(H, n_threads=n_threads, pool=pool) + eps))
 
     @classmethod
-    def _updated_H(cls, X, W, H, weights=1., Q=None, eps=1.e-8):
+    def _updated_H(cls, X, W, H, weights=1., Q=None, eps=1.e-8, n_threads=1,
+                   pool=None):
         if Q is None:
-            Q = cls._Q(X, W, H, eps=eps)
-        H = np.multiply(H, safe_sparse_dot(W.T, Q))
+            Q = cls._Q(X, W, H, eps=eps, n_threads=n_threads, pool=pool)
+        weights = _check_weights(weights, X)
+        if weights is None:
+            # Denominator is constant on rows thus removed by normalization
+            H = np.multiply(H, _threaded_tdot(W, Q, n_threads=n_threads,
+                                              pool=pool))
+        else:
+            H = np.multiply(H, np.divide(
+                _threaded_tdot(W, weights.multiply(Q), n_threads=n_threads,
+                               pool=pool),
+                weights.tdot(W, n_threads=n_threads, pool=pool) + eps))
         H = normalize_sum(H, axis=1)
         return H
@@ -0,0 +1,136 @@
+# encoding: utf-8
+
+
+"""Containers for data matrices that do not fit in memory.
+
+Dense matrices are simply memory-mapped numpy arrays (np.memmap, or
+np.load(..., mmap_mode='r')). Sparse matrices are stored in CSR format as
+.npy files for data, indices and indptr in a directory, and accessed by
+blocks of rows (DiskCSRMatrix).
+"""
+
+
+import os
+import shutil
+
+import numpy as np
+import scipy.sparse as sp
+
+
+# Default number of elements in blocks of rows loaded from disk
+BLOCK_SIZE = 2 ** 22
+
+
+def _field_path(path, field):
+    return os.path.join(path, field + '.npy')
+
+
+def _raw_to_npy(src, dest, dtype, length):
+    """Builds .npy file for 1D array from file with raw content."""
+    with open(dest, 'wb') as f:
+        np.lib.format.write_array_header_1_0(
+            f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                'fortran_order': False,
+                'shape': (length,)})
+        with open(src, 'rb') as g:
+            shutil.copyfileobj(g, f)
+    os.remove(src)
+
+
+class DiskCSRMatrix(object):
+    """Sparse matrix in CSR format stored on disk.
+
+    Data is stored as .npy files in the directory given by path, that are
+    memory-mapped. Blocks of consecutive rows are accessed by slicing,
+    which returns them as scipy.sparse.csr_matrix in memory.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.data = np.load(_field_path(path, 'data'), mmap_mode=mmap_mode)
+        self.indices = np.load(_field_path(path, 'indices'),
+                               mmap_mode=mmap_mode)
+        self.indptr = np.load(_field_path(path, 'indptr'),
+                              mmap_mode=mmap_mode)
+        self.shape = tuple(int(n) for n in np.load(_field_path(path, 'shape')))
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nnz(self):
+        return int(self.indptr[-1])
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice):
+            raise TypeError('DiskCSRMatrix only supports slices of rows.')
+        start, stop, step = rows.indices(self.shape[0])
+        if step != 1:
+            raise ValueError('DiskCSRMatrix only supports contiguous rows.')
+        stop = max(start, stop)
+        p_start, p_stop = self.indptr[start], self.indptr[stop]
+        return sp.csr_matrix(
+            (np.array(self.data[p_start:p_stop]),
+             np.array(self.indices[p_start:p_stop]),
+             np.array(self.indptr[start:(stop + 1)]) - p_start),
+            shape=(stop - start, self.shape[1]))
+
+    @classmethod
+    def save(cls, X, path):
+        """Stores a sparse matrix on disk and returns it as a DiskCSRMatrix.
+        """
+        return cls.from_row_blocks([X], path)
+
+    @classmethod
+    def from_row_blocks(cls, blocks, path):
+        """Stores the matrix obtained by stacking the given blocks of rows on
+        disk and returns it as a DiskCSRMatrix.
+
+        Blocks are processed one at a time so that they may be generated
+        on demand and the full matrix is never in memory.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        tmp = {f: _field_path(path, f) + '.tmp' for f in ['data', 'indices']}
+        indptr = [np.zeros((1,), dtype=np.int64)]
+        n_rows, n_cols, nnz, dtype = 0, None, 0, None
+        with open(tmp['data'], 'wb') as data_f:
+            with open(tmp['indices'], 'wb') as indices_f:
+                for b in blocks:
+                    b = sp.csr_matrix(b)
+                    b.sum_duplicates()
+                    if n_cols is None:
+                        n_cols, dtype = b.shape[1], b.dtype
+                    elif b.shape[1] != n_cols:
+                        raise ValueError('Blocks have different widths.')
+                    data_f.write(b.data.astype(dtype).tobytes())
+                    indices_f.write(b.indices.astype(np.int32).tobytes())
+                    indptr.append(nnz + b.indptr[1:].astype(np.int64))
+                    nnz += b.nnz
+                    n_rows += b.shape[0]
+        if n_cols is None:
+            raise ValueError('At least one block is required.')
+        _raw_to_npy(tmp['data'], _field_path(path, 'data'), dtype, nnz)
+        _raw_to_npy(tmp['indices'], _field_path(path, 'indices'), np.int32,
+                    nnz)
+        np.save(_field_path(path, 'indptr'), np.hstack(indptr))
+        np.save(_field_path(path, 'shape'), np.array([n_rows, n_cols]))
+        return cls(path)
+
+
+def is_out_of_core(X):
+    """Whether X is a memory-mapped array or matrix stored on disk."""
+    return isinstance(X, (np.memmap, DiskCSRMatrix))
+
+
+def default_block_rows(X, block_size=BLOCK_SIZE):
+    """Number of rows of X such that blocks hold about block_size elements
+    (non-zero elements for sparse matrices).
+    """
+    n_samples, n_features = X.shape
+    if isinstance(X, DiskCSRMatrix) or sp.issparse(X):
+        per_row = X.nnz / float(max(1, n_samples))
+    else:
+        per_row = n_features
+    return max(1, int(block_size // max(1., per_row)))
@@ -0,0 +1,110 @@
+# encoding: utf-8
+
+
+"""Helpers to share numpy arrays and sparse matrices between processes.
+
+Arrays are copied once into blocks of shared memory. Only the names of the
+blocks are pickled when sending a SharedMatrix to worker processes, which
+then access the data without copy. Where shared memory is not available
+(Python < 3.8) data is pickled as usual.
+"""
+
+
+import numpy as np
+import scipy.sparse as sp
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+SPARSE_FIELDS = ['data', 'indices', 'indptr']
+
+
+def _to_shared_block(a):
+    block = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+    np.ndarray(a.shape, dtype=a.dtype, buffer=block.buf)[...] = a
+    return block
+
+
+def _from_shared_block(block, shape, dtype):
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+class SharedMatrix(object):
+    """Dense array or sparse (csr or csc) matrix stored in shared memory.
+
+    The process creating the SharedMatrix owns the memory and must release it
+    through close (or by using the SharedMatrix as a context manager).
+    Other processes get the data through get, as read-only arrays.
+    """
+
+    def __init__(self, X):
+        if sp.issparse(X) and X.format not in ('csr', 'csc'):
+            X = X.tocsr()
+        self.shape = X.shape
+        if sp.issparse(X):
+            self.format = X.format
+            arrays = [getattr(X, f) for f in SPARSE_FIELDS]
+        else:
+            self.format = None
+            arrays = [np.asarray(X)]
+        self._meta = [(a.shape, a.dtype) for a in arrays]
+        if shared_memory is None:
+            self._arrays = arrays
+            self._blocks = None
+        else:
+            self._blocks = [_to_shared_block(a) for a in arrays]
+            self._arrays = [_from_shared_block(b, s, d)
+                            for b, (s, d) in zip(self._blocks, self._meta)]
+        self._owner = True
+
+    def get(self):
+        """Returns the shared data (as an array or sparse matrix).
+        """
+        if self.format is None:
+            return self._arrays[0]
+        else:
+            matrix_class = (sp.csr_matrix if self.format == 'csr'
+                            else sp.csc_matrix)
+            return matrix_class(tuple(self._arrays), shape=self.shape,
+                                copy=False)
+
+    def close(self):
+        """Releases shared memory (unlinks it if owned by this process).
+        """
+        if self._blocks is not None:
+            self._arrays = None
+            for b in self._blocks:
+                if self._owner:
+                    b.unlink()
+                try:
+                    b.close()
+                except BufferError:
+                    pass  # Views on the data are still in use
+            self._blocks = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._blocks is not None:
+            state['_blocks'] = [b.name for b in self._blocks]
+            state['_arrays'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = False
+        if self._blocks is not None:
+            self._blocks = [shared_memory.SharedMemory(name=n)
+                            for n in self._blocks]
+            self._arrays = [_from_shared_block(b, s, d)
+                            for b, (s, d) in zip(self._blocks, self._meta)]
+            for a in self._arrays:  # Shared data is read-only for workers
+                a.flags.writeable = False
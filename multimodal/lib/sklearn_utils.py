@@ -43,8 +43,11 @@
 # DAMAGE.
 
 
+import numbers
+
 import numpy as np
 from scipy import sparse
+from scipy import linalg
 
 
 # Source utils/fixes.py
@@ -69,6 +72,24 @@ def assert_all_finite(X):
             raise ValueError("array contains NaN or infinity")
 
 
+def check_random_state(seed):
+    """Turn seed into a np.random.RandomState instance
+
+    If seed is None, return the RandomState singleton used by np.random.
+    If seed is an int, return a new RandomState instance seeded with seed.
+    If seed is already a RandomState instance, return it.
+    Otherwise raise ValueError.
+    """
+    if seed is None or seed is np.random:
+        return np.random.mtrand._rand
+    if isinstance(seed, (numbers.Integral, np.integer)):
+        return np.random.RandomState(seed)
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    raise ValueError('%r cannot be used to seed a numpy.random.RandomState'
+                     ' instance' % seed)
+
+
 def array2d(X, dtype=None, order=None, copy=False):
     """Returns at least 2-d array with data from X"""
     if sparse.issparse(X):
@@ -108,3 +129,136 @@ def safe_sparse_dot(a, b, dense_output=False):
         return ret
     else:
         return np.dot(a, b)
+
+
+def norm(x):
+    """Compute the Euclidean or Frobenius norm of x.
+
+    Returns the Euclidean norm when x is a vector, the Frobenius norm when x
+    is a matrix (2-d array). More precise than sqrt(squared_norm(x)).
+    """
+    x = np.asarray(x)
+    nrm2, = linalg.get_blas_funcs(['nrm2'], [x])
+    return nrm2(x.ravel())
+
+
+def randomized_range_finder(A, size, n_iter, random_state=None):
+    """Computes an orthonormal matrix whose range approximates the range of A.
+
+    Parameters
+    ----------
+    A: 2D array or sparse matrix
+        The input data matrix
+    size: integer
+        Size of the return array
+    n_iter: integer
+        Number of power iterations used to stabilize the result
+    random_state: RandomState or an int seed (0 by default)
+        A random number generator instance
+
+    Returns
+    -------
+    Q: 2D array
+        A (size x size) projection matrix, the range of which
+        approximates well the range of the input matrix A.
+
+    Notes
+    -----
+    Follows Algorithm 4.3 of
+    Finding structure with randomness: Stochastic algorithms for constructing
+    approximate matrix decompositions
+    Halko, et al., 2009 (arXiv:909) http://arxiv.org/pdf/0909.4061
+    """
+    random_state = check_random_state(random_state)
+
+    # generating random gaussian vectors r with shape: (A.shape[1], size)
+    R = random_state.normal(size=(A.shape[1], size))
+
+    # sampling the range of A using by linear projection of r
+    Y = safe_sparse_dot(A, R)
+    del R
+
+    # perform power iterations with Y to further 'imprint' the top
+    # singular vectors of A in Y, orthonormalizing at each step for
+    # numerical stability
+    for i in range(n_iter):
+        Y, _ = linalg.qr(Y, mode='economic')
+        Y = safe_sparse_dot(A, safe_sparse_dot(A.T, Y))
+
+    # extracting an orthonormal basis of the A range samples
+    Q, R = linalg.qr(Y, mode='economic')
+    return Q
+
+
+def randomized_svd(M, n_components, n_oversamples=10, n_iter=2,
+                   transpose='auto', random_state=0):
+    """Computes a truncated randomized SVD
+
+    Parameters
+    ----------
+    M: ndarray or sparse matrix
+        Matrix to decompose
+
+    n_components: int
+        Number of singular values and vectors to extract.
+
+    n_oversamples: int (default is 10)
+        Additional number of random vectors to sample the range of M so as
+        to ensure proper conditioning. The total number of random vectors
+        used to find the range of M is n_components + n_oversamples.
+
+    n_iter: int (default is 2)
+        Number of power iterations (can be used to deal with very noisy
+        problems).
+
+    transpose: True, False or 'auto' (default)
+        Whether the algorithm should be applied to M.T instead of M. The
+        result should approximately be the same. The 'auto' mode will
+        trigger the transposition if M.shape[1] > M.shape[0] since this
+        implementation of randomized SVD tend to be a little faster in that
+        case).
+
+    random_state: RandomState or an int seed (0 by default)
+        A random number generator instance to make behavior
+
+    Notes
+    -----
+    This algorithm finds a (usually very good) approximate truncated
+    singular value decomposition using randomization to speed up the
+    computations. It is particularly fast on large matrices on which
+    you wish to extract only a small number of components.
+
+    References
+    ----------
+    * Finding structure with randomness: Stochastic algorithms for constructing
+      approximate matrix decompositions
+      Halko, et al., 2009 http://arxiv.org/abs/arXiv:0909.4061
+
+    * A randomized algorithm for the decomposition of matrices
+      Per-Gunnar Martinsson, Vladimir Rokhlin and Mark Tygert
+    """
+    random_state = check_random_state(random_state)
+    n_random = n_components + n_oversamples
+    n_samples, n_features = M.shape
+
+    if transpose == 'auto' and n_samples > n_features:
+        transpose = True
+    if transpose:
+        # this implementation is a bit faster with smaller shape[1]
+        M = M.T
+
+    Q = randomized_range_finder(M, n_random, n_iter, random_state)
+
+    # project M to the (k + p) dimensional space using the basis vectors
+    B = safe_sparse_dot(Q.T, M)
+
+    # compute the SVD on the thin matrix: (k + p) wide
+    Uhat, s, V = linalg.svd(B, full_matrices=False)
+    del B
+    U = np.dot(Q, Uhat)
+
+    if transpose:
+        # transpose back the results according to the input convention
+        return V[:n_components, :].T, s[:n_components], U[:, :n_components].T
+    else:
+        return U[:, :n_components], s[:n_components], V[:n_components, :]
@@ -2,6 +2,8 @@
 """
 
 
+from multiprocessing import cpu_count
+
 import numpy as np
 
 
@@ -140,3 +142,14 @@ def leave_one_out(n_samples):
         # Generate train and test set
         train = [j for j in range(n_samples) if j != i]
         yield train, [i]
+
+
+# Parallelism
+
+def effective_n_jobs(n_jobs):
+    """Number of processes to use for n_jobs, negative values counting from
+    the number of processors (-1 means all processors).
+    """
+    if n_jobs < 0:
+        return max(1, cpu_count() + 1 + n_jobs)
+    return max(1, n_jobs)
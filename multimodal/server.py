@@ -0,0 +1,259 @@
+# encoding: utf-8
+
+
+"""Local inference server for cross-modal reconstruction.
+
+Concurrent requests are coalesced into micro-batches: samples received for
+the same input modality within max_latency seconds (and up to
+max_batch_size samples) are transformed by a single call to the learner.
+Since each sample is transformed independently (the stopping condition
+and the eps guarding divisions are computed for each sample), results are
+the same as for individual requests, up to rounding errors.
+
+The server talks line-delimited json over a Unix socket or TCP on
+localhost. Each request is a json object:
+
+    {"op": "reconstruct_internal", "modality": "sound", "data": [[...]]}
+    {"op": "modality_to_modality", "modality": "sound", "dest": "image",
+     "data": [[...]]}
+
+where data holds one or several samples (rows). Answers are either
+{"result": [[...]]} or {"error": "message"}; an "id" given in the request
+is copied to the answer. Requests sent on the same connection are
+processed concurrently, so answers may come in a different order than
+the requests and should be matched by id.
+
+This module requires Python 3.7 or later (asyncio) and is not imported by
+the rest of the package, which still supports older versions.
+"""
+
+
+import json
+import asyncio
+from collections import OrderedDict
+
+import numpy as np
+
+from .lib.array_utils import safe_vstack
+
+
+class InferenceServer(object):
+    """Serves reconstructions from a trained MultimodalLearner.
+
+    Parameters
+    ----------
+    learner: trained MultimodalLearner
+
+    iterations: int
+        Number of iterations used to compute internal coefficients.
+
+    max_batch_size: int
+        Maximum number of samples transformed together.
+
+    max_latency: float
+        Maximum time (in seconds) a request waits for other requests to
+        be batched with.
+
+    max_pending: int
+        Maximum number of requests waiting to be processed; submitting more
+        requests blocks until some are processed (backpressure).
+
+    executor: concurrent.futures.Executor or None
+        Executor running the computations, default to the one of the loop.
+    """
+
+    def __init__(self, learner, iterations, max_batch_size=64,
+                 max_latency=.005, max_pending=1024, executor=None):
+        self.learner = learner
+        self.iterations = iterations
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.executor = executor
+        self.n_batches = 0  # Number of calls to the learner
+        self._queue = None
+        self._worker = None
+        self._error = None  # Set when the worker stops
+
+    async def start(self):
+        """Starts processing requests (in the running loop)."""
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._error = None
+        self._worker = asyncio.ensure_future(self._process_batches())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                pass  # The error was set on the pending requests
+            self._worker = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def reconstruct_internal(self, modality, data):
+        """Returns internal coefficients for data (one sample per row)."""
+        data = np.atleast_2d(data)
+        # Invalid requests must fail before being batched with other ones
+        dim = self.learner.dim[self.learner.get_index(modality)]
+        if data.ndim != 2 or data.shape[1] != dim:
+            raise ValueError('Wrong shape for %s data: %s (expected %d '
+                             'features).' % (modality, data.shape, dim))
+        if self._worker is None or self._error is not None:
+            raise RuntimeError('Inference server is not running.')
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((modality, data, future))
+        if self._error is not None:
+            # The worker stopped while this request was waiting
+            self._fail_pending([], self._error)
+        return await future
+
+    async def modality_to_modality(self, orig_mod, dest_mod, data):
+        internal = await self.reconstruct_internal(orig_mod, data)
+        return self.learner.reconstruct_modality(dest_mod, internal)
+
+    async def _next_batch(self, batch):
+        """Gets the requests of the next batch from the queue into batch.
+        """
+        loop = asyncio.get_running_loop()
+        batch.append(await self._queue.get())
+        n_samples = batch[0][1].shape[0]
+        deadline = loop.time() + self.max_latency
+        while n_samples < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            n_samples += request[1].shape[0]
+
+    async def _process_batches(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                await self._next_batch(batch)
+                by_modality = OrderedDict()
+                for request in batch:
+                    by_modality.setdefault(request[0], []).append(request)
+                for modality, requests in by_modality.items():
+                    try:
+                        internal = await loop.run_in_executor(
+                            self.executor, self.learner.reconstruct_internal,
+                            modality, safe_vstack([r[1] for r in requests]),
+                            self.iterations)
+                    except Exception as e:
+                        for _, _, future in requests:
+                            if not future.done():
+                                future.set_exception(e)
+                        continue
+                    self.n_batches += 1
+                    start = 0
+                    for _, data, future in requests:
+                        stop = start + data.shape[0]
+                        if not future.done():
+                            future.set_result(internal[start:stop, :])
+                        start = stop
+                batch = []
+        except BaseException as e:
+            # Requests must not wait forever for a stopped worker
+            if isinstance(e, Exception):
+                self._error = e
+            else:
+                self._error = RuntimeError('Inference server stopped.')
+            self._fail_pending(batch, self._error)
+            raise
+
+    def _fail_pending(self, requests, error):
+        """Sets error on requests and on all queued requests."""
+        requests = list(requests)
+        while not self._queue.empty():
+            requests.append(self._queue.get_nowait())
+        for _, _, future in requests:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _answer(self, request):
+        data = np.asarray(request['data'], dtype=np.float64)
+        if request['op'] == 'reconstruct_internal':
+            return await self.reconstruct_internal(request['modality'], data)
+        elif request['op'] == 'modality_to_modality':
+            return await self.modality_to_modality(request['modality'],
+                                                   request['dest'], data)
+        else:
+            raise ValueError('Unknown operation: %s.' % request['op'])
+
+    async def _respond(self, line, writer, lock):
+        answer = {}
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if 'id' in request:
+                answer['id'] = request['id']
+            answer['result'] = (await self._answer(request)).tolist()
+        except Exception as e:
+            answer['error'] = str(e)
+        async with lock:
+            writer.write((json.dumps(answer) + '\n').encode('utf-8'))
+            await writer.drain()
+
+    async def _handle_client(self, reader, writer):
+        # Requests are answered concurrently so that pipelined requests
+        # from one client can be batched together; at most max_pending
+        # requests of the connection are processed at a time.
+        lock = asyncio.Lock()
+        slots = asyncio.Semaphore(self.max_pending)
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await slots.acquire()
+                task = asyncio.ensure_future(
+                    self._respond(line, writer, lock))
+                task.add_done_callback(lambda t: slots.release())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=8765):
+        """Starts processing requests and listening on the Unix socket at
+        path, or on host and port. Returns the asyncio server.
+        """
+        await self.start()
+        if path is not None:
+            return await asyncio.start_unix_server(self._handle_client,
+                                                   path=path)
+        else:
+            return await asyncio.start_server(self._handle_client,
+                                              host=host, port=port)
+
+
+def serve_forever(learner, iterations, path=None, host='127.0.0.1',
+                  port=8765, **params):
+    """Runs an InferenceServer until interrupted (see InferenceServer for
+    parameters).
+    """
+    async def main():
+        server = await InferenceServer(learner, iterations, **params).serve(
+            path=path, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
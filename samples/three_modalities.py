@@ -16,7 +16,8 @@ class NewThreeModalitiesExperiment(ThreeModalitiesExperiment):
     """
 
     def run(self):
-        super(NewThreeModalitiesExperiment, self).run()
+        # Resume from checkpoint if the job was interrupted
+        super(NewThreeModalitiesExperiment, self).run(resume=True)
         self.print_result_table()
 
 
@@ -16,7 +16,8 @@ class NewTwoModalitiesExperiment(TwoModalitiesExperiment):
     """
 
     def run(self):
-        super(NewTwoModalitiesExperiment, self).run()
+        # Resume from checkpoint if the job was interrupted
+        super(NewTwoModalitiesExperiment, self).run(resume=True)
         self.print_result_table()
 
 
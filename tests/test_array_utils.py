@@ -3,7 +3,21 @@ import unittest
 import numpy as np
 from numpy.testing import assert_array_almost_equal
 
-from multimodal.lib.array_utils import normalize_sum, GrowingLILMatrix
+from multimodal.lib.array_utils import (normalize_sum, gen_batches,
+                                        GrowingLILMatrix)
+
+
+class TestGenBatches(unittest.TestCase):
+
+    def test_covers_range(self):
+        r = list(range(11))
+        self.assertEqual(sum([r[s] for s in gen_batches(11, 3)], []), r)
+
+    def test_sizes(self):
+        sizes = [s.stop - s.start for s in gen_batches(11, 3)]
+        self.assertEqual(sizes, [3, 3, 3, 2])
+        sizes = [s.stop - s.start for s in gen_batches(9, 3)]
+        self.assertEqual(sizes, [3, 3, 3])
 
 
 class TestNormalizeSum(unittest.TestCase):
@@ -2,11 +2,26 @@ import unittest
 
 import numpy as np
 import scipy.sparse as sp
+from numpy.testing import assert_array_almost_equal
 
 from multimodal.lib.array_utils import normalize_features
+from multimodal.lib.metrics import (kl_div, rev_kl_div, sym_kl_div,
+                                    frobenius, cosine_diff)
 from multimodal.evaluation import (evaluate_label_reco,
+                                   compare_labels_given_nb,
+                                   score_labels_given_nb,
+                                   GivenNbScoreAccumulator,
+                                   found_labels_to_score,
+                                   found_labels_to_confusion,
+                                   ConfusionAccumulator,
                                    evaluate_NN_label,
-                                   chose_examples)
+                                   chose_examples,
+                                   all_distances,
+                                   all_distances_multi,
+                                   classify_NN,
+                                   classify_NN_multi,
+                                   ExactNeighborIndex,
+                                   IVFNeighborIndex)
 
 
 class TestLabelEvaluation(unittest.TestCase):
@@ -30,6 +45,102 @@ class TestLabelEvaluation(unittest.TestCase):
             evaluate_label_reco(reco, labels)
 
 
+class TestLabelsGivenNb(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.reco = np.random.random((50, 6))
+        self.true = np.random.random((50, 6)) > .6
+        # Make some reconstructions right
+        self.reco[:25] += 2 * self.true[:25]
+
+    def loop_compare(self, reco, true):
+        nb_true = true.sum(axis=-1)
+        ok = []
+        for r, t, n in zip(reco, true, nb_true):
+            found = np.zeros(t.shape, dtype=bool)
+            found[np.argsort(-r)[:n]] = True
+            ok.append((found == t).all())
+        return np.array(ok)
+
+    def test_on_example(self):
+        reco = np.array([[.1, .5, .6, .1],
+                         [.6, .5, .2, .1],
+                         [.6, .5, .2, .1]])
+        true = np.array([[0, 1, 1, 0],
+                         [0, 1, 1, 0],
+                         [0, 0, 0, 0]])
+        self.assertEqual(list(compare_labels_given_nb(reco, true)),
+                         [True, False, True])
+        self.assertTrue(compare_labels_given_nb(reco[0], true[0]).all())
+
+    def test_same_as_loop(self):
+        ok = self.loop_compare(self.reco, self.true)
+        self.assertTrue(0 < ok.sum() < 50)
+        self.assertEqual(list(compare_labels_given_nb(self.reco, self.true)),
+                         list(ok))
+
+    def test_accumulator(self):
+        acc = GivenNbScoreAccumulator()
+        other = GivenNbScoreAccumulator()
+        self.assertTrue(np.isnan(acc.score))
+        acc.add(self.reco[:20], self.true[:20])
+        acc.add(self.reco[20:30], self.true[20:30])
+        other.add(self.reco[30:], self.true[30:])
+        acc.merge(other)
+        self.assertEqual(acc.n_samples, 50)
+        self.assertAlmostEqual(acc.score,
+                               score_labels_given_nb(self.reco, self.true))
+
+
+class TestConfusion(unittest.TestCase):
+
+    def setUp(self):
+        self.true = [0, 0, 1, 2, 2, 2]
+        self.found = [0, 0, 2, 2, 1, 2]
+        self.ok = np.array([[2, 0, 0],
+                            [0, 0, 1],
+                            [0, 1, 2]])
+
+    def test_counts_duplicates(self):
+        assert_array_almost_equal(
+            found_labels_to_confusion(self.true, self.found, 3), self.ok)
+
+    def test_score(self):
+        self.assertAlmostEqual(found_labels_to_score(self.true, self.found),
+                               4. / 6)
+        self.assertAlmostEqual(found_labels_to_score(['a', 'b'], ['a', 'a']),
+                               .5)
+        self.assertAlmostEqual(
+            found_labels_to_score([[1, 2], [3]], [[1, 2], [1]]), .5)
+
+    def test_accumulator(self):
+        acc = ConfusionAccumulator(3)
+        self.assertTrue(np.isnan(acc.accuracy))
+        acc.add(self.true[:2], self.found[:2])
+        other = ConfusionAccumulator(3)
+        other.add(self.true[2:], self.found[2:])
+        acc.merge(other)
+        assert_array_almost_equal(acc.confusion, self.ok)
+        self.assertEqual(acc.n_samples, 6)
+        self.assertAlmostEqual(acc.accuracy, 4. / 6)
+        assert_array_almost_equal(acc.recall, [1., 0., 2. / 3])
+
+    def test_recall_without_examples(self):
+        acc = ConfusionAccumulator(3)
+        acc.add([0, 0], [0, 1])
+        self.assertTrue(np.isnan(acc.recall[2]))
+
+    def test_wrong_labels(self):
+        acc = ConfusionAccumulator(3)
+        with self.assertRaises(ValueError):
+            acc.add([0, 3], [0, 1])
+        with self.assertRaises(ValueError):
+            acc.add([0, 1], [0])
+        with self.assertRaises(ValueError):
+            acc.merge(ConfusionAccumulator(2))
+
+
 class TestNNEvaluation(unittest.TestCase):
 
     def setUp(self):
@@ -70,6 +181,208 @@ class TestNNEvaluation(unittest.TestCase):
                 0.)
 
 
+class TestAllDistances(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.a = np.random.random((13, 7))
+        self.a *= self.a > .4
+        self.a[0, :] = 0
+        self.b = np.random.random((5, 7))
+        self.b *= self.b > .4
+
+    def broadcast(self, measure):
+        return measure(self.a[:, np.newaxis, :], self.b[np.newaxis, :, :],
+                       axis=-1)
+
+    def check_measure(self, measure):
+        ok = self.broadcast(measure)
+        for a, b in [(self.a, self.b),
+                     (sp.csr_matrix(self.a), sp.csc_matrix(self.b)),
+                     (self.a, sp.csr_matrix(self.b)),
+                     (sp.csr_matrix(self.a), self.b)]:
+            assert_array_almost_equal(all_distances(a, b, measure), ok)
+            # Chunks of 2 rows
+            assert_array_almost_equal(
+                all_distances(a, b, measure, max_memory=2 * 8 * (4 * 5 + 14)),
+                ok)
+
+    def test_kl(self):
+        self.check_measure(kl_div)
+
+    def test_rev_kl(self):
+        self.check_measure(rev_kl_div)
+
+    def test_sym_kl(self):
+        self.check_measure(sym_kl_div)
+
+    def test_frobenius(self):
+        self.check_measure(frobenius)
+
+    def test_cosine(self):
+        self.check_measure(cosine_diff)
+
+    def test_other_measure(self):
+        def l1(a, b, axis=-1):
+            return np.abs(a - b).sum(axis=axis)
+
+        self.check_measure(l1)
+        assert_array_almost_equal(all_distances(self.a, self.b, l1,
+                                                max_memory=1),
+                                  self.broadcast(l1))
+
+
+class TestMultipleMeasures(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.a = np.random.random((9, 6))
+        self.a *= self.a > .4
+        self.b = np.random.random((5, 6))
+
+    def broadcast(self, measure):
+        return measure(self.a[:, np.newaxis, :], self.b[np.newaxis, :, :],
+                       axis=-1)
+
+    def l1(self, a, b, axis=-1):
+        return np.abs(a - b).sum(axis=axis)
+
+    def test_same_as_separate_measures(self):
+        measures = [kl_div, rev_kl_div, frobenius, self.l1, cosine_diff]
+        for a, b in [(self.a, self.b),
+                     (sp.csr_matrix(self.a), sp.csr_matrix(self.b))]:
+            for max_memory in [1, 2 ** 20]:
+                all_dists = all_distances_multi(a, b, measures,
+                                                max_memory=max_memory)
+                self.assertEqual(len(all_dists), len(measures))
+                for dists, measure in zip(all_dists, measures):
+                    assert_array_almost_equal(dists, self.broadcast(measure))
+
+    def test_classify(self):
+        labels = list(range(5))
+        measures = [kl_div, rev_kl_div, frobenius, cosine_diff]
+        found = classify_NN_multi(self.a, self.b, labels, measures)
+        for f, measure in zip(found, measures):
+            self.assertEqual(f, classify_NN(self.a, self.b, labels, measure))
+
+
+class TestNeighborIndex(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        # Clustered examples
+        centers = 10 * np.random.random((8, 6))
+        self.labels = list(np.random.randint(8, size=400))
+        self.ex = (centers[self.labels, :]
+                   + .1 * np.random.random((400, 6)))
+        self.samples = (centers[[1, 3, 5], :]
+                        + .1 * np.random.random((3, 6)))
+
+    def check_exact(self, measure):
+        ok = all_distances(self.samples, self.ex, measure)
+        index = ExactNeighborIndex(measure=measure)
+        index.add(self.ex[:150], self.labels[:150])
+        index.add(self.ex[150:], self.labels[150:])
+        self.assertEqual(len(index), 400)
+        dists, idx = index.query(self.samples, k=5)
+        assert_array_almost_equal(idx, np.argsort(ok, axis=1)[:, :5])
+        assert_array_almost_equal(dists, np.sort(ok, axis=1)[:, :5])
+        self.assertEqual(index.found_labels(self.samples),
+                         classify_NN(self.samples, self.ex, self.labels,
+                                     measure))
+
+    def test_exact_cosine(self):
+        self.check_exact(cosine_diff)
+
+    def test_exact_frobenius(self):
+        self.check_exact(frobenius)
+
+    def test_missing_neighbors(self):
+        index = ExactNeighborIndex()
+        dists, idx = index.query(self.samples, k=2)
+        self.assertTrue((idx == -1).all())
+        index.add(self.ex[:1])
+        dists, idx = index.query(self.samples, k=2)
+        self.assertTrue((idx[:, 0] == 0).all())
+        self.assertTrue((idx[:, 1] == -1).all())
+        self.assertTrue(np.isinf(dists[:, 1]).all())
+
+    def test_wrong_shapes(self):
+        index = ExactNeighborIndex()
+        with self.assertRaises(ValueError):
+            index.add(self.ex[:2], labels=[1])
+        index.add(self.ex[:2])
+        with self.assertRaises(ValueError):
+            index.add(self.ex[:2, :3])
+
+    def check_ivf(self, measure):
+        index = IVFNeighborIndex(measure=measure, n_lists=8, n_probe=2,
+                                 train_ratio=4)
+        for i in range(0, 400, 50):  # Incremental insertion
+            index.add(self.ex[i:(i + 50)], self.labels[i:(i + 50)])
+        self.assertIsNotNone(index.centroids)
+        self.assertEqual(sum(len(l) for l in index._lists), 400)
+        ok = ExactNeighborIndex(measure=measure)
+        ok.add(self.ex, self.labels)
+        self.assertEqual(index.found_labels(self.samples),
+                         ok.found_labels(self.samples))
+        dists, idx = index.query(self.samples, k=3)
+        for i in range(3):
+            assert_array_almost_equal(
+                dists[i], all_distances(self.samples[i:(i + 1)],
+                                        self.ex[idx[i]], measure)[0])
+
+    def test_ivf_cosine(self):
+        self.check_ivf(cosine_diff)
+
+    def test_ivf_frobenius(self):
+        self.check_ivf(frobenius)
+
+    def trained_ivf(self, **params):
+        index = IVFNeighborIndex(n_lists=8, train_ratio=4, **params)
+        index.add(self.ex, self.labels)
+        return index
+
+    def test_ivf_skips_empty_lists(self):
+        index = self.trained_ivf(n_probe=1)
+        # Closest centroid of each sample with an empty list
+        index.centroids = np.vstack([index.centroids,
+                                     index._quantizer_space(self.samples)])
+        index._lists.extend([[], [], []])
+        ok = ExactNeighborIndex()
+        ok.add(self.ex, self.labels)
+        self.assertEqual(index.found_labels(self.samples),
+                         ok.found_labels(self.samples))
+
+    def test_ivf_probes_enough_lists(self):
+        index = self.trained_ivf(n_probe=1)
+        self.assertTrue(max(len(l) for l in index._lists) < 150)
+        dists, idx = index.query(self.samples, k=150)
+        self.assertTrue((idx >= 0).all())
+        for i in range(3):
+            self.assertEqual(len(set(idx[i])), 150)
+        self.assertTrue(np.isfinite(dists).all())
+        self.assertTrue((np.diff(dists, axis=1) >= 0).all())
+        # More neighbors than examples
+        _, idx = index.query(self.samples, k=401)
+        self.assertTrue((idx[:, :400] >= 0).all())
+        self.assertTrue((idx[:, 400] == -1).all())
+
+    def test_ivf_random_state(self):
+        index1 = self.trained_ivf(random_state=0)
+        np.random.seed(1)
+        index2 = self.trained_ivf(random_state=0)
+        assert_array_almost_equal(index1.centroids, index2.centroids)
+
+    def test_found_labels_empty_index(self):
+        self.assertEqual(ExactNeighborIndex().found_labels(self.samples),
+                         [None, None, None])
+
+    def test_ivf_measures(self):
+        with self.assertRaises(ValueError):
+            IVFNeighborIndex(measure=kl_div)
+
+
 class TestChoseExamples(unittest.TestCase):
 
     def setUp(self):
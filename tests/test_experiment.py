@@ -0,0 +1,221 @@
+import os
+import random
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+from collections import OrderedDict
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_allclose
+
+from multimodal.experiment import TwoModalitiesExperiment
+from multimodal.learner import MultimodalLearner
+
+
+class FakeLoader(object):
+
+    def __init__(self, data, labels):
+        self.data = data
+        self.labels = labels
+
+    def get_data(self):
+        return self.data
+
+    def get_labels(self):
+        return self.labels
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after_checkpoints(logger, n_runs):
+    """Makes the logger fail when checkpointing the run after n_runs."""
+    checkpoint_run = logger.checkpoint_run
+    done = []
+
+    def interrupted(*args, **kwargs):
+        if len(done) == n_runs:
+            raise Interrupted
+        checkpoint_run(*args, **kwargs)
+        done.append(True)
+
+    logger.checkpoint_run = interrupted
+
+
+def random_experiment(n_samples=40, **params):
+    labels = [i % 10 for i in range(n_samples)]
+    loaders = OrderedDict([
+        ('a', FakeLoader(np.random.random((n_samples, 5)), labels)),
+        ('b', FakeLoader(np.random.random((n_samples, 4)), labels))])
+    return TwoModalitiesExperiment(loaders, 3, 5, 5, **params)
+
+
+def run_experiment(seed, n_jobs, filename=None, interrupt_after=None,
+                   **params):
+    np.random.seed(seed)
+    random.seed(seed)
+    exp = random_experiment(**params)
+    exp.logger.filename = filename
+    if interrupt_after is None:
+        exp.run(n_jobs=n_jobs)
+    else:
+        interrupt_after_checkpoints(exp.logger, interrupt_after)
+        try:
+            exp.run(n_jobs=n_jobs, checkpoint=True)
+        except Interrupted:
+            pass
+        # Random state is restored from checkpoint
+        np.random.seed(seed + 1)
+        random.seed(seed + 1)
+        exp.run(n_jobs=n_jobs, resume=True)
+    return exp
+
+
+class RunsAssertions(object):
+    """Mixin for test cases comparing the runs of experiments."""
+
+    def assert_same_runs(self, exp1, exp2):
+        self.assertEqual(len(exp1.logger.exps), len(exp2.logger.exps))
+        self.assertEqual(exp1.logger.result_keys, exp2.logger.result_keys)
+        for run1, run2 in zip(exp1.logger.exps, exp2.logger.exps):
+            self.assertEqual(run1['test'], run2['test'])
+            assert_allclose(run1['dictionary'], run2['dictionary'])
+            for key in exp1.logger.result_keys:
+                if key.startswith('score'):
+                    assert_allclose(run1[key], run2[key])
+
+
+class TestParallelRuns(RunsAssertions, unittest.TestCase):
+
+    def test_n_runs(self):
+        exp = run_experiment(0, 1, run_mode=.25)
+        self.assertEqual(exp.n_runs, len(exp.logger.exps))
+
+    def test_independent_of_n_jobs(self):
+        self.assert_same_runs(run_experiment(0, 2, run_mode=.25),
+                             run_experiment(0, 3, run_mode=.25))
+
+    def test_same_splits_as_serial(self):
+        exp = run_experiment(0, 2, run_mode=.25)
+        serial = run_experiment(0, 1, run_mode=.25)
+        self.assertEqual(exp.logger.get_values('test'),
+                         serial.logger.get_values('test'))
+
+
+class TestResume(RunsAssertions, unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.filename = os.path.join(self.path, 'log')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_resume(self):
+        ok = run_experiment(0, 1, run_mode=.25)
+        exp = run_experiment(0, 1, filename=self.filename,
+                             interrupt_after=2, run_mode=.25)
+        self.assert_same_runs(ok, exp)
+        self.assertEqual(exp.logger.glob['sample_pairing'],
+                         ok.logger.glob['sample_pairing'])
+        self.assertTrue(os.path.exists(self.filename + '.json'))
+        self.assertFalse(os.path.exists(exp.logger.checkpoint_filename))
+
+    def test_resume_parallel(self):
+        ok = run_experiment(0, 2, run_mode=.25)
+        exp = run_experiment(0, 2, filename=self.filename,
+                             interrupt_after=1, run_mode=.25)
+        self.assert_same_runs(ok, exp)
+
+    def test_without_filename(self):
+        ok = run_experiment(0, 1, run_mode=.25)
+        np.random.seed(0)
+        random.seed(0)
+        exp = random_experiment(run_mode=.25)
+        exp.run(resume=True)
+        self.assert_same_runs(ok, exp)
+
+    def test_refuses_other_configuration(self):
+        exp = random_experiment(run_mode=.25)
+        exp.logger.filename = self.filename
+        interrupt_after_checkpoints(exp.logger, 2)
+        with self.assertRaises(Interrupted):
+            exp.run(checkpoint=True)
+        other = random_experiment(run_mode=.25)
+        other.logger.filename = self.filename
+        other.iter_test = 6
+        with self.assertRaises(ValueError):
+            other.run(resume=True)
+        self.assertTrue(os.path.exists(exp.logger.checkpoint_filename))
+
+    def test_ignores_incomplete_record(self):
+        exp = random_experiment(run_mode=.25)
+        exp.logger.filename = self.filename
+        interrupt_after_checkpoints(exp.logger, 3)
+        with self.assertRaises(Interrupted):
+            exp.run(checkpoint=True)
+        with open(exp.logger.checkpoint_filename, 'ab') as f:
+            f.write(b'\x80\x04\x95')
+        logger, states = exp.logger.load_checkpoint(self.filename)
+        self.assertEqual(len(logger.exps), 3)
+        self.assertEqual(len(states), 3)
+        assert_array_almost_equal(logger.exps[-1]['dictionary'],
+                                  exp.logger.exps[2]['dictionary'])
+
+
+class TestWarmStart(RunsAssertions, unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.filename = os.path.join(self.path, 'log')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_starts_from_previous_dictionary(self):
+        np.random.seed(0)
+        exp = random_experiment(n_samples=20, run_mode='leave-one-out',
+                                warm_start=True, iter_warm=2)
+        inits = []
+
+        def train(learner, data, iterations, init_dictionary=None):
+            inits.append((iterations, init_dictionary))
+            learner.dico = np.random.random((learner.k, sum(learner.dim)))
+
+        exp._get_new_learner = lambda: RecordingLearner(
+            exp.modalities, exp.n_features, exp.coefs, exp.k, train)
+        exp.run()
+        self.assertEqual(len(inits), exp.n_runs)
+        self.assertEqual(inits[0], (5, None))
+        for (iterations, init), run in zip(inits[1:], exp.logger.exps):
+            self.assertEqual(iterations, 2)
+            assert_array_almost_equal(init, run['dictionary'])
+
+    def check_resume(self, n_jobs, interrupt_after):
+        params = {'n_samples': 30, 'run_mode': 'leave-one-out',
+                  'warm_start': True, 'iter_warm': 2}
+        ok = run_experiment(0, n_jobs, **params)
+        exp = run_experiment(0, n_jobs, filename=self.filename,
+                             interrupt_after=interrupt_after, **params)
+        self.assert_same_runs(ok, exp)
+
+    def test_resume(self):
+        self.check_resume(1, 3)
+
+    def test_resume_parallel(self):
+        # Runs are sent by chunks of 3 runs
+        self.check_resume(2, 3)
+        self.check_resume(2, 4)
+
+
+class RecordingLearner(MultimodalLearner):
+
+    def __init__(self, modalities, dimensions, coefficients, k, train):
+        super(RecordingLearner, self).__init__(modalities, dimensions,
+                                               coefficients, k)
+        self._train = train
+
+    def train(self, data_matrices, iterations, init_dictionary=None):
+        self._train(self, data_matrices, iterations,
+                    init_dictionary=init_dictionary)
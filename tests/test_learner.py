@@ -0,0 +1,293 @@
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import scipy.sparse as sp
+from numpy.testing import assert_array_almost_equal
+
+from multimodal.lib.nmf import KLdivNMF as NMF
+from multimodal.learner import MultimodalLearner, fit_coefficients
+
+
+def random_NN_matrix(h, w):
+    return np.abs(np.random.random((h, w)))
+
+
+class TestCoefficientsTransformer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.learner = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3)
+        self.learner.dico = random_NN_matrix(3, 10)
+        self.learner.dico /= self.learner.dico.sum(axis=1)[:, np.newaxis]
+        coefs = random_NN_matrix(8, 3)
+        self.data_a = coefs.dot(self.learner.get_dico('a'))
+        self.data_b = coefs.dot(self.learner.get_dico('b'))
+
+    def test_same_as_fit_coefficients_without_tol(self):
+        transformer = self.learner.get_transformer(['a', 'b'], 20, tol=0.)
+        W = transformer.transform([self.data_a, self.data_b])
+        ok = fit_coefficients(self.learner.stack_data(
+            ['a', 'b'], [self.data_a, self.data_b]),
+            self.learner.get_dico(), iter_nmf=20)
+        assert_array_almost_equal(W, ok)
+
+    def test_warm_start(self):
+        transformer = self.learner.get_transformer(['a'], 200, tol=1.e-5)
+        W = transformer.transform([self.data_a])
+        transformer.nmf.max_iter = 1
+        W_warm = transformer.transform([self.data_a], init=W)
+        assert_array_almost_equal(W, W_warm, decimal=3)
+
+    def test_warm_start_stops_early(self):
+        data = [self.data_a, self.data_b]
+        transformer = self.learner.get_transformer(['a', 'b'], 500)
+        W = transformer.transform(data)
+        n_iter_cold = transformer.nmf.n_iter_
+        W_warm = transformer.transform(data, init=W)
+        self.assertTrue(transformer.nmf.n_iter_ < n_iter_cold)
+        assert_array_almost_equal(W, W_warm, decimal=3)
+
+    def test_row_sums(self):
+        transformer = self.learner.get_transformer(['b'], 10)
+        assert_array_almost_equal(transformer.row_sums,
+                                  self.learner.get_dico('b').sum(axis=1))
+        self.assertIs(transformer.row_sums,
+                      self.learner.get_dico_row_sums(['b']))
+
+    def test_normalized_updates_on_subset(self):
+        transformer = self.learner.get_transformer(['b'], 3000, tol=1.e-12)
+        W = transformer.transform([self.data_b])
+        H = transformer.dictionary
+        Q = 2. * self.data_b / W.dot(H)
+        # Fixed point of the KL updates on the sub-dictionary
+        ratios = Q.dot(H.T) / H.sum(axis=1)
+        significant = W > 1.e-2 * W.max()
+        assert_array_almost_equal(ratios[significant],
+                                  np.ones(significant.sum()), decimal=3)
+
+    def test_sparse(self):
+        transformer = self.learner.get_transformer(['b'], 10)
+        W = transformer.transform([sp.csr_matrix(self.data_b)])
+        W_dense = transformer.transform([self.data_b])
+        assert_array_almost_equal(W, W_dense)
+
+
+class TestWeightedLearner(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.learner = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3,
+                                         weighted=True)
+        coefs = random_NN_matrix(8, 3)
+        dico = random_NN_matrix(3, 10)
+        self.data = [coefs.dot(dico[:, :6]), coefs.dot(dico[:, 6:])]
+
+    def test_weights(self):
+        assert_array_almost_equal(self.learner.get_weights(['b', 'a']),
+                                  [[2.] * 4 + [1.] * 6])
+
+    def test_train_and_transform(self):
+        self.learner.train(self.data, 20)
+        self.assertEqual(self.learner.dico.shape, (3, 10))
+        transformer = self.learner.get_transformer(['a', 'b'], 20, tol=0.)
+        W = transformer.transform(self.data)
+        ok = self.learner.reconstruct_internal_multi(['a', 'b'], self.data,
+                                                     20)
+        assert_array_almost_equal(W, ok)
+
+    def test_init(self):
+        learner = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3,
+                                    init='nndsvd')
+        np.random.seed(1)
+        learner.train(self.data, 5)
+        self.assertEqual(learner.nmf_train.init, 'nndsvd')
+        nmf = NMF(n_components=3, init='nndsvd', max_iter=5, tol=0)
+        np.random.seed(1)
+        nmf.fit(learner.stack_data(['a', 'b'], self.data), scale_W=True)
+        assert_array_almost_equal(learner.dico, nmf.components_)
+        learner.train(self.data, 5, init='nndsvda')
+        self.assertEqual(learner.nmf_train.init, 'nndsvda')
+
+    def test_mini_batch(self):
+        self.learner.train([sp.csr_matrix(m) for m in self.data], 2,
+                           batch_size=3)
+        self.assertEqual(self.learner.dico.shape, (3, 10))
+
+
+class TestDicoCache(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.learner = MultimodalLearner(['a', 'b', 'c'], [2, 3, 4],
+                                         [1., 1., 1.], 2)
+        self.learner.dico = random_NN_matrix(2, 9)
+
+    def test_axis_range(self):
+        self.assertEqual(self.learner.get_axis_range('a'), (0, 2))
+        self.assertEqual(self.learner.get_axis_range('c'), (5, 9))
+
+    def test_stacked_dicos(self):
+        dico = self.learner.dico
+        stacked = self.learner.get_stacked_dicos(['c', 'a'])
+        assert_array_almost_equal(stacked,
+                                  np.hstack([dico[:, 5:], dico[:, :2]]))
+        self.assertTrue(stacked.flags.c_contiguous)
+        self.assertIs(stacked, self.learner.get_stacked_dicos(['c', 'a']))
+        assert_array_almost_equal(self.learner.get_dico_row_sums(['c', 'a']),
+                                  stacked.sum(axis=1))
+
+    def test_adjacent_modalities_are_views(self):
+        dico = self.learner.dico
+        view = self.learner.get_stacked_dicos(['b', 'c'])
+        assert_array_almost_equal(view, dico[:, 2:])
+        self.assertTrue(np.shares_memory(view, dico))
+        self.assertFalse(view.flags.writeable)
+        self.assertTrue(dico.flags.writeable)
+        self.assertFalse(np.shares_memory(
+            self.learner.get_stacked_dicos(['c', 'b']), dico))
+
+    def test_invalidated_on_new_dico(self):
+        stacked = self.learner.get_dico('b')
+        self.learner.dico = 2 * self.learner.dico
+        assert_array_almost_equal(self.learner.get_dico('b'), 2 * stacked)
+
+
+class TestBatchReconstruction(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.learner = MultimodalLearner(['a', 'b', 'c'], [5, 4, 6],
+                                         [1., 2., .5], 3)
+        self.learner.dico = random_NN_matrix(3, 15)
+        self.learner.dico /= self.learner.dico.sum(axis=1)[:, np.newaxis]
+        self.data = {m: random_NN_matrix(7, d)
+                     for m, d in zip(['a', 'b', 'c'], [5, 4, 6])}
+        self.subsets = [['a'], ['b', 'c'], ['a', 'c']]
+
+    def check_same_as_multi(self, data):
+        internals = self.learner.reconstruct_internal_batch(self.subsets,
+                                                            data, 20)
+        for mods, internal in zip(self.subsets, internals):
+            ok = self.learner.reconstruct_internal_multi(
+                mods, [data[m] for m in mods], 20)
+            assert_array_almost_equal(internal, ok)
+
+    def test_same_as_multi(self):
+        self.check_same_as_multi(self.data)
+
+    def test_same_as_multi_sparse(self):
+        self.check_same_as_multi({m: sp.csr_matrix(x * (x > .5))
+                                  for m, x in self.data.items()})
+
+    def test_same_as_multi_weighted(self):
+        self.learner.weighted = True
+        self.check_same_as_multi(self.data)
+
+    def test_same_as_multi_weighted_sparse(self):
+        self.learner.weighted = True
+        self.check_same_as_multi({m: sp.csr_matrix(x * (x > .5))
+                                  for m, x in self.data.items()})
+
+    def test_modalities_to_modalities(self):
+        combinations = [(['a'], ['b']), (['b', 'c'], ['a']), (['a'], ['c'])]
+        results = self.learner.modalities_to_modalities_batch(
+            combinations, self.data, 20)
+        for (orig, dest), result in zip(combinations, results):
+            ok = self.learner.modalities_to_modalities(
+                orig, dest, [self.data[m] for m in orig], 20)
+            assert_array_almost_equal(result, ok)
+
+
+class TestSaveLoad(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.learner = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3,
+                                         dtype=np.float32, weighted=True)
+        self.learner.dico = random_NN_matrix(3, 10)
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_save_load(self):
+        self.learner.save(self.path)
+        loaded = MultimodalLearner.load(self.path)
+        self.assertEqual(loaded.mod, ['a', 'b'])
+        self.assertEqual(loaded.dim, [6, 4])
+        self.assertEqual(loaded.coef, [1., 2.])
+        self.assertEqual(loaded.k, 3)
+        self.assertEqual(loaded.dtype, np.float32)
+        self.assertTrue(loaded.weighted)
+        self.assertIsInstance(loaded.dico, np.memmap)
+        assert_array_almost_equal(loaded.get_dico('b'),
+                                  self.learner.get_dico('b'))
+
+    def test_mmap_views(self):
+        self.learner.save(self.path)
+        loaded = MultimodalLearner.load(self.path)
+        view = loaded.get_dico('b')
+        self.assertIsInstance(view, np.memmap)
+        self.assertTrue(np.shares_memory(view, loaded.dico))
+        assert_array_almost_equal(loaded.get_dico_row_sums(['b']),
+                                  self.learner.get_dico('b').sum(axis=1),
+                                  decimal=5)
+
+    def test_in_memory(self):
+        self.learner.save(self.path)
+        loaded = MultimodalLearner.load(self.path, mmap_mode=None)
+        self.assertNotIsInstance(loaded.dico, np.memmap)
+
+    def test_not_trained(self):
+        self.learner.dico = None
+        with self.assertRaises(ValueError):
+            self.learner.save(self.path)
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.learner = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3)
+        coefs = random_NN_matrix(40, 3)
+        dico = random_NN_matrix(3, 10)
+        self.data = [coefs.dot(dico[:, :6]), coefs.dot(dico[:, 6:])]
+
+    def error(self, data):
+        internal = self.learner.reconstruct_internal_multi(['a', 'b'], data,
+                                                           50)
+        return self.learner.nmf_train.error(
+            self.learner.stack_data(['a', 'b'], data), internal,
+            H=self.learner.dico)
+
+    def test_update_after_train(self):
+        old = [m[:20] for m in self.data]
+        new = [m[20:] for m in self.data]
+        self.learner.train(old, 5)
+        dico = self.learner.dico
+        error = self.error(new)
+        self.learner.update(new, 5)
+        self.assertFalse(np.allclose(dico, self.learner.dico))
+        self.assertTrue(self.error(new) < error)
+
+    def test_continues_mini_batch_statistics(self):
+        new = [m[:10] for m in self.data]
+        self.learner.train(self.data, 3, batch_size=10)
+        dico = self.learner.dico
+        # Without previous statistics
+        fresh = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3)
+        fresh.dico = dico
+        fresh.update(new, 1)
+        # Previous statistics are forgotten
+        self.learner.update(new, 1, forget_factor=0.)
+        assert_array_almost_equal(self.learner.dico, fresh.dico)
+        # Previous statistics are kept
+        self.learner.train(self.data, 3, batch_size=10)
+        self.learner.update(new, 1)
+        self.assertFalse(np.allclose(self.learner.dico, fresh.dico))
+
+    def test_not_trained(self):
+        with self.assertRaises(ValueError):
+            self.learner.update(self.data, 1)
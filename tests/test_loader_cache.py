@@ -0,0 +1,119 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+from multimodal.db.models.loader import Loader, LoaderCache
+
+
+class CountingLoader(Loader):
+
+    dataset_name = 'counting'
+
+    def __init__(self, conf, n_features=10, sparse=False):
+        super(CountingLoader, self).__init__()
+        self.conf = conf
+        self.n_features = n_features
+        self.sparse = sparse
+        self.calls = 0
+
+    def get_data(self):
+        self.calls += 1
+        X = np.ones((4, self.n_features))
+        self.check_n_samples(X.shape[0])
+        return sp.csr_matrix(X) if self.sparse else X
+
+    def get_labels(self):
+        self.calls += 1
+        labels = ['a', 'b', 'a', 'b']
+        self.check_n_samples(len(labels))
+        return labels
+
+    def serialize(self):
+        return self.conf
+
+
+class UnnamedLoader(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_data(self):
+        self.calls += 1
+        return sp.csr_matrix(np.eye(3))
+
+
+class TestLoaderCache(unittest.TestCase):
+
+    def test_loads_once_per_config(self):
+        cache = LoaderCache()
+        loader1 = CountingLoader({'x': 1, 'y': [2]})
+        loader2 = CountingLoader({'y': [2], 'x': 1})
+        X = cache.get_data(loader1)
+        self.assertIs(cache.get_data(loader2), X)
+        self.assertEqual(cache.get_labels(loader2), ['a', 'b', 'a', 'b'])
+        cache.get_labels(loader1)
+        self.assertEqual(loader1.calls + loader2.calls, 2)
+        cache.get_data(CountingLoader({'x': 2, 'y': [2]}))
+        self.assertEqual(len(cache), 3)
+
+    def test_cached_values_are_protected(self):
+        cache = LoaderCache()
+        loader = CountingLoader(None)
+        with self.assertRaises(ValueError):
+            cache.get_data(loader)[0, 0] = 2.
+        cache.get_labels(loader).append('c')
+        self.assertEqual(len(cache.get_labels(loader)), 4)
+
+    def test_sparse_values_are_copied(self):
+        cache = LoaderCache()
+        loader = CountingLoader(None, sparse=True)
+        X = cache.get_data(loader)
+        X[0, 0] = 2.
+        X2 = cache.get_data(loader)
+        self.assertEqual(X2[0, 0], 1.)
+        self.assertEqual(loader.calls, 1)
+
+    def test_checks_n_samples_on_hits(self):
+        cache = LoaderCache()
+        cache.get_data(CountingLoader(None))
+        loader = CountingLoader(None)
+        cache.get_data(loader)
+        self.assertEqual(loader.calls, 0)
+        self.assertEqual(loader.n_samples, 4)
+        cache.get_labels(loader)
+        loader.n_samples = 3
+        with self.assertRaises(AssertionError):
+            cache.get_labels(loader)
+
+    def test_lru_eviction(self):
+        size = np.ones((4, 10)).nbytes
+        cache = LoaderCache(max_bytes=2 * size)
+        loaders = [CountingLoader(i) for i in range(3)]
+        cache.get_data(loaders[0])
+        cache.get_data(loaders[1])
+        cache.get_data(loaders[0])  # Now most recently used
+        cache.get_data(loaders[2])  # Evicts loaders[1]
+        self.assertEqual(cache.n_bytes, 2 * size)
+        for loader in loaders:
+            cache.get_data(loader)
+        self.assertEqual([l.calls for l in loaders], [1, 2, 2])
+        cache.set_max_bytes(size)
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(cache.n_bytes, 0)
+
+    def test_too_large_values_not_cached(self):
+        cache = LoaderCache(max_bytes=10)
+        loader = CountingLoader(None)
+        cache.get_data(loader)
+        cache.get_data(loader)
+        self.assertEqual(loader.calls, 2)
+        self.assertEqual(len(cache), 0)
+
+    def test_unnamed_loaders_not_cached(self):
+        cache = LoaderCache()
+        loader = UnnamedLoader()
+        cache.get_data(loader)
+        cache.get_data(loader)
+        self.assertEqual(loader.calls, 2)
@@ -4,11 +4,14 @@
 import unittest
 
 import numpy as np
+import scipy.sparse as sp
 from numpy.testing import assert_array_almost_equal
 
 from multimodal.lib.metrics import (generalized_KL, hoyer_sparseness, entropy,
                                     mutual_information, conditional_entropy,
-                                    cosine_similarity)
+                                    cosine_similarity, kl_div, rev_kl_div,
+                                    sym_kl_div, pairwise_kl, pairwise_rev_kl,
+                                    pairwise_sym_kl, KLTerms)
 
 
 def random_NN_matrix(h, w):
@@ -183,3 +186,40 @@ class TestCosineSimilarity(unittest.TestCase):
                       [0., 2., 1.]])
         ok = np.sqrt(np.array([1., .5, 0., 3. / 5.]))
         np.testing.assert_allclose(cosine_similarity(a, b), ok)
+
+
+class TestPairwiseKL(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.a = random_NN_matrix(6, 8)
+        self.a *= self.a > .3
+        self.b = random_NN_matrix(4, 8)
+        self.b *= self.b > .3
+
+    def broadcast(self, measure):
+        return measure(self.a[:, np.newaxis, :], self.b[np.newaxis, :, :])
+
+    def check(self, pairwise, measure):
+        ok = self.broadcast(measure)
+        self.assertEqual(ok.shape, (6, 4))
+        assert_array_almost_equal(pairwise(self.a, self.b), ok)
+        a, b = sp.csr_matrix(self.a), sp.csr_matrix(self.b)
+        assert_array_almost_equal(pairwise(a, self.b), ok)
+        assert_array_almost_equal(pairwise(self.a, b), ok)
+        assert_array_almost_equal(pairwise(a, b), ok)
+        assert_array_almost_equal(
+            pairwise(KLTerms(self.a), KLTerms(b)), ok)
+
+    def test_kl(self):
+        self.check(pairwise_kl, kl_div)
+
+    def test_rev_kl(self):
+        self.check(pairwise_rev_kl, rev_kl_div)
+
+    def test_sym_kl(self):
+        self.check(pairwise_sym_kl, sym_kl_div)
+
+    def test_returns_dense_array_on_sparse(self):
+        r = pairwise_kl(sp.csr_matrix(self.a), sp.csr_matrix(self.b))
+        self.assertIsInstance(r, np.ndarray)
@@ -1,11 +1,19 @@
+import os
+import io
+import pickle
 import unittest
+from contextlib import redirect_stderr
+from shutil import rmtree
+from tempfile import NamedTemporaryFile, mkdtemp
 
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 import scipy.sparse as sp
 
 from multimodal.lib import nmf
 from multimodal.lib.metrics import generalized_KL
+from multimodal.lib.out_of_core import DiskCSRMatrix
+from multimodal.lib.shared_arrays import SharedMatrix
 
 
 def random_NN_matrix(shape):
@@ -164,6 +172,12 @@ class TestFitTransform(unittest.TestCase):
         W, errors = self.nmf.fit_transform(X, return_errors=True)
         self.assertTrue(errors[-1] < errors[0] * 1.e-3)
 
+    def test_transform_errors(self):
+        self.nmf.components_ = random_NN_matrix((3, 5))
+        W, errors = self.nmf.transform(random_NN_matrix((10, 5)),
+                                       return_errors=True)
+        self.assertTrue(errors[-1] <= errors[0])
+
     def test_no_compenents_update(self):
         components = random_NN_matrix((3, 5))
         self.nmf.components_ = components
@@ -190,3 +204,521 @@ class TestSparseDot(unittest.TestCase):
         ok = np.multiply(np.dot(self.a, self.b), (self.ref.todense() != 0))
         ans = nmf._special_sparse_dot(self.a, self.b, self.ref).todense()
         assert_array_almost_equal(ans, ok)
+
+
+class TestPartialFit(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.X = np.dot(random_NN_matrix((40, 3)), random_NN_matrix((3, 12)))
+        self.nmf = nmf.KLdivNMF(n_components=3, tol=0, max_iter=30,
+                                subit=5)
+
+    def test_components_shape_and_normalized(self):
+        self.nmf.partial_fit(self.X[:10, :])
+        self.assertEqual(self.nmf.components_.shape, (3, 12))
+        assert_array_almost_equal(self.nmf.components_.sum(axis=1),
+                                  np.ones((3,)))
+
+    def test_batches_decrease_error(self):
+        self.nmf.partial_fit(self.X[:10, :])
+        W = self.nmf.transform(self.X)
+        err_first = self.nmf.error(self.X, W)
+        self.nmf.fit(self.X, batch_size=10)
+        W = self.nmf.transform(self.X)
+        self.assertTrue(self.nmf.error(self.X, W) < err_first)
+
+    def test_sparse(self):
+        X = sp.csc_matrix(self.X * (self.X > .5))
+        self.nmf.max_iter = 3
+        self.nmf.fit(X, batch_size=7)
+        self.assertTrue(is_NN(self.nmf.components_))
+
+    def test_unsupported_params(self):
+        self.nmf.max_iter = 2
+        self.nmf.fit(self.X, batch_size=10, scale_W=True, forget_factor=.5)
+        with self.assertRaises(ValueError):
+            self.nmf.fit(self.X, batch_size=10, return_errors=True)
+
+
+class TestCheckEvery(unittest.TestCase):
+
+    def test_errors_every_n_iterations(self):
+        X = random_NN_matrix((10, 5))
+        model = nmf.KLdivNMF(n_components=3, tol=0, max_iter=20,
+                             check_every=5)
+        W, errors = model.fit_transform(X, return_errors=True)
+        self.assertEqual(len(errors), 4)
+
+    def test_error_from_Q(self):
+        X = random_NN_sparse(10, 8, .3).tocsr()
+        W = random_NN_matrix((10, 3))
+        H = random_NN_matrix((3, 8))
+        Q = nmf.KLdivNMF._Q(X.toarray(), W, H)
+        err = nmf.KLdivNMF._error_from_Q(X.toarray(), W, H, Q)
+        assert_array_almost_equal(err, generalized_KL(X.toarray(), W.dot(H)))
+        Q = nmf.KLdivNMF._Q(X, W, H)
+        err = nmf.KLdivNMF._error_from_Q(X, W, H, Q)
+        assert_array_almost_equal(err, generalized_KL(X.toarray(), W.dot(H)))
+
+
+class TestThreadedSparse(unittest.TestCase):
+
+    def setUp(self):
+        self.X = random_NN_sparse(37, 23, .3).tocsr()
+        self.W = random_NN_matrix((37, 4))
+        self.H = random_NN_matrix((4, 23))
+
+    def test_row_chunks_cover_rows(self):
+        chunks = nmf._row_chunks(self.X, 10)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], self.X.shape[0])
+        self.assertTrue(all([a[1] == b[0]
+                             for a, b in zip(chunks[:-1], chunks[1:])]))
+
+    def test_chunked_special_sparse_dot(self):
+        ok = nmf._special_sparse_dot(self.W, self.H, self.X)
+        ans = nmf._special_sparse_dot(self.W, self.H, self.X, n_threads=3,
+                                      chunk_size=20)
+        self.assertTrue((ans.indptr == self.X.indptr).all()
+                        and (ans.indices == self.X.indices).all())
+        assert_array_almost_equal(ans.data, ok.data)
+
+    def test_threaded_dots(self):
+        Q = nmf.KLdivNMF._Q(self.X, self.W, self.H, n_threads=3)
+        assert_array_almost_equal(nmf._threaded_dot(Q, self.H.T, 3),
+                                  Q.toarray().dot(self.H.T))
+        assert_array_almost_equal(nmf._threaded_tdot(self.W, Q, 3),
+                                  self.W.T.dot(Q.toarray()))
+
+    def test_same_fit(self):
+        H = random_NN_matrix((4, 23))
+        Ws = []
+        for n_threads in [1, 4]:
+            model = nmf.KLdivNMF(n_components=4, tol=0, max_iter=10,
+                                 n_threads=n_threads)
+            model._init_dictionary = H
+            Ws.append(model.fit_transform(self.X))
+        assert_array_almost_equal(Ws[0], Ws[1])
+
+    def test_one_pool_per_fit(self):
+        pools = []
+        ThreadPool = nmf.ThreadPool
+
+        def counting_pool(*args):
+            pools.append(ThreadPool(*args))
+            return pools[-1]
+
+        nmf.ThreadPool = counting_pool
+        try:
+            model = nmf.KLdivNMF(n_components=4, tol=0, max_iter=10,
+                                 n_threads=3)
+            model.fit_transform(self.X)
+            self.assertEqual(len(pools), 1)
+            model.fit(self.X, batch_size=10)
+            self.assertEqual(len(pools), 2)
+        finally:
+            nmf.ThreadPool = ThreadPool
+        self.assertIsNone(model._pool)
+
+
+class TestFloat32(unittest.TestCase):
+
+    def setUp(self):
+        self.X = np.dot(random_NN_matrix((20, 3)), random_NN_matrix((3, 8)))
+        self.nmf = nmf.KLdivNMF(n_components=3, init='random', tol=0,
+                                max_iter=50, dtype=np.float32)
+
+    def test_keeps_dtype_dense(self):
+        W = self.nmf.fit_transform(self.X)
+        self.assertEqual(W.dtype, np.float32)
+        self.assertEqual(self.nmf.components_.dtype, np.float32)
+        self.assertEqual(self.nmf.transform(self.X).dtype, np.float32)
+
+    def test_keeps_dtype_sparse(self):
+        X = sp.csr_matrix(self.X * (self.X > .5))
+        W = self.nmf.fit_transform(X)
+        self.assertEqual(W.dtype, np.float32)
+        self.assertEqual(self.nmf.components_.dtype, np.float32)
+        self.nmf.partial_fit(X)
+        self.assertEqual(self.nmf.components_.dtype, np.float32)
+
+    def test_converges(self):
+        W, errors = self.nmf.fit_transform(self.X, return_errors=True)
+        self.assertTrue(np.all(np.isfinite(errors)))
+        self.assertTrue(errors[-1] < errors[0] * 1.e-2)
+
+    def test_safe_eps(self):
+        self.assertEqual(nmf._safe_eps(1.e-8, np.float32).dtype, np.float32)
+        self.assertTrue(nmf._safe_eps(1.e-8, np.float16) > 0)
+        eps = nmf._safe_eps(1.e-8, np.float32, scale=30.)
+        self.assertTrue(np.float32(30.) + eps > np.float32(30.))
+        self.assertEqual(nmf._safe_eps(1.e-8, np.float64, scale=30.), 1.e-8)
+
+    def test_zero_denominator(self):
+        # Last sample only uses a feature that is absent from components
+        X = np.zeros((4, 3), dtype=np.float32)
+        X[:3, :2] = 10 * random_NN_matrix((3, 2))
+        X[3, 2] = 20.
+        H = np.array([[1., 0., 0.], [0., 1., 0.]], dtype=np.float32)
+        self.nmf.n_components = 2
+        self.nmf.components_ = H
+        Q = self.nmf._Q(X, X[:, :2], H, eps=nmf._safe_eps(
+            self.nmf.eps, np.float32, scale=X.max()))
+        self.assertTrue(np.all(np.isfinite(Q)))
+        self.assertTrue(Q[3, 2] > 1)  # eps is not lost in the addition
+        W = self.nmf.transform(X)
+        self.assertTrue(np.all(np.isfinite(W)))
+        self.assertTrue(np.isfinite(self.nmf.error(X, W)))
+
+
+    def test_transform_independent_rows(self):
+        self.nmf.fit(self.X)
+        X = self.X * np.array([1.e-3, 1.e3] * 10)[:, np.newaxis]
+        for data in (X, sp.csr_matrix(X * (self.X > .5))):
+            W = self.nmf.transform(data)
+            for i in range(data.shape[0]):
+                np.testing.assert_allclose(
+                    self.nmf.transform(data[i:(i + 1), :]), W[i:(i + 1), :],
+                    rtol=1.e-2)  # Up to rounding in single precision
+
+class TestInit(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.X = np.dot(random_NN_matrix((30, 4)), random_NN_matrix((4, 12)))
+
+    def test_shapes_and_non_negative(self):
+        for init in ['random', 'nndsvd', 'nndsvda', 'nndsvdar']:
+            W, H = nmf._initialize_nmf(self.X, 4, init=init, random_state=0)
+            self.assertEqual(W.shape, (30, 4))
+            self.assertEqual(H.shape, (4, 12))
+            self.assertTrue(is_NN(W) and is_NN(H))
+            assert_array_almost_equal(H.sum(axis=1), np.ones((4,)))
+
+    def test_nndsvd_is_good_init(self):
+        W, H = nmf._initialize_nmf(self.X, 4, init='nndsvd', random_state=0)
+        err_nndsvd = generalized_KL(self.X, W.dot(H))
+        W, H = nmf._initialize_nmf(self.X, 4, init='random', random_state=0)
+        err_random = generalized_KL(self.X, W.dot(H))
+        self.assertTrue(err_nndsvd < err_random)
+
+    def test_nndsvda_has_no_zeros(self):
+        W, H = nmf._initialize_nmf(self.X, 4, init='nndsvda', random_state=0)
+        self.assertFalse((W == 0).any() or (H == 0).any())
+
+    def test_sparse(self):
+        X = sp.csr_matrix(self.X * (self.X > 1.))
+        W, H = nmf._initialize_nmf(X, 4, init='nndsvdar', random_state=0)
+        self.assertTrue(is_NN(W) and is_NN(H))
+
+    def test_seeded(self):
+        model = nmf.KLdivNMF(n_components=4, init='nndsvdar', random_state=3)
+        W1, H1 = model._init(self.X)
+        W2, H2 = model._init(self.X)
+        assert_array_almost_equal(W1, W2)
+        assert_array_almost_equal(H1, H2)
+
+    def test_default_is_previous_random_init(self):
+        np.random.seed(1)
+        H = np.random.random((4, 12))
+        H = (H + .01) / (H + .01).sum(axis=1)[:, np.newaxis]
+        np.random.seed(1)
+        W_init, H_init = nmf.KLdivNMF(n_components=4)._init(self.X)
+        assert_array_almost_equal(H_init, H)
+        assert_array_almost_equal(W_init, self.X.dot(H.T))
+
+    def test_wrong_init(self):
+        with self.assertRaises(ValueError):
+            nmf._initialize_nmf(self.X, 4, init='foo')
+        with self.assertRaises(ValueError):
+            nmf._initialize_nmf(self.X, 13, init='nndsvd')
+
+
+class TestRestarts(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.X = random_NN_sparse(30, 12, .5).tocsr()
+
+    def fit(self, n_restarts, n_jobs=1):
+        model = nmf.KLdivNMF(n_components=3, init='random', tol=0,
+                             max_iter=20, random_state=0,
+                             n_restarts=n_restarts, n_jobs=n_jobs)
+        W = model.fit_transform(self.X)
+        return model.error(self.X, W)
+
+    def test_best_restart_is_not_worse(self):
+        seed = nmf.check_random_state(0).randint(np.iinfo(np.int32).max)
+        model = nmf.KLdivNMF(n_components=3, init='random', tol=0,
+                             max_iter=20, random_state=seed)
+        W = model.fit_transform(self.X)
+        self.assertTrue(self.fit(4) <= model.error(self.X, W) + 1.e-8)
+
+    def test_same_with_processes(self):
+        self.assertAlmostEqual(self.fit(3), self.fit(3, n_jobs=2))
+
+    def test_explicit_zeros_not_modified(self):
+        X = self.X.copy()
+        X.data[::3] = 0.
+        indptr, data = X.indptr.copy(), X.data.copy()
+        clean = X.copy()
+        clean.eliminate_zeros()
+        model = nmf.KLdivNMF(n_components=3, tol=0, max_iter=5,
+                             random_state=0, n_restarts=2, n_jobs=2)
+        W = model.fit_transform(X)
+        assert_array_equal(X.indptr, indptr)
+        assert_array_equal(X.data, data)
+        model.n_jobs = 1
+        assert_array_almost_equal(model.fit_transform(clean), W)
+
+    def test_worker_does_not_modify_shared_data(self):
+        X = self.X.copy()
+        X.data[::3] = 0.
+        model = nmf.KLdivNMF(n_components=3, tol=0, max_iter=2)
+        with SharedMatrix(X) as shared:
+            other = pickle.loads(pickle.dumps(shared))
+            nmf._restart_worker((model, other, 0, {}))
+            other.close()
+            assert_array_equal(shared.get().indptr, X.indptr)
+            assert_array_equal(shared.get().data, X.data)
+
+    def test_returns_errors(self):
+        model = nmf.KLdivNMF(n_components=3, tol=0, max_iter=7, n_restarts=2)
+        W, errors = model.fit_transform(self.X, return_errors=True)
+        self.assertEqual(W.shape, (30, 3))
+        self.assertEqual(len(errors), 7)
+
+    def test_selects_on_weighted_error(self):
+        weights = np.random.random((1, 12))
+        weights[0, :6] *= 100
+        model = nmf.KLdivNMF(n_components=3, tol=0, max_iter=10,
+                             random_state=0, n_restarts=4)
+        W = model.fit_transform(self.X, weights=weights)
+        seeds = nmf.check_random_state(0).randint(np.iinfo(np.int32).max,
+                                                  size=4)
+        errors = [nmf._fit_one_restart(model, self.X, s,
+                                       {'weights': weights})[2]
+                  for s in seeds]
+        self.assertAlmostEqual(model.error(self.X, W, weights=weights),
+                               min(errors))
+
+
+class TestTransformRows(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.H = nmf.normalize_sum(random_NN_matrix((3, 10)), axis=1)
+        self.X = np.dot(random_NN_matrix((15, 3)), self.H)
+        self.nmf = nmf.KLdivNMF(n_components=3, max_iter=200)
+        self.nmf.components_ = self.H
+
+    def test_reconstructs(self):
+        W = self.nmf._transform_rows(self.X, self.X.dot(self.H.T), 1.e-6)
+        self.assertTrue(generalized_KL(self.X, W.dot(self.H)) < 1.e-3)
+
+    def test_same_as_updates_without_tol(self):
+        self.nmf.max_iter = 5
+        W = self.X.dot(self.H.T)
+        ans = self.nmf._transform_rows(self.X, W, 0.)
+        for _ in range(5):
+            W = self.nmf._updated_W(self.X, W, self.H)
+        assert_array_almost_equal(ans, W)
+
+    def test_warm_start_stops_early(self):
+        W = self.nmf._transform_rows(self.X, self.X.dot(self.H.T), 1.e-6,
+                                     criterion='error')
+        n_iter_cold = self.nmf.n_iter_
+        self.nmf._transform_rows(self.X, W, 1.e-6, criterion='error')
+        self.assertTrue(self.nmf.n_iter_ < n_iter_cold)
+        self.assertTrue(self.nmf.n_iter_ <= 2)
+
+    def test_converged_rows_are_not_updated(self):
+        W = self.nmf._transform_rows(self.X, self.X.dot(self.H.T), 1.e-6)
+        W_bad = W.copy()
+        W_bad[0, :] = 1.
+        self.nmf.max_iter = 1
+        W_new = self.nmf._transform_rows(self.X, W_bad, 1.e-2)
+        assert_array_almost_equal(W_new[1:, :], W[1:, :], decimal=3)
+        self.assertFalse(np.allclose(W_new[0, :], 1.))
+
+    def test_converged_rows_leave_working_set(self):
+        W = self.nmf._transform_rows(self.X, self.X.dot(self.H.T), 1.e-6,
+                                     criterion='error')
+        W_bad = W.copy()
+        W_bad[0, :] = 1.
+        W_new = self.nmf._transform_rows(self.X, W_bad, 1.e-6,
+                                         criterion='error')
+        self.assertTrue(self.nmf.n_iter_ > 2)  # Row 0 was updated
+        self.assertFalse(np.allclose(W_new[0, :], 1.))
+        # Other rows are only updated once
+        W_once = self.nmf._updated_W(self.X, W, self.H)
+        assert_array_almost_equal(W_new[1:, :], W_once[1:, :])
+
+    def test_errors(self):
+        W, errors = self.nmf._transform_rows(
+            self.X, self.X.dot(self.H.T), 1.e-6, return_errors=True,
+            criterion='error')
+        self.assertTrue(all([e1 >= e2
+                             for e1, e2 in zip(errors[:-1], errors[1:])]))
+        self.assertAlmostEqual(errors[0],
+                               self.nmf.error(self.X, self.X.dot(self.H.T)))
+
+    def test_given_row_sums(self):
+        W, errors = self.nmf._transform_rows(
+            self.X, self.X.dot(self.H.T), 1.e-6, return_errors=True,
+            H_sums=self.H.sum(axis=1), criterion='error')
+        ok, ok_errors = self.nmf._transform_rows(
+            self.X, self.X.dot(self.H.T), 1.e-6, return_errors=True,
+            criterion='error')
+        assert_array_almost_equal(W, ok)
+        assert_array_almost_equal(errors, ok_errors)
+
+    def test_invalid_criterion(self):
+        with self.assertRaises(ValueError):
+            self.nmf._transform_rows(self.X, self.X.dot(self.H.T),
+                                     criterion='iterations')
+
+    def test_sparse(self):
+        X = sp.csr_matrix(self.X)
+        W = self.nmf._transform_rows(X, X.dot(self.H.T), 1.e-4)
+        W_dense = self.nmf._transform_rows(self.X, self.X.dot(self.H.T),
+                                           1.e-4)
+        assert_array_almost_equal(W, W_dense)
+
+
+class TestBlocks(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.X = random_NN_sparse(30, 12, .5).tocsr()
+        self.H = nmf.normalize_sum(random_NN_matrix((3, 12)), axis=1)
+
+    def fit(self, X, **params):
+        model = nmf.KLdivNMF(n_components=3, tol=0, max_iter=10)
+        model._init_dictionary = self.H
+        return model.fit_transform(X, **params), model.components_
+
+    def test_same_as_in_memory(self):
+        W, H = self.fit(self.X)
+        for X in [self.X, self.X.toarray()]:
+            W_b, H_b = self.fit(X, block_size=7)
+            assert_array_almost_equal(W, W_b)
+            assert_array_almost_equal(H, H_b)
+
+    def test_unsupported_options(self):
+        with self.assertRaises(ValueError):
+            self.fit(self.X, block_size=7, scale_W=True)
+        model = nmf.KLdivNMF(n_components=3, max_iter=10, n_restarts=2)
+        with self.assertRaises(ValueError):
+            model.fit_transform(self.X, block_size=7)
+
+    def test_memmap(self):
+        W, H = self.fit(self.X)
+        with NamedTemporaryFile() as f:
+            X = np.memmap(f.name, mode='w+', dtype=np.float64,
+                          shape=self.X.shape)
+            X[:] = self.X.toarray()
+            W_b, H_b = self.fit(X)
+        assert_array_almost_equal(W, W_b)
+        assert_array_almost_equal(H, H_b)
+
+    def test_transform(self):
+        model = nmf.KLdivNMF(n_components=3, tol=1.e-3, max_iter=100)
+        model.components_ = self.H
+        W, errors = model.transform(self.X, return_errors=True)
+        path = mkdtemp()
+        try:
+            D = DiskCSRMatrix.save(self.X, os.path.join(path, 'X'))
+            for X in [D, self.X.toarray()]:
+                W_b, errors_b = model.transform(X, block_size=7,
+                                                return_errors=True)
+                assert_array_almost_equal(W, W_b)
+                assert_array_almost_equal(errors, errors_b)
+            assert_array_almost_equal(W, model.transform(D))
+        finally:
+            rmtree(path)
+        with self.assertRaises(ValueError):
+            model.transform(self.X, block_size=7,
+                            weights=random_NN_matrix((30, 12)))
+
+    def test_iteration_limit_warning(self):
+        model = nmf.KLdivNMF(n_components=3, tol=1.e-10, max_iter=2)
+        for transform in [False, True]:
+            stderr = io.StringIO()
+            with redirect_stderr(stderr):
+                if transform:
+                    model.transform(self.X, block_size=7)
+                else:
+                    model.fit_transform(self.X, block_size=7)
+            self.assertIn('Iteration limit reached', stderr.getvalue())
+
+
+class TestWeights(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.X = random_NN_sparse(20, 12, .5).tocsr()
+        self.W = random_NN_matrix((20, 3))
+        self.H = nmf.normalize_sum(random_NN_matrix((3, 12)), axis=1)
+        self.weights = random_NN_matrix((20, 12)) + .1
+        self.nmf = nmf.KLdivNMF(n_components=3, tol=0, max_iter=20,
+                                init='random', random_state=0)
+
+    def test_error_is_weighted_gen_kl(self):
+        X = self.X.toarray()
+        WH = self.W.dot(self.H)
+        ok = np.sum(self.weights * (X * np.log((X + 1.e-8) / (WH + 1.e-8))
+                                    - X + WH))
+        self.assertAlmostEqual(
+            self.nmf.error(X, self.W, self.H, weights=self.weights), ok)
+        self.assertAlmostEqual(
+            self.nmf.error(self.X, self.W, self.H, weights=self.weights), ok)
+
+    def test_uniform_weights(self):
+        W = self.nmf._updated_W(self.X, self.W, self.H)
+        W_w = self.nmf._updated_W(self.X, self.W, self.H,
+                                  weights=np.ones((1, 12)))
+        assert_array_almost_equal(W, W_w)
+        H = self.nmf._updated_H(self.X, self.W, self.H)
+        H_w = self.nmf._updated_H(self.X, self.W, self.H,
+                                  weights=np.ones((20, 1)))
+        assert_array_almost_equal(H, H_w)
+
+    def test_decreases_error(self):
+        for weights in [self.weights, self.weights[:1, :],
+                        self.weights[:, :1],
+                        self.X.multiply(self.weights).tocsr()]:
+            for X in [self.X, self.X.toarray()]:
+                _, errors = self.nmf.fit_transform(X, weights=weights,
+                                                   return_errors=True)
+                self.assertTrue((np.diff(errors) <= 1.e-10).all())
+
+    def test_sparse_weights_ignore_zeros(self):
+        weights = self.X.multiply(self.weights).tocsr()
+        W = self.nmf.fit_transform(self.X, weights=weights)
+        H = self.nmf.components_
+        W_d = self.nmf.fit_transform(self.X.toarray(),
+                                     weights=weights.toarray())
+        assert_array_almost_equal(W, W_d)
+        assert_array_almost_equal(H, self.nmf.components_)
+
+    def test_transform_rows(self):
+        self.nmf.components_ = self.H
+        weights = self.weights[:1, :]
+        W = self.nmf._transform_rows(self.X, self.W, tol=0, weights=weights)
+        ok = self.W
+        for _ in range(self.nmf.max_iter):
+            ok = self.nmf._updated_W(self.X, ok, self.H, weights=weights)
+        assert_array_almost_equal(W, ok)
+
+    def test_mini_batch(self):
+        self.nmf.max_iter = 3
+        self.nmf.fit(self.X, batch_size=7, weights=self.weights)
+        assert_array_almost_equal(self.nmf.components_.sum(axis=1),
+                                  np.ones((3,)))
+
+    def test_no_weights_on_blocks(self):
+        with self.assertRaises(ValueError):
+            self.nmf.fit_transform(self.X, weights=self.weights,
+                                   block_size=5)
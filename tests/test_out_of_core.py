@@ -0,0 +1,62 @@
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import scipy.sparse as sp
+
+from multimodal.lib.out_of_core import (DiskCSRMatrix, is_out_of_core,
+                                        default_block_rows)
+
+
+class TestDiskCSRMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'mat')
+        self.X = sp.rand(23, 11, .3, format='csr')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_save_and_slice(self):
+        D = DiskCSRMatrix.save(self.X, self.path)
+        self.assertEqual(D.shape, self.X.shape)
+        self.assertEqual(D.nnz, self.X.nnz)
+        np.testing.assert_array_equal(D[3:17].toarray(),
+                                      self.X[3:17].toarray())
+        np.testing.assert_array_equal(D[:].toarray(), self.X.toarray())
+
+    def test_from_row_blocks(self):
+        blocks = (self.X[i:(i + 5)] for i in range(0, 23, 5))
+        D = DiskCSRMatrix.from_row_blocks(blocks, self.path)
+        np.testing.assert_array_equal(D[:].toarray(), self.X.toarray())
+        # Can be opened again
+        D = DiskCSRMatrix(self.path)
+        np.testing.assert_array_equal(D[5:6].toarray(),
+                                      self.X[5:6].toarray())
+
+    def test_dense_blocks(self):
+        D = DiskCSRMatrix.from_row_blocks([self.X.toarray()], self.path)
+        np.testing.assert_array_equal(D[:].toarray(), self.X.toarray())
+
+    def test_only_slices(self):
+        D = DiskCSRMatrix.save(self.X, self.path)
+        with self.assertRaises(TypeError):
+            D[[1, 2]]
+        with self.assertRaises(ValueError):
+            D[::2]
+
+    def test_is_out_of_core(self):
+        D = DiskCSRMatrix.save(self.X, self.path)
+        self.assertTrue(is_out_of_core(D))
+        self.assertFalse(is_out_of_core(self.X))
+        np.save(self.path + '.npy', self.X.toarray())
+        self.assertTrue(is_out_of_core(np.load(self.path + '.npy',
+                                               mmap_mode='r')))
+
+    def test_default_block_rows(self):
+        self.assertEqual(default_block_rows(np.zeros((10, 5)), 20), 4)
+        D = DiskCSRMatrix.save(sp.eye(10, 5, format='csr'), self.path)
+        self.assertEqual(default_block_rows(D, 20), 20)
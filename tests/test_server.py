@@ -0,0 +1,137 @@
+import os
+import json
+import asyncio
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+
+from multimodal.learner import MultimodalLearner
+from multimodal.server import InferenceServer
+
+
+def random_NN_matrix(h, w):
+    return np.abs(np.random.random((h, w)))
+
+
+class FailingServer(InferenceServer):
+
+    async def _next_batch(self, batch):
+        await super(FailingServer, self)._next_batch(batch)
+        raise RuntimeError('Broken worker.')
+
+
+class TestInferenceServer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.learner = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3)
+        self.learner.dico = random_NN_matrix(3, 10)
+        self.data = random_NN_matrix(5, 6)
+
+    def test_batches_concurrent_requests(self):
+        async def run():
+            async with InferenceServer(self.learner, 20,
+                                       max_latency=.1) as server:
+                results = await asyncio.gather(
+                    *[server.modality_to_modality('a', 'b', x)
+                      for x in self.data])
+                return results, server.n_batches
+
+        results, n_batches = asyncio.run(run())
+        self.assertEqual(n_batches, 1)
+        ok = self.learner.modality_to_modality('a', 'b', self.data, 20)
+        assert_array_almost_equal(np.vstack(results), ok)
+
+    def test_batch_independent_results(self):
+        learner = MultimodalLearner(['a', 'b'], [6, 4], [1., 2.], 3,
+                                    dtype=np.float32)
+        learner.dico = self.learner.dico
+        # Samples of very different magnitudes in single precision
+        data = self.data * np.array([[1.e-3], [1.e3], [1.], [1.e-3], [1.]])
+
+        async def run():
+            async with InferenceServer(learner, 20,
+                                       max_latency=.1) as server:
+                results = await asyncio.gather(
+                    *[server.modality_to_modality('a', 'b', x)
+                      for x in data])
+                return results, server.n_batches
+
+        results, n_batches = asyncio.run(run())
+        self.assertEqual(n_batches, 1)
+        for x, r in zip(data, results):
+            ok = learner.modality_to_modality('a', 'b', x[np.newaxis, :],
+                                              20)
+            np.testing.assert_allclose(r, ok, rtol=1.e-5)
+
+    def test_max_batch_size(self):
+        async def run():
+            async with InferenceServer(self.learner, 5, max_batch_size=2,
+                                       max_latency=.1) as server:
+                await asyncio.gather(*[server.reconstruct_internal('a', x)
+                                       for x in self.data])
+                return server.n_batches
+
+        self.assertEqual(asyncio.run(run()), 3)
+
+    def test_worker_failure(self):
+        async def run():
+            async with FailingServer(self.learner, 5,
+                                     max_latency=.1) as server:
+                results = await asyncio.gather(
+                    *[server.reconstruct_internal('a', x)
+                      for x in self.data], return_exceptions=True)
+                try:
+                    await server.reconstruct_internal('a', self.data)
+                except RuntimeError as e:
+                    results.append(e)
+                return results
+
+        results = asyncio.run(run())
+        self.assertEqual(len(results), 6)
+        for r in results:
+            self.assertIsInstance(r, RuntimeError)
+
+    def test_unix_socket(self):
+        path = mkdtemp()
+        socket_path = os.path.join(path, 'server.sock')
+
+        async def run():
+            server = InferenceServer(self.learner, 20)
+            listening = await server.serve(path=socket_path)
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+            requests = [{'id': 1, 'op': 'reconstruct_internal',
+                         'modality': 'a', 'data': self.data.tolist()},
+                        {'id': 2, 'op': 'wrong', 'modality': 'a', 'data': []},
+                        {'id': 3, 'op': 'reconstruct_internal',
+                         'modality': 'a', 'data': [[1., 2.]]}]
+            requests.extend({'id': 4 + i, 'op': 'reconstruct_internal',
+                             'modality': 'a', 'data': [x.tolist()]}
+                            for i, x in enumerate(self.data))
+            for request in requests:
+                writer.write((json.dumps(request) + '\n').encode('utf-8'))
+            answers = {}
+            for _ in requests:
+                answer = json.loads((await reader.readline()).decode('utf-8'))
+                answers[answer['id']] = answer
+            writer.close()
+            listening.close()
+            await listening.wait_closed()
+            await server.stop()
+            return answers, server.n_batches
+
+        try:
+            answers, n_batches = asyncio.run(run())
+        finally:
+            rmtree(path)
+        ok = self.learner.reconstruct_internal('a', self.data, 20)
+        assert_array_almost_equal(np.array(answers[1]['result']), ok)
+        self.assertIn('error', answers[2])
+        self.assertIn('error', answers[3])
+        # Pipelined requests are batched together
+        assert_array_almost_equal(
+            np.vstack([answers[4 + i]['result'] for i in range(5)]), ok)
+        self.assertTrue(n_batches < 6)
@@ -0,0 +1,40 @@
+import unittest
+import pickle
+
+import numpy as np
+import scipy.sparse as sp
+
+from multimodal.lib.shared_arrays import SharedMatrix
+
+
+class TestSharedMatrix(unittest.TestCase):
+
+    def test_dense(self):
+        X = np.random.random((4, 3))
+        with SharedMatrix(X) as shared:
+            np.testing.assert_array_equal(shared.get(), X)
+
+    def test_sparse(self):
+        for fmt in ['csr', 'csc', 'coo']:
+            X = sp.rand(5, 7, .3, format=fmt)
+            with SharedMatrix(X) as shared:
+                Y = shared.get()
+                self.assertTrue(sp.issparse(Y))
+                np.testing.assert_array_equal(Y.toarray(), X.toarray())
+
+    def test_pickled_shares_data(self):
+        X = np.random.random((4, 3))
+        with SharedMatrix(X) as shared:
+            other = pickle.loads(pickle.dumps(shared))
+            shared.get()[0, 0] = -1.
+            self.assertEqual(other.get()[0, 0], -1.)
+            other.close()
+
+    def test_read_only_in_other_processes(self):
+        X = sp.rand(5, 7, .3, format='csr')
+        with SharedMatrix(X) as shared:
+            other = pickle.loads(pickle.dumps(shared))
+            if other._blocks is not None:  # Not pickled as usual
+                with self.assertRaises(ValueError):
+                    other.get().data[0] = -1.
+            other.close()